@@ -585,10 +585,12 @@ const ScanPage = () => {
 
       const fastData = await fastResponse.json();
 
-      // Extract prediction from fast response
-      const prediction = fastData.prediction.hybrid_prediction;
+      // Extract prediction from fast response (the triage student answers under its own fields)
+      const isTriage = fastData.tier === "triage";
+      const prediction = isTriage ? fastData.prediction.triage_prediction : fastData.prediction.hybrid_prediction;
+      const confidence = isTriage ? fastData.prediction.triage_confidence : fastData.prediction.hybrid_confidence;
       setPredictionResult(prediction);
-      setConfidenceLevel(`${(fastData.prediction.hybrid_confidence * 100).toFixed(1)}%`);
+      setConfidenceLevel(`${(confidence * 100).toFixed(1)}%`);
       console.log("Fast prediction received:", prediction);
 
       setLoading(false);
@@ -599,7 +601,9 @@ const ScanPage = () => {
       const limeFormData = new FormData();
       limeFormData.append('file', selectedFiles[0]);
 
-      fetch(`${API_URL}/generate-lime?num_samples=100`, {
+      // Explain the diagnosis that is shown and saved (the triage label when the student answered)
+      const explainClass = isTriage ? `&explain_class=${encodeURIComponent(prediction)}` : "";
+      fetch(`${API_URL}/generate-lime?num_samples=100${explainClass}`, {
         method: 'POST',
         body: limeFormData,
       })
@@ -620,8 +624,12 @@ const ScanPage = () => {
             // Prepare comprehensive notes array
             const notes = [
               `Autoencoder Validation: Diseased teeth detected (passed validation)`,
-              `CNN Prediction: ${fastData.prediction.cnn_prediction} (${(fastData.prediction.cnn_confidence * 100).toFixed(1)}% confidence)`,
-              `Hybrid Prediction: ${fastData.prediction.hybrid_prediction} (${(fastData.prediction.hybrid_confidence * 100).toFixed(1)}% confidence)`,
+              ...(isTriage
+                ? [`Triage Prediction: ${prediction} (${(confidence * 100).toFixed(1)}% confidence)`]
+                : [
+                    `CNN Prediction: ${fastData.prediction.cnn_prediction} (${(fastData.prediction.cnn_confidence * 100).toFixed(1)}% confidence)`,
+                    `Hybrid Prediction: ${fastData.prediction.hybrid_prediction} (${(fastData.prediction.hybrid_confidence * 100).toFixed(1)}% confidence)`,
+                  ]),
               `Total Positive Evidence: ${limeData.lime_statistics.total_positive_evidence.toFixed(4)}`,
               `Total Negative Evidence: ${limeData.lime_statistics.total_negative_evidence.toFixed(4)}`,
               `Net Evidence: ${limeData.lime_statistics.net_evidence.toFixed(4)}`,
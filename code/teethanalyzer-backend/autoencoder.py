@@ -0,0 +1,303 @@
+# autoencoder.py - PyTorch autoencoder gate (healthy vs diseased)
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torchvision import transforms
+from PIL import Image
+import numpy as np
+import argparse
+import base64
+import json
+import os
+import io
+import logging
+
+logger = logging.getLogger(__name__)
+
+AUTOENCODER_PATH = 'hybrid_models/autoencoder_healthy.pth'
+AUTOENCODER_IMAGE_SIZE = (224, 224)
+
+# Autoencoder threshold (tune this based on your validation results)
+RECONSTRUCTION_ERROR_THRESHOLD = 0.05  # Adjust based on your model's performance
+
+# Anomaly heatmap: reconstruction error pooled into an ANOMALY_GRID x ANOMALY_GRID
+# map (16x16 pixel patches at 224x224) and rendered as a small PNG overlay
+ANOMALY_GRID = 14
+ANOMALY_TOP_K = 5
+ANOMALY_OVERLAY_SIZE = 112
+
+# ==================== DEFINE AUTOENCODER ARCHITECTURE ====================
+# You need to define the same architecture as your training code
+class SimpleAutoencoder(nn.Module):
+    def __init__(self):
+        super(SimpleAutoencoder, self).__init__()
+        # Encoder
+        self.encoder = nn.Sequential(
+            nn.Conv2d(3, 16, 3, stride=2, padding=1),  # [B, 16, 112, 112]
+            nn.ReLU(),
+            nn.Conv2d(16, 32, 3, stride=2, padding=1), # [B, 32, 56, 56]
+            nn.ReLU(),
+            nn.Conv2d(32, 64, 3, stride=2, padding=1), # [B, 64, 28, 28]
+            nn.ReLU(),
+        )
+        # Decoder
+        self.decoder = nn.Sequential(
+            nn.ConvTranspose2d(64, 32, 3, stride=2, padding=1, output_padding=1), # [B, 32, 56, 56]
+            nn.ReLU(),
+            nn.ConvTranspose2d(32, 16, 3, stride=2, padding=1, output_padding=1), # [B, 16, 112, 112]
+            nn.ReLU(),
+            nn.ConvTranspose2d(16, 3, 3, stride=2, padding=1, output_padding=1),  # [B, 3, 224, 224]
+            nn.Sigmoid(),  # Output in [0,1]
+        )
+    def forward(self, x):
+        x = self.encoder(x)
+        x = self.decoder(x)
+        return x
+
+# Image preprocessing for PyTorch
+transform = transforms.Compose([
+    transforms.Resize(AUTOENCODER_IMAGE_SIZE),
+    transforms.ToTensor(),  # Converts to [0, 1] and changes to CHW format
+])
+
+def preprocess_image_for_autoencoder(image_bytes):
+    """Preprocess image for PyTorch autoencoder"""
+    img = Image.open(io.BytesIO(image_bytes))
+    img = img.convert('RGB')
+    img_tensor = transform(img)  # Shape: (3, 224, 224)
+    img_tensor = img_tensor.unsqueeze(0)  # Add batch dimension: (1, 3, 224, 224)
+    return img_tensor
+
+def preprocess_images_for_autoencoder(images_bytes):
+    """Preprocess several images into one (N, 3, 224, 224) batch"""
+    return torch.stack([
+        transform(Image.open(io.BytesIO(image_bytes)).convert('RGB'))
+        for image_bytes in images_bytes
+    ])
+
+def reconstruction_errors(model, batch):
+    """Per-image reconstruction MSE for a (N, 3, H, W) batch in one forward.
+
+    mse_loss's default reduction averages over the whole batch, so the squared
+    error is kept unreduced and averaged per image instead.
+    """
+    with torch.no_grad():
+        reconstructed = model(batch)
+        errors = F.mse_loss(reconstructed, batch, reduction='none').mean(dim=(1, 2, 3))
+    return errors.cpu().numpy(), reconstructed
+
+def autoencoder_verdict(reconstruction_error, threshold=RECONSTRUCTION_ERROR_THRESHOLD):
+    """Turn one reconstruction error into the healthy/diseased validation result"""
+    # Determine if image is valid (diseased) or invalid (healthy)
+    # High error = diseased (autoencoder can't reconstruct anomalies well)
+    # Low error = healthy (autoencoder reconstructs healthy teeth well)
+    is_valid = reconstruction_error > threshold
+    
+    # Calculate confidence based on distance from threshold
+    error_diff = abs(reconstruction_error - threshold)
+    confidence = min(0.99, 0.5 + error_diff * 10)
+    
+    status = 'diseased' if is_valid else 'healthy'
+    
+    return {
+        'is_valid': bool(is_valid),
+        'reconstruction_error': float(reconstruction_error),
+        'threshold': threshold,
+        'confidence': float(confidence),
+        'status': status
+    }
+
+# ==================== ANOMALY HEATMAP ====================
+
+def anomaly_maps(batch, reconstructed, grid=ANOMALY_GRID):
+    """Per-patch reconstruction error, (N, grid, grid), from an existing forward.
+
+    The mean of a map equals the image's reconstruction error, so patch values
+    are on the same scale as RECONSTRUCTION_ERROR_THRESHOLD.
+    """
+    with torch.no_grad():
+        pixel_error = (reconstructed - batch).pow(2).mean(dim=1, keepdim=True)  # (N, 1, H, W)
+        patch_error = F.adaptive_avg_pool2d(pixel_error, grid)
+    return patch_error[:, 0].cpu().numpy()
+
+def top_anomalous_regions(error_map, k=ANOMALY_TOP_K, threshold=RECONSTRUCTION_ERROR_THRESHOLD):
+    """The k highest-error patches with boxes as fractions of image width/height"""
+    rows, cols = error_map.shape
+    order = np.argsort(error_map, axis=None)[::-1][:k]
+    regions = []
+    for flat_index in order:
+        row, col = divmod(int(flat_index), cols)
+        error = float(error_map[row, col])
+        regions.append({
+            'row': row,
+            'col': col,
+            'box': [col / cols, row / rows, (col + 1) / cols, (row + 1) / rows],  # x0, y0, x1, y1
+            'error': error,
+            'ratio_to_threshold': error / threshold
+        })
+    return regions
+
+def render_anomaly_overlay(error_map, threshold=RECONSTRUCTION_ERROR_THRESHOLD, size=ANOMALY_OVERLAY_SIZE):
+    """Small RGBA PNG (base64) of the map; full heat at twice the threshold"""
+    t = np.clip(error_map / (2 * threshold), 0.0, 1.0)
+    # Black-red-yellow-white ramp, transparent where the error is low
+    rgba = np.stack([
+        np.clip(3 * t, 0, 1),
+        np.clip(3 * t - 1, 0, 1),
+        np.clip(3 * t - 2, 0, 1),
+        0.8 * t,
+    ], axis=-1)
+    overlay = Image.fromarray((rgba * 255).astype(np.uint8), mode='RGBA')
+    overlay = overlay.resize((size, size), Image.BILINEAR)
+
+    buf = io.BytesIO()
+    overlay.save(buf, format='PNG', optimize=True)
+    return base64.b64encode(buf.getvalue()).decode('utf-8')
+
+def anomaly_heatmap(error_map, threshold=RECONSTRUCTION_ERROR_THRESHOLD):
+    """Compact heatmap payload for one image"""
+    return {
+        'grid': list(error_map.shape),
+        'values': np.round(error_map, 5).tolist(),
+        'overlay_png': render_anomaly_overlay(error_map, threshold),
+        'top_regions': top_anomalous_regions(error_map, threshold=threshold)
+    }
+
+def load_autoencoder(model_path=AUTOENCODER_PATH):
+    """Build the autoencoder, load its weights and put it in eval mode"""
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    logger.info(f"Using device: {device}")
+
+    model = SimpleAutoencoder().to(device)
+    model.load_state_dict(torch.load(model_path, map_location=device))
+    model.eval()  # Set to evaluation mode
+
+    logger.info("PyTorch Autoencoder model loaded successfully")
+    return model, device
+
+def warmup_autoencoder(model, device):
+    """Run one dummy forward so the first real request does not pay for lazy init"""
+    dummy = torch.zeros(1, 3, *AUTOENCODER_IMAGE_SIZE, device=device)
+    with torch.no_grad():
+        model(dummy)
+
+# ==================== OFFLINE THRESHOLD CALIBRATION ====================
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+def iter_labeled_images(data_dir):
+    """Yield (label, path) for every image in data_dir/<label>/"""
+    for label in sorted(os.listdir(data_dir)):
+        label_dir = os.path.join(data_dir, label)
+        if not os.path.isdir(label_dir):
+            continue
+        for name in sorted(os.listdir(label_dir)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                yield label, os.path.join(label_dir, name)
+
+def score_folder(model, device, data_dir, batch_size=32):
+    """Stream a labeled folder through the autoencoder in batches.
+
+    Returns {label: np.ndarray of per-image reconstruction errors}.
+    """
+    errors = {}
+    batch_labels, batch_tensors = [], []
+
+    def flush():
+        batch = torch.stack(batch_tensors).to(device)
+        batch_errors, _ = reconstruction_errors(model, batch)
+        for label, error in zip(batch_labels, batch_errors):
+            errors.setdefault(label, []).append(float(error))
+        batch_labels.clear()
+        batch_tensors.clear()
+
+    for label, path in iter_labeled_images(data_dir):
+        try:
+            with Image.open(path) as img:
+                batch_tensors.append(transform(img.convert('RGB')))
+        except Exception as e:
+            logger.warning(f"Skipping unreadable image {path}: {str(e)}")
+            continue
+        batch_labels.append(label)
+        if len(batch_tensors) == batch_size:
+            flush()
+    if batch_tensors:
+        flush()
+
+    return {label: np.array(values) for label, values in errors.items()}
+
+def suggest_threshold(healthy_errors, diseased_errors):
+    """Threshold that maximizes balanced accuracy (healthy below, diseased above)"""
+    candidates = np.unique(np.concatenate([healthy_errors, diseased_errors]))
+    # Midpoints between neighbouring errors, plus both ends
+    candidates = np.concatenate([
+        [candidates[0] - 1e-9],
+        (candidates[:-1] + candidates[1:]) / 2,
+        [candidates[-1] + 1e-9],
+    ])
+    healthy_sorted = np.sort(healthy_errors)
+    diseased_sorted = np.sort(diseased_errors)
+    # Fraction of healthy at or below / diseased above each candidate
+    specificity = np.searchsorted(healthy_sorted, candidates, side='right') / len(healthy_sorted)
+    sensitivity = 1.0 - np.searchsorted(diseased_sorted, candidates, side='right') / len(diseased_sorted)
+    balanced_accuracy = (specificity + sensitivity) / 2
+    best = int(np.argmax(balanced_accuracy))
+    return {
+        'threshold': float(candidates[best]),
+        'balanced_accuracy': float(balanced_accuracy[best]),
+        'sensitivity': float(sensitivity[best]),
+        'specificity': float(specificity[best]),
+    }
+
+def calibrate(data_dir, healthy_label='healthy', batch_size=32, model_path=AUTOENCODER_PATH):
+    """Error distribution per label and a suggested RECONSTRUCTION_ERROR_THRESHOLD"""
+    model, device = load_autoencoder(model_path)
+    errors = score_folder(model, device, data_dir, batch_size=batch_size)
+    if not errors:
+        raise ValueError(f"No labeled images found under {data_dir}")
+
+    distribution = {
+        label: {
+            'count': int(len(values)),
+            'mean': float(values.mean()),
+            'std': float(values.std()),
+            'percentiles': {
+                str(p): float(np.percentile(values, p)) for p in (5, 25, 50, 75, 95)
+            },
+        }
+        for label, values in errors.items()
+    }
+    report = {
+        'current_threshold': RECONSTRUCTION_ERROR_THRESHOLD,
+        'distribution': distribution,
+    }
+
+    healthy = errors.get(healthy_label)
+    diseased = [values for label, values in errors.items() if label != healthy_label]
+    if healthy is not None and diseased:
+        report['suggested'] = suggest_threshold(healthy, np.concatenate(diseased))
+    else:
+        report['suggested'] = None
+        logger.warning(f"Need a '{healthy_label}' folder and at least one other label to suggest a threshold")
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Autoencoder gate utilities")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    calibrate_parser = subparsers.add_parser(
+        'calibrate',
+        help="Score a labeled folder (data_dir/<label>/*.jpg) and suggest a threshold"
+    )
+    calibrate_parser.add_argument('data_dir')
+    calibrate_parser.add_argument('--healthy-label', default='healthy')
+    calibrate_parser.add_argument('--batch-size', type=int, default=32)
+    calibrate_parser.add_argument('--model-path', default=AUTOENCODER_PATH)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'calibrate':
+        report = calibrate(args.data_dir, healthy_label=args.healthy_label,
+                           batch_size=args.batch_size, model_path=args.model_path)
+        print(json.dumps(report, indent=2))
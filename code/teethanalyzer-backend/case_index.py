@@ -0,0 +1,229 @@
+# case_index.py - Similar-case retrieval over hybrid CNN embeddings
+import os
+import time
+import logging
+import threading
+import numpy as np
+
+from feature_store import FeatureStore
+
+logger = logging.getLogger(__name__)
+
+# Persistent index location; empty disables case indexing
+CASE_INDEX_DIR = os.getenv("CASE_INDEX_DIR", "cache/case_index")
+# "exact" = NumPy brute force; "ivf" = k-means partitions, probing the nearest few
+CASE_INDEX_MODE = os.getenv("CASE_INDEX_MODE", "exact")
+CASE_INDEX_QUANTIZE = os.getenv("CASE_INDEX_QUANTIZE", "0") == "1"
+CASE_INDEX_LISTS = int(os.getenv("CASE_INDEX_LISTS", "64"))
+CASE_INDEX_PROBES = int(os.getenv("CASE_INDEX_PROBES", "8"))
+# Below this many cases IVF falls back to brute force (partitions would be too small)
+CASE_INDEX_IVF_MIN_CASES = int(os.getenv("CASE_INDEX_IVF_MIN_CASES", "2000"))
+
+EMBEDDING_DIM = 1024
+CASES_STORE = "cases"
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+def _kmeans(vectors, k, iters=10, seed=0):
+    """Spherical k-means on unit vectors; returns (centroids, assignment)"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=k, replace=False)].copy()
+    for _ in range(iters):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        for j in range(k):
+            members = vectors[assignment == j]
+            if len(members):
+                centroids[j] = members.mean(axis=0)
+        centroids = _normalize(centroids)
+    return centroids, np.argmax(vectors @ centroids.T, axis=1)
+
+class CaseIndex:
+    """Cosine-similarity index of past cases (embedding + predicted label).
+
+    Vectors persist in a FeatureStore (so the index survives restarts and is
+    shared by workers); the searchable matrix lives in memory and grows
+    incrementally, including with cases other workers added (checked before
+    each search). Optional int8 quantization keeps one scale per vector and
+    cuts index memory 4x.
+    """
+
+    def __init__(self, root, mode=CASE_INDEX_MODE, quantize=CASE_INDEX_QUANTIZE,
+                 n_lists=CASE_INDEX_LISTS, n_probe=CASE_INDEX_PROBES):
+        if mode not in ("exact", "ivf"):
+            raise ValueError(f"Unknown case index mode '{mode}' (expected 'exact' or 'ivf')")
+        self.mode = mode
+        self.quantize = quantize
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.store = FeatureStore(root, CASES_STORE, (EMBEDDING_DIM,))
+        self._lock = threading.Lock()
+
+        self.digests = []
+        self._capacity = 0
+        self._vectors = np.empty((0, EMBEDDING_DIM), dtype=np.int8 if quantize else np.float32)
+        self._scales = np.empty(0, dtype=np.float32)
+        self._centroids = None
+        self._assignment = np.empty(0, dtype=np.int64)
+        self._trained_size = 0
+        self._training = False
+
+        digests = self.store.digests()
+        if digests:
+            self._append(digests, self.store.as_array())
+        logger.info(f"Case index loaded with {len(self.digests)} cases ({mode}{', int8' if quantize else ''})")
+
+    def __len__(self):
+        return len(self.digests)
+
+    def _append(self, digests, vectors):
+        vectors = _normalize(vectors)
+        n = len(self.digests)
+        needed = n + len(digests)
+        if needed > self._capacity:
+            self._capacity = max(needed, 2 * self._capacity, 1024)
+            grown = np.empty((self._capacity, EMBEDDING_DIM), dtype=self._vectors.dtype)
+            grown[:n] = self._vectors[:n]
+            self._vectors = grown
+            scales = np.ones(self._capacity, dtype=np.float32)
+            scales[:n] = self._scales[:n]
+            self._scales = scales
+
+        if self.quantize:
+            scales = np.abs(vectors).max(axis=1) / 127.0
+            scales = np.maximum(scales, 1e-12)
+            self._vectors[n:needed] = np.round(vectors / scales[:, None]).astype(np.int8)
+            self._scales[n:needed] = scales
+        else:
+            self._vectors[n:needed] = vectors
+        self.digests.extend(digests)
+
+        if self._centroids is not None:
+            new_assignment = np.argmax(vectors @ self._centroids.T, axis=1)
+            self._assignment = np.concatenate([self._assignment, new_assignment])
+
+    def _sync(self):
+        """Append rows other workers added to the shared store since the last check.
+
+        self.digests always follows the store's row order, so only the tail is new.
+        """
+        self.store.refresh()
+        n = len(self.digests)
+        if self.store.count > n:
+            self._append(self.store.digests()[n:], self.store.as_array()[n:self.store.count])
+
+    def _needs_training(self):
+        n = len(self.digests)
+        return (self.mode == "ivf" and not self._training and n >= CASE_INDEX_IVF_MIN_CASES
+                and n >= 2 * self._trained_size)
+
+    def _train(self):
+        """(Re)build IVF partitions when the collection has doubled since last time.
+
+        k-means runs on a snapshot outside the index lock, so concurrent searches
+        keep using the previous partitions until the new ones are swapped in.
+        """
+        with self._lock:
+            if not self._needs_training():
+                return
+            self._training = True
+            n = len(self.digests)
+            vectors = self._dequantized(np.arange(n))  # fancy indexing copies
+        try:
+            start = time.perf_counter()
+            centroids, assignment = _kmeans(vectors, min(self.n_lists, n))
+            with self._lock:
+                # Rows appended while training get assigned to the new partitions
+                tail = self._dequantized(np.arange(n, len(self.digests)))
+                self._centroids = centroids
+                self._assignment = np.concatenate([assignment, np.argmax(tail @ centroids.T, axis=1)])
+                self._trained_size = n
+            logger.info(f"Case index IVF trained on {n} cases in {time.perf_counter() - start:.2f}s")
+        finally:
+            with self._lock:
+                self._training = False
+
+    def _dequantized(self, rows):
+        if self.quantize:
+            return self._vectors[rows].astype(np.float32) * self._scales[rows, None]
+        return self._vectors[rows]
+
+    def _scores(self, rows, query):
+        if self.quantize:
+            return (self._vectors[rows] @ query) * self._scales[rows]
+        return self._vectors[rows] @ query
+
+    def add(self, digest, embedding, label, confidence=None):
+        """Insert one case (no-op if this image is already indexed)"""
+        with self._lock:
+            if digest in self.store:
+                return
+            meta = {"label": label, "confidence": confidence, "added": time.time()}
+            self.store.put(digest, embedding, meta)
+            # Picks up this row together with any rows other workers wrote before it
+            self._sync()
+
+    def search(self, embedding, k=5, exclude=None):
+        """k most similar indexed cases as [{image_hash, label, similarity, ...}]"""
+        query = _normalize(np.asarray(embedding).reshape(-1))
+        with self._lock:
+            self._sync()
+            train = self._needs_training()
+        if train:
+            self._train()
+        with self._lock:
+            n = len(self.digests)
+            if n == 0:
+                return []
+            if self._centroids is not None and self.mode == "ivf":
+                probes = np.argsort(self._centroids @ query)[::-1][:self.n_probe]
+                rows = np.flatnonzero(np.isin(self._assignment[:n], probes))
+            else:
+                rows = np.arange(n)
+            scores = self._scores(rows, query)
+
+            top = min(k + 1, len(rows))
+            best = np.argpartition(-scores, top - 1)[:top]
+            best = best[np.argsort(-scores[best])]
+
+            results = []
+            for i in best:
+                digest = self.digests[rows[i]]
+                if digest == exclude:
+                    continue
+                meta = self.store.meta.get(digest, {})
+                results.append({
+                    "image_hash": digest,
+                    "label": meta.get("label"),
+                    "confidence": meta.get("confidence"),
+                    "similarity": float(scores[i]),
+                })
+                if len(results) == k:
+                    break
+            return results
+
+    def stats(self):
+        return {
+            "cases": len(self.digests),
+            "mode": self.mode,
+            "quantized": self.quantize,
+            "ivf_trained": self._centroids is not None,
+            "ivf_training": self._training,
+            "ivf_lists": 0 if self._centroids is None else len(self._centroids),
+            "ivf_probes": self.n_probe,
+        }
+
+# Global instance (lazy initialization)
+_case_index = None
+_case_index_lock = threading.Lock()
+
+def get_case_index():
+    """Get or create the case index, or None when CASE_INDEX_DIR is empty"""
+    global _case_index
+    if _case_index is None and CASE_INDEX_DIR:
+        with _case_index_lock:
+            if _case_index is None:
+                _case_index = CaseIndex(CASE_INDEX_DIR)
+    return _case_index
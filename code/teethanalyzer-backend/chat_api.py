@@ -18,8 +18,18 @@ class Prompt(BaseModel):
     prompt: str
 
 @app.post("/chat-stream")
-async def chat_stream(prompt: Prompt):
-    return StreamingResponse(stream_response(prompt.prompt), media_type="text/plain")
+async def chat_stream(prompt: Prompt, request: Request):
+    async def event_generator():
+        stream = stream_response(prompt.prompt)
+        try:
+            async for chunk in stream:
+                if await request.is_disconnected():
+                    break
+                yield chunk
+        finally:
+            await stream.aclose()
+
+    return StreamingResponse(event_generator(), media_type="text/plain")
 
 import torch
 import torch.nn as nn
@@ -134,6 +144,84 @@ class AGFFBlock(nn.Module):
         
         return f_fused
 
+class FusedAGFFBlock(nn.Module):
+    """
+    Inference-only AGFF built from a trained AGFFBlock (same outputs).
+    
+    Works channels-last (NHWC) from start to end:
+    - LayerNorm affine, projection and the alpha/beta scales are folded into one
+      weight/bias per branch, and both projections write straight into their
+      half of a single preallocated output (no torch.cat, no scaled copies)
+    - f_spatial + f_channel = f_cal * (a_c + a_s) is applied as one in-place
+      multiply, building the gate one sample at a time
+    
+    The result is a channels_last [B, C, H, W] view. Inputs already in
+    torch.channels_last avoid the only remaining layout copy.
+    """
+    def __init__(self, block: AGFFBlock):
+        super().__init__()
+        self.in_channels = block.ln_conv.normalized_shape[0]
+        self.half_channels = self.in_channels // 2
+        self.eps_conv = block.ln_conv.eps
+        self.eps_swin = block.ln_swin.eps
+        
+        with torch.no_grad():
+            weight_conv, bias_conv = self._fold(block.ln_conv, block.proj_conv, block.alpha)
+            weight_swin, bias_swin = self._fold(block.ln_swin, block.proj_swin, block.beta)
+            
+            # Stored as (C, C/2) so addmm needs no transpose
+            self.register_buffer('weight_conv', weight_conv.t().contiguous())
+            self.register_buffer('bias_conv', bias_conv)
+            self.register_buffer('weight_swin', weight_swin.t().contiguous())
+            self.register_buffer('bias_swin', bias_swin)
+            
+            # 1x1 conv to one channel == per-pixel dot product over C
+            self.register_buffer('spatial_weight', block.spatial_att_conv.weight.reshape(-1).clone())
+            self.register_buffer('spatial_bias', block.spatial_att_conv.bias.clone())
+        
+        self.channel_att_mlp = block.channel_att_mlp
+    
+    @staticmethod
+    def _fold(ln: nn.LayerNorm, proj: nn.Linear, scale: torch.Tensor):
+        """scale * proj(ln(x)) == xhat @ weight.T + bias, with xhat the un-affined LayerNorm"""
+        weight = scale * proj.weight * ln.weight  # (C/2, C)
+        bias = scale * (proj.weight @ ln.bias + proj.bias)
+        return weight, bias
+    
+    @torch.no_grad()
+    def forward(self, f_conv: torch.Tensor, f_swin: torch.Tensor) -> torch.Tensor:
+        B, C, H, W = f_conv.shape
+        half = self.half_channels
+        
+        # --- Step 1: Spatial Alignment (keeps the input memory format) ---
+        f_aligned_swin = F.interpolate(f_swin, size=(H, W), mode='bilinear', align_corners=False)
+        
+        # NHWC rows; views when the inputs are channels_last
+        x_conv = f_conv.permute(0, 2, 3, 1).reshape(-1, C)
+        x_swin = f_aligned_swin.permute(0, 2, 3, 1).reshape(-1, C)
+        
+        # --- Step 2: Calibration, written in place into the halves of f_cal ---
+        f_cal = f_conv.new_empty(B * H * W, C)
+        torch.addmm(self.bias_conv, F.layer_norm(x_conv, (C,), eps=self.eps_conv),
+                    self.weight_conv, out=f_cal[:, :half])
+        torch.addmm(self.bias_swin, F.layer_norm(x_swin, (C,), eps=self.eps_swin),
+                    self.weight_swin, out=f_cal[:, half:])
+        
+        # --- Step 3: Dual Attention Gating ---
+        f_cal_b = f_cal.view(B, H * W, C)
+        a_c = self.channel_att_mlp(f_cal_b.mean(dim=1))  # (B, C)
+        a_s = torch.sigmoid(torch.addmv(self.spatial_bias, f_cal, self.spatial_weight))  # (B*H*W,)
+        a_s = a_s.view(B, H * W, 1)
+        
+        # --- Step 4: Fusion, f_cal * (a_c + a_s) in place ---
+        gate = f_cal.new_empty(H * W, C)
+        for b in range(B):
+            torch.add(a_c[b], a_s[b], out=gate)
+            f_cal_b[b].mul_(gate)
+        
+        # [B, H, W, C] storage seen as channels_last [B, C, H, W]
+        return f_cal.view(B, H, W, C).permute(0, 3, 1, 2)
+
 class CNNTranFusion(nn.Module):
     def __init__(self, num_classes=10, feature_dim=768):
         super().__init__()
@@ -150,6 +238,17 @@ class CNNTranFusion(nn.Module):
         self.final_norm = nn.LayerNorm(feature_dim)
         self.head = nn.Linear(feature_dim, num_classes)
         
+        # Set by optimize_for_inference(); backbone features are then produced channels_last
+        self.channels_last = False
+    
+    def optimize_for_inference(self):
+        """Swap in the fused channels-last AGFF path (eval only, same outputs)"""
+        self.eval()
+        if not isinstance(self.agff, FusedAGFFBlock):
+            self.agff = FusedAGFFBlock(self.agff)
+        self.channels_last = True
+        return self
+        
     def forward(self, x):
         """
         Input x: Raw image tensor
@@ -165,6 +264,17 @@ class CNNTranFusion(nn.Module):
         # Output shape: [B, 768, 16, 16] (Often smaller resolution than Conv branch)
         f_swin = self._mock_swin_features(x)
         
+        return self.forward_features(f_conv, f_swin)
+    
+    def forward_features(self, f_conv, f_swin):
+        """
+        Fusion + head only, from precomputed backbone outputs
+        (e.g. rows of the feature_store 'convnext' / 'swin' stores), so head
+        experiments skip the backbones entirely
+        """
+        f_conv = torch.as_tensor(f_conv, device=self.head.weight.device)
+        f_swin = torch.as_tensor(f_swin, device=self.head.weight.device)
+        
         # --- Fusion ---
         # 
         f_fused = self.agff(f_conv, f_swin) # Returns [B, 768, 32, 32]
@@ -180,18 +290,123 @@ class CNNTranFusion(nn.Module):
         return logits
 
     # Mock helper methods to make the code runnable without heavy external deps
+    def _mock_features(self, x, stride):
+        B, _, H, W = x.shape
+        if self.channels_last:
+            # Generated as NHWC and viewed as NCHW, i.e. torch.channels_last
+            return torch.randn(B, H//stride, W//stride, self.feature_dim, device=x.device).permute(0, 3, 1, 2)
+        return torch.randn(B, self.feature_dim, H//stride, W//stride, device=x.device)
+
     def _mock_convnext_features(self, x):
         # Simulates 768 channels, H/8 resolution
-        B, _, H, W = x.shape
-        return torch.randn(B, self.feature_dim, H//8, W//8, device=x.device)
+        return self._mock_features(x, 8)
 
     def _mock_swin_features(self, x):
         # Simulates 768 channels, H/16 resolution (needs alignment)
-        B, _, H, W = x.shape
-        return torch.randn(B, self.feature_dim, H//16, W//16, device=x.device)
+        return self._mock_features(x, 16)
+
+# --- Fused AGFF parity check and benchmark ---
+def check_agff_parity(batch_size=2, feature_dim=768, size=32, atol=1e-4):
+    """Compare FusedAGFFBlock against AGFFBlock on random weights and inputs"""
+    torch.manual_seed(0)
+    block = AGFFBlock(in_channels=feature_dim).eval()
+    # Non-trivial affine/scale parameters so the folding is actually exercised
+    with torch.no_grad():
+        for ln in (block.ln_conv, block.ln_swin):
+            ln.weight.uniform_(0.5, 1.5)
+            ln.bias.uniform_(-0.5, 0.5)
+        block.alpha.fill_(0.7)
+        block.beta.fill_(1.3)
+    fused = FusedAGFFBlock(block)
+    
+    f_conv = torch.randn(batch_size, feature_dim, size, size)
+    f_swin = torch.randn(batch_size, feature_dim, size // 2, size // 2)
+    with torch.no_grad():
+        expected = block(f_conv, f_swin)
+        actual = fused(f_conv, f_swin)
+        actual_cl = fused(f_conv.contiguous(memory_format=torch.channels_last),
+                          f_swin.contiguous(memory_format=torch.channels_last))
+    max_diff = max((expected - actual).abs().max().item(), (expected - actual_cl).abs().max().item())
+    return max_diff <= atol, max_diff
+
+def _peak_memory_worker(fused, batch_size, image_size, iters, device_name, queue):
+    """Runs in a fresh process so ru_maxrss reflects only this configuration"""
+    import resource
+    import time
+    
+    device = torch.device(device_name)
+    torch.manual_seed(0)
+    model = CNNTranFusion(num_classes=5).to(device).eval()
+    if fused:
+        model.optimize_for_inference()
+    x = torch.randn(batch_size, 3, image_size, image_size, device=device)
+    
+    # RSS high-water mark before any forward (CPU); the delta is the forward's peak
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    with torch.no_grad():
+        model(x)  # warmup
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            baseline = torch.cuda.memory_allocated()
+        
+        start = time.perf_counter()
+        for _ in range(iters):
+            model(x)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - start
+    
+    if device.type == 'cuda':
+        peak = torch.cuda.max_memory_allocated() - baseline
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - baseline
+    queue.put((batch_size * iters / elapsed, peak))
+
+def benchmark_agff(batch_sizes=(1, 4, 8, 16), image_size=256, iters=10):
+    """Throughput and peak memory of CNNTranFusion, reference vs fused AGFF"""
+    import multiprocessing as mp
+    
+    device_name = "cuda" if torch.cuda.is_available() else "cpu"
+    ctx = mp.get_context("spawn")
+    results = []
+    for batch_size in batch_sizes:
+        row = {"batch_size": batch_size}
+        for mode, fused in (("reference", False), ("fused", True)):
+            queue = ctx.Queue()
+            proc = ctx.Process(target=_peak_memory_worker,
+                               args=(fused, batch_size, image_size, iters, device_name, queue))
+            proc.start()
+            throughput, peak = queue.get()
+            proc.join()
+            row[f"{mode}_images_per_s"] = round(throughput, 2)
+            row[f"{mode}_peak_mb"] = round(peak / 2**20, 1)
+        results.append(row)
+    return results
 
 # --- Sanity Check / Experiment Execution Code ---
 if __name__ == "__main__":
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="CNNTranFusion sanity check")
+    parser.add_argument("--parity", action="store_true", help="check FusedAGFFBlock against AGFFBlock")
+    parser.add_argument("--benchmark", action="store_true", help="reference vs fused throughput/peak memory")
+    parser.add_argument("--batch-sizes", default="1,4,8,16")
+    args = parser.parse_args()
+    
+    if args.parity:
+        ok, max_diff = check_agff_parity()
+        print(f"Fused AGFF parity: {'OK' if ok else 'FAILED'} (max abs diff {max_diff:.2e})")
+        raise SystemExit(0 if ok else 1)
+    
+    if args.benchmark:
+        batch_sizes = [int(b) for b in args.batch_sizes.split(",")]
+        print("batch | reference img/s | fused img/s | reference peak MB | fused peak MB")
+        for row in benchmark_agff(batch_sizes):
+            print(f"{row['batch_size']:5d} | {row['reference_images_per_s']:15.2f} | {row['fused_images_per_s']:11.2f}"
+                  f" | {row['reference_peak_mb']:17.1f} | {row['fused_peak_mb']:13.1f}")
+        raise SystemExit(0)
+    
     # Check for CUDA backend as per environment details
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f"Running on: {device}")
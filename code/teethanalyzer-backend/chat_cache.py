@@ -0,0 +1,207 @@
+# chat_cache.py - Response cache for repeated chatbot questions
+import os
+import re
+import json
+import time
+import hashlib
+import asyncio
+import threading
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+CHAT_CACHE_ENABLED = os.getenv("CHAT_CACHE_ENABLED", "1") == "1"
+CHAT_CACHE_MAX_ENTRIES = int(os.getenv("CHAT_CACHE_MAX_ENTRIES", "512"))
+CHAT_CACHE_TTL_SECONDS = float(os.getenv("CHAT_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+# Optional persistent tier. Off by default (answers describe patient images): set a
+# directory to keep answers on disk across restarts
+CHAT_CACHE_DIR = os.getenv("CHAT_CACHE_DIR", "")
+CHAT_CACHE_DISK_MAX_ENTRIES = int(os.getenv("CHAT_CACHE_DISK_MAX_ENTRIES", "10000"))
+
+_WHITESPACE = re.compile(r"\s+")
+
+def normalize_prompt(prompt):
+    """Case-fold, collapse whitespace and drop trailing punctuation"""
+    prompt = _WHITESPACE.sub(" ", prompt.strip().lower())
+    return prompt.rstrip(" ?!.")
+
+def cache_key(prompt, image_digest=None, namespace=""):
+    """Key on the normalized prompt plus the attached image hash (if any)"""
+    raw = "\n".join([namespace, normalize_prompt(prompt), image_digest or ""])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+class ChatResponseCache:
+    """Two-tier (memory LRU + on-disk JSON) cache of streamed chat answers.
+
+    Entries keep the original chunk list so a hit replays the answer with the
+    same chunking as the upstream stream.
+    """
+
+    def __init__(self, max_entries=CHAT_CACHE_MAX_ENTRIES, ttl_seconds=CHAT_CACHE_TTL_SECONDS,
+                 cache_dir=CHAT_CACHE_DIR, disk_max_entries=CHAT_CACHE_DISK_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.cache_dir = cache_dir or None
+        self.disk_max_entries = disk_max_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._puts_since_prune = 0
+        self._stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "latency_saved_seconds": 0.0,
+        }
+
+    def _expired(self, entry):
+        return time.time() - entry["created"] > self.ttl_seconds
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _read_disk(self, key):
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_disk(self, key, entry):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)  # atomic, safe across workers
+
+    def _prune_disk(self):
+        """Drop expired files, then the oldest ones above disk_max_entries"""
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith(".json"):
+                    path = os.path.join(root, name)
+                    try:
+                        files.append((os.path.getmtime(path), path))
+                    except FileNotFoundError:
+                        continue
+        files.sort()
+        now = time.time()
+        excess = len(files) - self.disk_max_entries
+        for i, (mtime, path) in enumerate(files):
+            if i < excess or now - mtime > self.ttl_seconds:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def get(self, key):
+        """Return the cached entry or None (blocking; may touch disk)"""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if self._expired(entry):
+                    del self._memory[key]
+                else:
+                    self._memory.move_to_end(key)
+                    self._stats["memory_hits"] += 1
+                    return entry
+
+        if self.cache_dir:
+            entry = self._read_disk(key)
+            if entry is not None and not self._expired(entry):
+                with self._lock:
+                    self._remember(key, entry)
+                    self._stats["disk_hits"] += 1
+                return entry
+
+        with self._lock:
+            self._stats["misses"] += 1
+        return None
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def put(self, key, chunks, generation_seconds):
+        """Store a completed answer (blocking; may touch disk)"""
+        entry = {
+            "chunks": list(chunks),
+            "created": time.time(),
+            "generation_seconds": generation_seconds,
+        }
+        with self._lock:
+            self._remember(key, entry)
+            self._stats["stores"] += 1
+            self._puts_since_prune += 1
+            prune = self._puts_since_prune >= 100
+            if prune:
+                self._puts_since_prune = 0
+
+        if self.cache_dir:
+            try:
+                self._write_disk(key, entry)
+                if prune:
+                    self._prune_disk()
+            except OSError as e:
+                logger.warning(f"Chat cache disk write failed: {str(e)}")
+
+    def record_replay(self, entry, replay_seconds):
+        """Credit the upstream latency a hit avoided"""
+        with self._lock:
+            self._stats["latency_saved_seconds"] += max(0.0, entry["generation_seconds"] - replay_seconds)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_entries"] = len(self._memory)
+        hits = stats["memory_hits"] + stats["disk_hits"]
+        lookups = hits + stats["misses"]
+        stats["hits"] = hits
+        stats["hit_rate"] = hits / lookups if lookups else 0.0
+        stats["latency_saved_seconds"] = round(stats["latency_saved_seconds"], 4)
+        stats["enabled"] = CHAT_CACHE_ENABLED
+        stats["persistent"] = self.cache_dir is not None
+        return stats
+
+chat_cache = ChatResponseCache()
+
+async def cached_stream(key, generate):
+    """Replay a cached answer chunk by chunk, or stream `generate()` and store it.
+
+    Only answers that streamed to completion are stored; a cancelled or failed
+    stream leaves the cache untouched.
+    """
+    if not CHAT_CACHE_ENABLED:
+        stream = generate()
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
+        return
+
+    entry = await asyncio.to_thread(chat_cache.get, key)
+    if entry is not None:
+        replay_start = time.perf_counter()
+        for chunk in entry["chunks"]:
+            yield chunk
+            await asyncio.sleep(0)  # let the server flush each chunk like a live stream
+        chat_cache.record_replay(entry, time.perf_counter() - replay_start)
+        return
+
+    chunks = []
+    start = time.perf_counter()
+    stream = generate()
+    try:
+        async for chunk in stream:
+            chunks.append(chunk)
+            yield chunk
+    finally:
+        await stream.aclose()
+    if chunks:
+        await asyncio.to_thread(chat_cache.put, key, chunks, time.perf_counter() - start)
@@ -1,35 +1,158 @@
 import os
+import asyncio
 import base64
 from dotenv import load_dotenv
 from google import genai
 from google.genai import types
 from PIL import Image
 import io
+import logging
+from collections import OrderedDict
+
+from chat_cache import cache_key, cached_stream
+from image_store import content_hash, image_store
 
 load_dotenv()
 
-def stream_response(prompt: str, image_base64: str = None):
-    # Create the client instance
-    client = genai.Client(api_key=os.environ["GEMINI_API_KEY"])
-    
-    # Start with the text prompt
-    contents = [prompt]
-    
-    # Add image if provided
-    if image_base64:
-        # Decode the base64 image
-        image_data = base64.b64decode(image_base64.split(",")[1])
-        
-        # Convert to PIL Image (the new SDK handles PIL Images automatically)
-        image = Image.open(io.BytesIO(image_data))
-        contents.append(image)
-    
-    # Stream the response using the new SDK
-    for chunk in client.models.generate_content_stream(
-        model='gemini-2.0-flash',
+logger = logging.getLogger(__name__)
+
+GEMINI_MODEL = 'gemini-2.0-flash'
+
+# "gemini" streams from the Gemini API, "fake" streams canned text locally so the
+# chat path can be load-tested offline without an API key.
+CHAT_BACKEND = os.getenv("CHAT_BACKEND", "gemini")
+# Max concurrent streams per upstream backend; extra callers wait their turn
+CHAT_MAX_CONCURRENCY = int(os.getenv("CHAT_MAX_CONCURRENCY", "8"))
+# Images are downscaled so the longest side is at most this many pixels and
+# re-encoded as JPEG before they are sent upstream
+CHAT_IMAGE_MAX_SIDE = int(os.getenv("CHAT_IMAGE_MAX_SIDE", "1024"))
+CHAT_IMAGE_JPEG_QUALITY = int(os.getenv("CHAT_IMAGE_JPEG_QUALITY", "85"))
+# Delay between fake chunks (seconds), roughly a real token stream
+FAKE_LLM_CHUNK_DELAY = float(os.getenv("FAKE_LLM_CHUNK_DELAY", "0.05"))
+
+FAKE_LLM_RESPONSE = (
+    "This is a simulated response from the offline chat backend. "
+    "Brush twice a day with fluoride toothpaste, floss daily, "
+    "and visit your dentist every six months for a check-up."
+)
+
+# Downscaled JPEGs by content hash, so follow-up questions about the same photo
+# skip the decode/resize/encode
+PREPARED_IMAGE_CACHE_SIZE = 32
+_prepared_images = OrderedDict()
+
+# One client per process so the underlying HTTP connection pool is reused
+_client = None
+_upstream_semaphores = {}
+
+def get_client():
+    """Get or create the shared Gemini client"""
+    global _client
+    if _client is None:
+        _client = genai.Client(api_key=os.environ["GEMINI_API_KEY"])
+    return _client
+
+def _upstream_semaphore(backend):
+    """Concurrency limiter for one upstream backend"""
+    if backend not in _upstream_semaphores:
+        _upstream_semaphores[backend] = asyncio.Semaphore(CHAT_MAX_CONCURRENCY)
+    return _upstream_semaphores[backend]
+
+def decode_image_data_url(image_base64):
+    """Decode a base64 data URL (or bare base64 string) into raw bytes"""
+    return base64.b64decode(image_base64.split(",")[-1])
+
+def prepare_chat_image(image_bytes):
+    """Downscale to CHAT_IMAGE_MAX_SIDE and re-encode as JPEG for upstream"""
+    image = Image.open(io.BytesIO(image_bytes))
+    image.draft('RGB', (CHAT_IMAGE_MAX_SIDE, CHAT_IMAGE_MAX_SIDE))  # cheap JPEG DCT downscale
+    image = image.convert('RGB')
+    image.thumbnail((CHAT_IMAGE_MAX_SIDE, CHAT_IMAGE_MAX_SIDE), Image.LANCZOS)
+
+    buf = io.BytesIO()
+    image.save(buf, format='JPEG', quality=CHAT_IMAGE_JPEG_QUALITY, optimize=True)
+    return buf.getvalue()
+
+def _prepared_chat_image(image_digest, image_bytes):
+    """prepare_chat_image, memoized by content hash"""
+    jpeg_bytes = _prepared_images.get(image_digest)
+    if jpeg_bytes is None:
+        jpeg_bytes = prepare_chat_image(image_bytes)
+        _prepared_images[image_digest] = jpeg_bytes
+        while len(_prepared_images) > PREPARED_IMAGE_CACHE_SIZE:
+            _prepared_images.popitem(last=False)
+    return jpeg_bytes
+
+async def _stream_fake(contents):
+    """Offline backend: stream a canned answer word by word"""
+    words = FAKE_LLM_RESPONSE.split(" ")
+    for i, word in enumerate(words):
+        await asyncio.sleep(FAKE_LLM_CHUNK_DELAY)
+        yield word if i == len(words) - 1 else word + " "
+
+async def _stream_gemini(contents):
+    """Stream from the Gemini API on the event loop (no threadpool slot held)"""
+    client = get_client()
+    response = await client.aio.models.generate_content_stream(
+        model=GEMINI_MODEL,
         contents=contents,
         config=types.GenerateContentConfig(
             response_mime_type="text/plain"
         )
-    ):
-        yield chunk.text
+    )
+    try:
+        async for chunk in response:
+            if chunk.text:
+                yield chunk.text
+    finally:
+        # Closing the upstream iterator releases the HTTP connection when the
+        # caller stops early (e.g. the browser disconnected)
+        await response.aclose()
+
+_BACKENDS = {
+    "gemini": _stream_gemini,
+    "fake": _stream_fake,
+}
+
+async def _stream_upstream(contents):
+    """Stream from the configured backend, holding one of its concurrency slots"""
+    async with _upstream_semaphore(CHAT_BACKEND):
+        stream = _BACKENDS[CHAT_BACKEND](contents)
+        try:
+            async for text in stream:
+                yield text
+        finally:
+            await stream.aclose()
+
+async def stream_response(prompt: str, image_base64: str = None, image_bytes: bytes = None):
+    """Stream a chat answer.
+
+    The image can be a base64 data URL (``image_base64``) or raw bytes already
+    resolved from an image reference (``image_bytes``).
+    """
+    if CHAT_BACKEND not in _BACKENDS:
+        raise ValueError(f"Unknown CHAT_BACKEND '{CHAT_BACKEND}' (expected one of {list(_BACKENDS)})")
+
+    # Start with the text prompt
+    contents = [prompt]
+    image_digest = None
+
+    if image_base64 and image_bytes is None:
+        image_bytes = await asyncio.to_thread(decode_image_data_url, image_base64)
+        # Keep it so follow-up questions can send the hash instead of the image
+        await asyncio.to_thread(image_store.put, image_bytes)
+
+    # Add image if provided (downscaled off the event loop)
+    if image_bytes:
+        image_digest = content_hash(image_bytes)
+        jpeg_bytes = await asyncio.to_thread(_prepared_chat_image, image_digest, image_bytes)
+        contents.append(types.Part.from_bytes(data=jpeg_bytes, mime_type='image/jpeg'))
+
+    # Repeated questions are answered from the cache with the same chunking
+    key = cache_key(prompt, image_digest, namespace=f"{CHAT_BACKEND}:{GEMINI_MODEL}")
+    stream = cached_stream(key, lambda: _stream_upstream(contents))
+    try:
+        async for text in stream:
+            yield text
+    finally:
+        await stream.aclose()
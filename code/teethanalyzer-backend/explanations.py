@@ -0,0 +1,521 @@
+# explanations.py - LIME explanation artifacts, statistics and on-demand rendering
+import os
+import io
+import json
+import shutil
+import math
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Artifacts are kept at most this many pixels on the long side; figure panels are
+# ~750px wide, so rendering from the full-resolution photo only costs time
+RENDER_MAX_SIDE = int(os.getenv("EXPLANATION_RENDER_MAX_SIDE", "1024"))
+EXPLANATION_REGISTRY_SIZE = int(os.getenv("EXPLANATION_REGISTRY_SIZE", "64"))
+RENDER_CACHE_MAX_BYTES = int(os.getenv("EXPLANATION_RENDER_CACHE_MB", "64")) * 1024 * 1024
+# Shared on-disk tier (all workers, survives restarts); empty keeps explanations in memory only
+EXPLANATION_STORE_DIR = os.getenv("EXPLANATION_STORE_DIR", "cache/explanations")
+EXPLANATION_STORE_DISK_MAX_BYTES = int(os.getenv("EXPLANATION_STORE_DISK_MAX_MB", "1024")) * 1024 * 1024
+
+# The 8 panels of the full explanation figure, in grid order
+PANELS = ('original', 'segments', 'complete', 'positive', 'negative', 'heatmap', 'top_regions', 'summary')
+IMAGE_FORMATS = {'png': 'image/png', 'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+MIN_DPI, MAX_DPI = 20, 300
+
+def load_matplotlib():
+    """Import matplotlib lazily (object API only: pyplot is not thread-safe)"""
+    import matplotlib
+    matplotlib.use('Agg')  # Non-interactive backend for server
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    return Figure, FigureCanvasAgg, matplotlib.colormaps
+
+def explanation_id(image_hash, model_version, **params):
+    """Stable ID of one explanation: image content hash + model version + explainer parameters"""
+    raw = f"{image_hash}|{model_version}|" + "|".join(f"{k}={params[k]}" for k in sorted(params))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+class ExplanationArtifacts:
+    """Everything needed to re-render or summarize an explanation without LIME.
+
+    image/segments are downscaled to RENDER_MAX_SIDE; local_exp maps class
+    index -> [(segment_id, weight), ...] sorted by |weight| as in lime.
+    """
+
+    def __init__(self, image_array, segments, local_exp, predicted_class, class_names, num_segments=None,
+                 result=None):
+        self.image = image_array
+        self.segments = segments
+        self.local_exp = local_exp
+        self.predicted_class = int(predicted_class)
+        self.class_names = list(class_names)
+        self.num_segments = num_segments if num_segments is not None else len(np.unique(segments))
+        # JSON response of the explanation (prediction, statistics, ...) for reuse
+        self.result = result
+
+    def nbytes(self):
+        return self.image.nbytes + self.segments.nbytes
+
+    def save(self, directory):
+        """Write arrays.npz + meta.json into directory (caller handles atomicity)"""
+        np.savez(os.path.join(directory, "arrays.npz"), image=self.image, segments=self.segments)
+        meta = {
+            "local_exp": {str(c): exp for c, exp in self.local_exp.items()},
+            "predicted_class": self.predicted_class,
+            "class_names": self.class_names,
+            "num_segments": self.num_segments,
+            "result": self.result,
+        }
+        with open(os.path.join(directory, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, directory):
+        with open(os.path.join(directory, "meta.json"), "r") as f:
+            meta = json.load(f)
+        with np.load(os.path.join(directory, "arrays.npz")) as arrays:
+            image, segments = arrays["image"], arrays["segments"]
+        local_exp = {int(c): [(int(seg), float(w)) for seg, w in exp] for c, exp in meta["local_exp"].items()}
+        return cls(image, segments, local_exp, meta["predicted_class"], meta["class_names"],
+                   meta["num_segments"], meta.get("result"))
+
+    @classmethod
+    def from_full_resolution(cls, image_array, segments, local_exp, predicted_class, class_names):
+        h, w = segments.shape
+        num_segments = len(np.unique(segments))
+        scale = RENDER_MAX_SIDE / max(h, w)
+        if scale < 1:
+            new_w, new_h = max(1, round(w * scale)), max(1, round(h * scale))
+            image_array = np.asarray(Image.fromarray(image_array).resize((new_w, new_h), Image.LANCZOS))
+            rows = (np.arange(new_h) * h // new_h)
+            cols = (np.arange(new_w) * w // new_w)
+            segments = segments[rows[:, None], cols[None, :]]
+        local_exp = {int(c): [(int(s), float(wt)) for s, wt in exp] for c, exp in local_exp.items()}
+        return cls(np.ascontiguousarray(image_array), segments.astype(np.uint16),
+                   local_exp, predicted_class, class_names, num_segments)
+
+    def image_and_mask(self, label, **kwargs):
+        return image_and_mask(self.image, self.segments, self.local_exp, label, **kwargs)
+
+    def class_index(self, class_name):
+        """Index of a class that has fitted weights, or None"""
+        for index in self.local_exp:
+            if str(self.class_names[index]) == class_name:
+                return index
+        return None
+
+    def class_summaries(self, top_regions=5):
+        """Per-class statistics and strongest regions (None: all) for every class fitted in the run"""
+        summaries = {}
+        for index in sorted(self.local_exp):
+            exp = self.local_exp[index]
+            summaries[str(self.class_names[index])] = {
+                'class_index': index,
+                'is_prediction': index == self.predicted_class,
+                'top_regions': [{'segment': s, 'weight': w} for s, w in exp[:top_regions]],
+                **explanation_statistics(exp),
+            }
+        return summaries
+
+def image_and_mask(image, segments, local_exp, label, positive_only=True, negative_only=False,
+                   hide_rest=False, num_features=5, min_weight=0.):
+    """Same contract as lime's ImageExplanation.get_image_and_mask"""
+    if label not in local_exp:
+        raise KeyError('Label not in explanation')
+    if positive_only & negative_only:
+        raise ValueError("Positive_only and negative_only cannot be true at the same time.")
+    exp = local_exp[label]
+    mask = np.zeros(segments.shape, np.int32)
+    if hide_rest:
+        temp = np.zeros(image.shape)
+    else:
+        temp = image.copy()
+    if positive_only or negative_only:
+        if positive_only:
+            fs = [x[0] for x in exp if x[1] > 0 and x[1] > min_weight][:num_features]
+        else:
+            fs = [x[0] for x in exp if x[1] < 0 and abs(x[1]) > min_weight][:num_features]
+        for f in fs:
+            temp[segments == f] = image[segments == f].copy()
+            mask[segments == f] = 1
+        return temp, mask
+    for f, w in exp[:num_features]:
+        if np.abs(w) < min_weight:
+            continue
+        c = 0 if w < 0 else 1
+        mask[segments == f] = -1 if w < 0 else 1
+        temp[segments == f] = image[segments == f].copy()
+        temp[segments == f, c] = np.max(image)
+    return temp, mask
+
+# ==================== STATISTICS ====================
+
+def explanation_statistics(local_exp):
+    """Evidence totals and clinical interpretation for one class's superpixel weights"""
+    positive_sum = sum(imp for _, imp in local_exp if imp > 0)
+    negative_sum = sum(imp for _, imp in local_exp if imp < 0)
+    net_evidence = positive_sum + negative_sum
+
+    # Generate clinical interpretation
+    clinical_interpretation = []
+    if positive_sum > abs(negative_sum):
+        clinical_interpretation.append("The model found more supporting evidence than contradicting evidence")
+        clinical_interpretation.append("Key pathological regions were identified and weighted appropriately")
+    else:
+        clinical_interpretation.append("The model found mixed or contradictory evidence")
+        clinical_interpretation.append("Consider reviewing the diagnosis or obtaining additional images")
+
+    return {
+        'total_positive_evidence': float(positive_sum),
+        'total_negative_evidence': float(negative_sum),
+        'net_evidence': float(net_evidence),
+        'clinical_interpretation': clinical_interpretation
+    }
+
+# ==================== RENDERING ====================
+
+def _create_importance_heatmap(artifacts, class_index):
+    """Create importance heatmap from LIME explanation"""
+    segments = artifacts.segments
+    importance_map = np.zeros(segments.shape, dtype=float)
+
+    # Get local explanation
+    local_exp = artifacts.local_exp[class_index]
+
+    for segment_id, importance in local_exp:
+        importance_map[segments == segment_id] = importance
+
+    return importance_map
+
+def _plot_top_regions(ax, artifacts, class_index, colormaps):
+    """Plot top contributing regions with their importance scores"""
+    local_exp = artifacts.local_exp[class_index]
+    top_regions = sorted(local_exp, key=lambda x: abs(x[1]), reverse=True)[:5]
+
+    # Create image showing only top regions
+    segments = artifacts.segments
+    top_regions_mask = np.zeros(segments.shape, dtype=int)
+
+    for i, (segment_id, importance) in enumerate(top_regions):
+        top_regions_mask[segments == segment_id] = i + 1
+
+    # Show regions with different colors
+    masked_image = artifacts.image.copy()
+    colored_mask = colormaps['Set1'](top_regions_mask / 5.0)
+
+    # Blend original image with colored mask
+    for i in range(3):
+        masked_image[:, :, i] = np.where(
+            top_regions_mask > 0,
+            0.6 * masked_image[:, :, i] + 0.4 * 255 * colored_mask[:, :, i],
+            masked_image[:, :, i]
+        )
+
+    ax.imshow(masked_image.astype(np.uint8))
+    ax.set_title('Top 5 Contributing Regions', fontsize=12, fontweight='bold')
+    ax.axis('off')
+
+    # Add legend
+    legend_text = []
+    for i, (segment_id, importance) in enumerate(top_regions):
+        sign = "+" if importance > 0 else ""
+        legend_text.append(f"Region {i+1}: {sign}{importance:.3f}")
+
+    ax.text(1.02, 1, '\n'.join(legend_text), transform=ax.transAxes,
+           verticalalignment='top', fontsize=9,
+           bbox=dict(boxstyle="round,pad=0.3", facecolor="white", alpha=0.8))
+
+def _plot_quantitative_analysis(ax, artifacts, class_index, disease_name):
+    """Plot quantitative analysis of LIME explanation"""
+    local_exp = artifacts.local_exp[class_index]
+
+    # Separate positive and negative contributions
+    positive_contrib = [imp for _, imp in local_exp if imp > 0]
+    negative_contrib = [imp for _, imp in local_exp if imp < 0]
+
+    # Create summary statistics
+    stats_text = "Quantitative Analysis\n" + "="*25 + "\n"
+    stats_text += f"Disease: {disease_name}\n\n"
+    stats_text += f"Total Regions: {len(local_exp)}\n"
+    stats_text += f"Supporting: {len(positive_contrib)}\n"
+    stats_text += f"Against: {len(negative_contrib)}\n\n"
+
+    if positive_contrib:
+        stats_text += "Positive Evidence:\n"
+        stats_text += f"• Mean: {np.mean(positive_contrib):.4f}\n"
+        stats_text += f"• Max: {np.max(positive_contrib):.4f}\n"
+        stats_text += f"• Sum: {np.sum(positive_contrib):.4f}\n\n"
+
+    if negative_contrib:
+        stats_text += "Negative Evidence:\n"
+        stats_text += f"• Mean: {np.abs(np.mean(negative_contrib)):.4f}\n"
+        stats_text += f"• Min: {np.abs(np.min(negative_contrib)):.4f}\n"
+        stats_text += f"• Sum: {np.abs(np.sum(negative_contrib)):.4f}\n\n"
+
+    # Overall assessment
+    net_support = np.sum(positive_contrib) - np.abs(np.sum(negative_contrib))
+    stats_text += f"Net Support: {net_support:.4f}\n"
+
+    if net_support > 0.1:
+        assessment = "Strong Support"
+    elif net_support > 0.05:
+        assessment = "Moderate Support"
+    elif net_support > -0.05:
+        assessment = "Weak/Mixed Evidence"
+    else:
+        assessment = "Contradictory Evidence"
+
+    stats_text += f"Assessment: {assessment}"
+
+    ax.text(0.05, 0.95, stats_text, transform=ax.transAxes,
+           verticalalignment='top', fontsize=10, fontfamily='monospace',
+           bbox=dict(boxstyle="round,pad=0.5", facecolor="lightgray", alpha=0.8))
+    ax.set_title('Statistical Summary', fontsize=12, fontweight='bold')
+    ax.axis('off')
+
+def _draw_panel(fig, ax, panel, artifacts, class_index, disease_name, colormaps):
+    from skimage.segmentation import mark_boundaries
+
+    image_array = artifacts.image
+    if panel == 'original':
+        ax.imshow(image_array)
+        ax.set_title('Original Image', fontsize=12, fontweight='bold')
+    elif panel == 'segments':
+        ax.imshow(mark_boundaries(image_array/255.0, artifacts.segments))
+        ax.set_title(f'Superpixel Segmentation\n({artifacts.num_segments} segments)',
+                     fontsize=12, fontweight='bold')
+    elif panel == 'complete':
+        temp, mask = artifacts.image_and_mask(class_index, positive_only=False, num_features=10, hide_rest=False)
+        ax.imshow(mark_boundaries(temp/255.0, mask))
+        ax.set_title('Complete Explanation\n(Green=Support, Red=Against)',
+                     fontsize=12, fontweight='bold')
+    elif panel == 'positive':
+        temp, mask = artifacts.image_and_mask(class_index, positive_only=True, num_features=5, hide_rest=False)
+        ax.imshow(mark_boundaries(temp/255.0, mask))
+        ax.set_title('Positive Evidence\n(Supports Diagnosis)',
+                     fontsize=12, fontweight='bold')
+    elif panel == 'negative':
+        temp, mask = artifacts.image_and_mask(class_index, positive_only=False, negative_only=True,
+                                              num_features=5, hide_rest=False)
+        ax.imshow(mark_boundaries(temp/255.0, mask))
+        ax.set_title('Negative Evidence\n(Against Diagnosis)',
+                     fontsize=12, fontweight='bold')
+    elif panel == 'heatmap':
+        importance_map = _create_importance_heatmap(artifacts, class_index)
+        im = ax.imshow(importance_map, cmap='RdYlBu_r', alpha=0.8)
+        ax.imshow(image_array, alpha=0.5)
+        ax.set_title('Importance Heatmap\n(Warmer = More Important)',
+                     fontsize=12, fontweight='bold')
+        fig.colorbar(im, ax=ax, fraction=0.046)
+    elif panel == 'top_regions':
+        _plot_top_regions(ax, artifacts, class_index, colormaps)
+    elif panel == 'summary':
+        _plot_quantitative_analysis(ax, artifacts, class_index, disease_name)
+    ax.axis('off')
+
+def render_explanation(artifacts, panels=None, fmt='png', dpi=150, max_pixels=None, class_index=None):
+    """Render the explanation figure (or a subset of its panels) to encoded image bytes"""
+    Figure, FigureCanvasAgg, colormaps = load_matplotlib()
+    panels = list(panels or PANELS)
+    class_index = artifacts.predicted_class if class_index is None else class_index
+    disease_name = artifacts.class_names[class_index]
+
+    # Same 5x6 inch panels as the original 2x4 figure (20x12 inches)
+    cols = min(4, len(panels))
+    rows = math.ceil(len(panels) / cols)
+    width_in, height_in = 5 * cols, 6 * rows
+    if max_pixels:
+        dpi = min(dpi, math.sqrt(max_pixels / (width_in * height_in)))
+    dpi = max(MIN_DPI, min(MAX_DPI, dpi))
+
+    fig = Figure(figsize=(width_in, height_in), dpi=dpi)
+    FigureCanvasAgg(fig)
+    axes = fig.subplots(rows, cols, squeeze=False)
+    fig.suptitle(f'LIME Explanation for {disease_name}', fontsize=16, fontweight='bold')
+    for i, ax in enumerate(axes.flat):
+        if i < len(panels):
+            _draw_panel(fig, ax, panels[i], artifacts, class_index, disease_name, colormaps)
+        else:
+            ax.axis('off')
+    fig.tight_layout()
+
+    buf = io.BytesIO()
+    pil_kwargs = None if fmt == 'png' else {'quality': 85}
+    fig.savefig(buf, format=fmt, bbox_inches='tight', dpi=dpi, pil_kwargs=pil_kwargs)
+    return buf.getvalue()
+
+# ==================== REGISTRY ====================
+
+class ExplanationRegistry:
+    """Content-addressed store of explanation artifacts and their rendered images.
+
+    Memory tier: LRU of artifacts plus a byte-bounded cache of renders. Disk tier
+    (EXPLANATION_STORE_DIR, shared by uvicorn workers and kept across restarts):
+    ``<id[:2]>/<id>/`` holding arrays.npz, meta.json and ``renders/``. Entries are
+    built in a temp directory and renamed into place, so concurrent writers of the
+    same ID never expose a partial entry; the first rename wins.
+    """
+
+    def __init__(self, max_explanations=EXPLANATION_REGISTRY_SIZE, render_cache_bytes=RENDER_CACHE_MAX_BYTES,
+                 store_dir=EXPLANATION_STORE_DIR, disk_max_bytes=EXPLANATION_STORE_DISK_MAX_BYTES):
+        self.max_explanations = max_explanations
+        self.render_cache_bytes = render_cache_bytes
+        self.store_dir = store_dir or None
+        self.disk_max_bytes = disk_max_bytes
+        self._artifacts = OrderedDict()
+        self._renders = OrderedDict()
+        self._render_bytes = 0
+        self._lock = threading.Lock()
+        self._puts_since_prune = 0
+        self._stats = {"hits": 0, "disk_hits": 0, "misses": 0}
+
+    def _path(self, key):
+        return os.path.join(self.store_dir, key[:2], key)
+
+    @staticmethod
+    def _valid_key(key):
+        return len(key) == 32 and all(c in "0123456789abcdef" for c in key)
+
+    def _remember(self, key, artifacts):
+        self._artifacts[key] = artifacts
+        self._artifacts.move_to_end(key)
+        while len(self._artifacts) > self.max_explanations:
+            self._artifacts.popitem(last=False)
+
+    def put(self, key, artifacts):
+        with self._lock:
+            self._remember(key, artifacts)
+            self._puts_since_prune += 1
+            prune = self._puts_since_prune >= 20
+            if prune:
+                self._puts_since_prune = 0
+
+        if self.store_dir:
+            try:
+                path = self._path(key)
+                if not os.path.exists(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                    os.makedirs(os.path.join(tmp_path, "renders"), exist_ok=True)
+                    artifacts.save(tmp_path)
+                    try:
+                        os.rename(tmp_path, path)
+                    except OSError:
+                        # Another worker stored the same explanation first
+                        shutil.rmtree(tmp_path, ignore_errors=True)
+                if prune:
+                    self._prune_disk()
+            except OSError as e:
+                logger.warning(f"Explanation store disk write failed: {str(e)}")
+
+    def get(self, key):
+        """Artifacts for an explanation ID (memory, then disk), or None"""
+        with self._lock:
+            artifacts = self._artifacts.get(key)
+            if artifacts is not None:
+                self._artifacts.move_to_end(key)
+                self._stats["hits"] += 1
+                return artifacts
+
+        if self.store_dir and self._valid_key(key):
+            path = self._path(key)
+            try:
+                artifacts = ExplanationArtifacts.load(path)
+                os.utime(os.path.join(path, "meta.json"))  # recency for eviction
+            except (FileNotFoundError, NotADirectoryError):
+                artifacts = None
+            except Exception as e:
+                logger.warning(f"Unreadable explanation entry {key}: {str(e)}")
+                artifacts = None
+            if artifacts is not None:
+                with self._lock:
+                    self._remember(key, artifacts)
+                    self._stats["disk_hits"] += 1
+                return artifacts
+
+        with self._lock:
+            self._stats["misses"] += 1
+        return None
+
+    def render(self, key, panels=None, fmt='png', dpi=150, max_pixels=None, class_index=None):
+        """Rendered bytes for a stored explanation (cached in memory and on disk), or None"""
+        render_key = (key, tuple(panels or PANELS), fmt, dpi, max_pixels, class_index)
+        with self._lock:
+            data = self._renders.get(render_key)
+            if data is not None:
+                self._renders.move_to_end(render_key)
+                return data
+
+        render_path = None
+        if self.store_dir and self._valid_key(key):
+            variant = hashlib.sha256(repr(render_key[1:]).encode("utf-8")).hexdigest()[:16]
+            render_path = os.path.join(self._path(key), "renders", f"{variant}.{fmt}")
+            try:
+                with open(render_path, "rb") as f:
+                    data = f.read()
+            except (FileNotFoundError, NotADirectoryError):
+                data = None
+
+        if data is None:
+            artifacts = self.get(key)
+            if artifacts is None:
+                return None
+            data = render_explanation(artifacts, panels, fmt, dpi, max_pixels, class_index)
+            if render_path is not None and os.path.isdir(os.path.dirname(render_path)):
+                try:
+                    tmp_path = f"{render_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                    with open(tmp_path, "wb") as f:
+                        f.write(data)
+                    os.replace(tmp_path, render_path)
+                except OSError as e:
+                    logger.warning(f"Explanation render write failed: {str(e)}")
+
+        with self._lock:
+            if render_key not in self._renders:
+                self._renders[render_key] = data
+                self._render_bytes += len(data)
+            while self._render_bytes > self.render_cache_bytes and len(self._renders) > 1:
+                _, evicted = self._renders.popitem(last=False)
+                self._render_bytes -= len(evicted)
+        return data
+
+    def _prune_disk(self):
+        """Delete the least recently used entries above disk_max_bytes"""
+        entries = []
+        for prefix in os.listdir(self.store_dir):
+            prefix_dir = os.path.join(self.store_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(prefix_dir, name)
+                size = 0
+                try:
+                    last_used = os.stat(os.path.join(path, "meta.json")).st_mtime
+                    for root, _, files in os.walk(path):
+                        size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+                except FileNotFoundError:
+                    continue
+                entries.append((last_used, size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.disk_max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_entries"] = len(self._artifacts)
+            stats["render_cache_bytes"] = self._render_bytes
+        stats["store_dir"] = self.store_dir
+        return stats
+
+explanation_registry = ExplanationRegistry()
@@ -0,0 +1,352 @@
+# feature_store.py - Memory-mapped cache of backbone features per image hash
+import os
+import json
+import fcntl
+import argparse
+import logging
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Root directory for the server-side store; empty disables it
+FEATURE_STORE_DIR = os.getenv("FEATURE_STORE_DIR", "")
+# "1" stores new offline stores as float16 (half the disk, rounded features); serving always uses float32
+FEATURE_STORE_FP16 = os.getenv("FEATURE_STORE_FP16", "0") == "1"
+
+# Store names used across the backend
+HYBRID_FEATURES = "hybrid"      # EfficientNetV2 1024-dim features fed to LightGBM
+CONVNEXT_FEATURES = "convnext"  # CNNTranFusion local branch [768, 32, 32]
+SWIN_FEATURES = "swin"          # CNNTranFusion global branch [768, 16, 16]
+
+class FeatureStore:
+    """Append-only store of fixed-shape feature arrays keyed by image content hash.
+
+    Layout of ``root/name/`` (``root/name/version/`` when a model version is
+    given, so features of a retrained or swapped backbone are never mixed):
+    - ``features.bin``: raw rows, memory-mapped as (capacity, *shape)
+    - ``manifest.json``: shape, dtype, row count and {hash: row}, plus optional
+      per-image metadata (e.g. the label of a training image)
+    - ``manifest.log``: JSON lines appended per insert since the last manifest
+      snapshot, so an insert costs O(1) instead of rewriting the manifest
+
+    Reads go straight to the memmap, so training the fusion head or re-scoring
+    LightGBM runs at disk speed. Writers across processes are serialized with an
+    flock on ``lock``.
+    """
+
+    GROWTH_ROWS = 256
+    COMPACT_MIN_RECORDS = 1024
+
+    def __init__(self, root, name, shape, fp16=FEATURE_STORE_FP16, version=None):
+        self.dir = os.path.join(root, name) if version is None else os.path.join(root, name, version)
+        self.name = name
+        self.version = version
+        os.makedirs(self.dir, exist_ok=True)
+        self._manifest_path = os.path.join(self.dir, "manifest.json")
+        self._log_path = os.path.join(self.dir, "manifest.log")
+        self._data_path = os.path.join(self.dir, "features.bin")
+        self._lock_path = os.path.join(self.dir, "lock")
+        self._thread_lock = threading.RLock()
+        self._memmap = None
+        self._manifest_mtime = None
+        self._log_offset = 0
+        self._log_entries = 0
+
+        if os.path.exists(self._manifest_path):
+            self._load_manifest()
+            if list(self.shape) != list(shape):
+                raise ValueError(f"Feature store '{name}' holds shape {self.shape}, not {tuple(shape)}")
+        else:
+            self.shape = tuple(shape)
+            self.dtype = np.dtype(np.float16 if fp16 else np.float32)
+            self.count = 0
+            self.capacity = 0
+            self.index = {}
+            self.meta = {}
+
+    # ---------- manifest / memmap ----------
+
+    def _load_manifest(self):
+        with open(self._manifest_path, "r") as f:
+            manifest = json.load(f)
+        self.shape = tuple(manifest["shape"])
+        self.dtype = np.dtype(manifest["dtype"])
+        self.count = manifest["count"]
+        self.capacity = manifest["capacity"]
+        self.index = manifest["index"]
+        self.meta = manifest.get("meta", {})
+        self._manifest_mtime = os.path.getmtime(self._manifest_path)
+        self._log_offset = 0
+        self._log_entries = 0
+        self._memmap = None
+        self._read_log()
+
+    def _read_log(self):
+        """Apply complete log records written since the last read"""
+        try:
+            with open(self._log_path, "rb") as f:
+                f.seek(self._log_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        end = data.rfind(b"\n") + 1  # a concurrent append may still be mid-line
+        for line in data[:end].splitlines():
+            record = json.loads(line)
+            if "capacity" in record:
+                if record["capacity"] > self.capacity:
+                    self.capacity = record["capacity"]
+                    self._memmap = None
+                continue
+            self.index[record["digest"]] = record["row"]
+            self.count = max(self.count, record["row"] + 1)
+            if record.get("meta"):
+                self.meta[record["digest"]] = record["meta"]
+            self._log_entries += 1
+        self._log_offset += end
+
+    def _append_log(self, records):
+        with open(self._log_path, "ab") as f:
+            f.write(b"".join(json.dumps(r).encode("utf-8") + b"\n" for r in records))
+        self._log_offset = os.path.getsize(self._log_path)
+
+    def _write_manifest(self):
+        """Snapshot the full manifest and empty the log (amortized: see put_many)"""
+        manifest = {
+            "name": self.name,
+            "shape": list(self.shape),
+            "dtype": self.dtype.name,
+            "count": self.count,
+            "capacity": self.capacity,
+            "index": self.index,
+            "meta": self.meta,
+        }
+        tmp_path = f"{self._manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self._manifest_path)
+        # Readers that see the new manifest re-read the whole log; replaying
+        # records already in the snapshot is harmless
+        with open(self._log_path, "wb"):
+            pass
+        self._manifest_mtime = os.path.getmtime(self._manifest_path)
+        self._log_offset = 0
+        self._log_entries = 0
+
+    def refresh(self):
+        """Pick up rows appended by other processes; True when anything changed"""
+        with self._thread_lock:
+            return self._refresh()
+
+    def _refresh(self):
+        if not os.path.exists(self._manifest_path):
+            return False
+        if os.path.getmtime(self._manifest_path) != self._manifest_mtime:
+            self._load_manifest()
+            return True
+        try:
+            log_size = os.path.getsize(self._log_path)
+        except FileNotFoundError:
+            return False
+        if log_size < self._log_offset:  # compacted between the two checks
+            self._load_manifest()
+            return True
+        if log_size > self._log_offset:
+            count = self.count
+            self._read_log()
+            return self.count != count
+        return False
+
+    def _rows(self, mode="r"):
+        if self._memmap is None or (mode == "r+" and self._memmap.mode != "r+"):
+            if self.capacity == 0:
+                return np.empty((0,) + self.shape, dtype=self.dtype)
+            self._memmap = np.memmap(self._data_path, dtype=self.dtype, mode=mode,
+                                     shape=(self.capacity,) + self.shape)
+        return self._memmap
+
+    def _grow(self, needed_rows):
+        new_capacity = max(self.capacity * 2, self.capacity + self.GROWTH_ROWS, needed_rows)
+        row_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        with open(self._data_path, "ab") as f:
+            f.truncate(new_capacity * row_bytes)
+        self.capacity = new_capacity
+        self._memmap = None
+
+    @contextmanager
+    def _write_lock(self):
+        with self._thread_lock, open(self._lock_path, "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self.refresh()
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # ---------- public API ----------
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, digest):
+        return digest in self.index
+
+    def get(self, digest):
+        """float32 copy of one stored row, or None"""
+        row = self.index.get(digest)
+        if row is None:
+            self.refresh()
+            row = self.index.get(digest)
+            if row is None:
+                return None
+        return np.asarray(self._rows()[row], dtype=np.float32)
+
+    def get_many(self, digests):
+        """float32 (N, *shape) array for hashes that are all present"""
+        rows = [self.index[d] for d in digests]
+        return np.asarray(self._rows()[rows], dtype=np.float32)
+
+    def put_many(self, digests, arrays, meta=None):
+        """Append rows for new hashes (existing hashes are left untouched)"""
+        arrays = np.asarray(arrays)
+        with self._write_lock():
+            new = [(i, d) for i, d in enumerate(digests) if d not in self.index]
+            if not new:
+                return
+            grown = self.count + len(new) > self.capacity
+            if grown:
+                self._grow(self.count + len(new))
+            rows = self._rows(mode="r+")
+            for offset, (i, digest) in enumerate(new):
+                rows[self.count + offset] = arrays[i].astype(self.dtype)
+                self.index[digest] = self.count + offset
+                if meta is not None and meta[i]:
+                    self.meta[digest] = meta[i]
+            rows.flush()
+            self.count += len(new)
+            if not os.path.exists(self._manifest_path):
+                self._write_manifest()
+                return
+            records = [{"capacity": self.capacity}] if grown else []
+            records += [{"digest": d, "row": self.index[d], "meta": self.meta.get(d)} for _, d in new]
+            self._append_log(records)
+            self._log_entries += len(new)
+            # Compact once the log holds as many records as the snapshot (amortized O(1) per insert)
+            if self._log_entries > max(self.COMPACT_MIN_RECORDS, self.count - self._log_entries):
+                self._write_manifest()
+
+    def put(self, digest, array, meta=None):
+        self.put_many([digest], [array], [meta] if meta else None)
+
+    def digests(self):
+        """Hashes in row order"""
+        ordered = [None] * self.count
+        for digest, row in self.index.items():
+            ordered[row] = digest
+        return ordered
+
+    def as_array(self):
+        """Read-only memmap view of all stored rows (stored dtype)"""
+        self.refresh()
+        return self._rows()[:self.count]
+
+    def iter_batches(self, batch_size=256):
+        """Yield (digests, float32 batch) in row order"""
+        digests = self.digests()
+        rows = self.as_array()
+        for start in range(0, self.count, batch_size):
+            yield digests[start:start + batch_size], np.asarray(rows[start:start + batch_size], dtype=np.float32)
+
+def open_feature_store(name, shape, root=None, version=None, fp16=FEATURE_STORE_FP16):
+    """Store under FEATURE_STORE_DIR (or root), or None when disabled"""
+    root = root or FEATURE_STORE_DIR
+    if not root:
+        return None
+    return FeatureStore(root, name, shape, fp16=fp16, version=version)
+
+# ==================== OFFLINE EXTRACTION / RE-SCORING ====================
+
+def extract_folder(image_dir, store_root, batch_size=32):
+    """Run the hybrid CNN over a folder (optionally image_dir/<label>/*) and store features"""
+    from PIL import Image
+    from autoencoder import IMAGE_EXTENSIONS
+    from image_store import content_hash
+    from lime_inference import get_lime_predictor
+
+    predictor = get_lime_predictor()
+    store = FeatureStore(store_root, HYBRID_FEATURES, (1024,), version=predictor.model_version)
+
+    paths = []
+    for root, _, names in os.walk(image_dir):
+        for name in sorted(names):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(root, name))
+    paths.sort()
+
+    for start in range(0, len(paths), batch_size):
+        batch_paths = paths[start:start + batch_size]
+        digests, images, meta = [], [], []
+        for path in batch_paths:
+            with open(path, "rb") as f:
+                image_bytes = f.read()
+            digest = content_hash(image_bytes)
+            if digest in store:
+                continue
+            digests.append(digest)
+            images.append(Image.open(path).convert("RGB"))
+            rel_path = os.path.relpath(path, image_dir)
+            # image_dir/<label>/<file> gives a label; loose files do not
+            label = rel_path.split(os.sep)[0] if os.sep in rel_path else None
+            meta.append({"path": rel_path, "label": label})
+        if digests:
+            store.put_many(digests, predictor.extract_features_batch(images), meta)
+        logger.info(f"Extracted {min(start + batch_size, len(paths))}/{len(paths)} images")
+    return store
+
+def rescore(store_root, batch_size=1024):
+    """Re-score every stored hybrid feature row with the current LightGBM model"""
+    from lime_inference import get_lime_predictor
+
+    predictor = get_lime_predictor()
+    store = FeatureStore(store_root, HYBRID_FEATURES, (1024,), version=predictor.model_version)
+    classes = list(predictor.label_encoder.classes_)
+
+    correct = labeled = 0
+    counts = {c: 0 for c in classes}
+    for digests, features in store.iter_batches(batch_size):
+        probs = predictor.score_features(features)
+        for digest, p in zip(digests, probs):
+            predicted = classes[int(np.argmax(p))]
+            counts[predicted] += 1
+            label = store.meta.get(digest, {}).get("label")
+            if label in classes:
+                labeled += 1
+                correct += int(label == predicted)
+
+    report = {"images": len(store), "predicted_counts": counts}
+    if labeled:
+        report["labeled_images"] = labeled
+        report["accuracy"] = correct / labeled
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backbone feature store utilities")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    extract_parser = subparsers.add_parser("extract", help="Extract hybrid CNN features for an image folder")
+    extract_parser.add_argument("image_dir")
+    extract_parser.add_argument("--store", required=True)
+    extract_parser.add_argument("--batch-size", type=int, default=32)
+
+    score_parser = subparsers.add_parser("score", help="Re-score stored features with LightGBM")
+    score_parser.add_argument("--store", required=True)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "extract":
+        store = extract_folder(args.image_dir, args.store, batch_size=args.batch_size)
+        print(f"{len(store)} feature rows in {store.dir}")
+    elif args.command == "score":
+        print(json.dumps(rescore(args.store), indent=2))
@@ -0,0 +1,113 @@
+# image_store.py - Recently uploaded images addressed by content hash
+import os
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+IMAGE_STORE_MAX_BYTES = int(os.getenv("IMAGE_STORE_MAX_MB", "256")) * 1024 * 1024
+# Optional shared tier so a hash uploaded to one uvicorn worker resolves in the others.
+# Off by default (uploads are patient photos): set a directory to persist them to disk
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", "")
+IMAGE_STORE_DISK_MAX_BYTES = int(os.getenv("IMAGE_STORE_DISK_MAX_MB", "2048")) * 1024 * 1024
+
+def content_hash(image_bytes):
+    """SHA-256 hex digest of raw image bytes (the image reference clients send back)"""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+class RecentImageStore:
+    """Byte-bounded LRU of uploaded images with an optional on-disk tier"""
+
+    def __init__(self, max_bytes=IMAGE_STORE_MAX_BYTES, store_dir=IMAGE_STORE_DIR,
+                 disk_max_bytes=IMAGE_STORE_DISK_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.store_dir = store_dir or None
+        self.disk_max_bytes = disk_max_bytes
+        self._images = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._puts_since_prune = 0
+
+    def _path(self, digest):
+        return os.path.join(self.store_dir, digest[:2], digest)
+
+    def _remember(self, digest, image_bytes):
+        if digest in self._images:
+            self._images.move_to_end(digest)
+            return
+        self._images[digest] = image_bytes
+        self._total_bytes += len(image_bytes)
+        while self._total_bytes > self.max_bytes and len(self._images) > 1:
+            _, evicted = self._images.popitem(last=False)
+            self._total_bytes -= len(evicted)
+
+    def put(self, image_bytes):
+        """Register an upload and return its content hash"""
+        digest = content_hash(image_bytes)
+        with self._lock:
+            self._remember(digest, image_bytes)
+            self._puts_since_prune += 1
+            prune = self._puts_since_prune >= 100
+            if prune:
+                self._puts_since_prune = 0
+
+        if self.store_dir:
+            try:
+                path = self._path(digest)
+                if not os.path.exists(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                    with open(tmp_path, "wb") as f:
+                        f.write(image_bytes)
+                    os.replace(tmp_path, path)
+                if prune:
+                    self._prune_disk()
+            except OSError as e:
+                logger.warning(f"Image store disk write failed: {str(e)}")
+        return digest
+
+    def get(self, digest):
+        """Return the image bytes for a content hash, or None if unknown/evicted"""
+        with self._lock:
+            image_bytes = self._images.get(digest)
+            if image_bytes is not None:
+                self._images.move_to_end(digest)
+                return image_bytes
+
+        if self.store_dir and len(digest) == 64 and all(c in "0123456789abcdef" for c in digest):
+            try:
+                with open(self._path(digest), "rb") as f:
+                    image_bytes = f.read()
+            except FileNotFoundError:
+                return None
+            with self._lock:
+                self._remember(digest, image_bytes)
+            return image_bytes
+        return None
+
+    def _prune_disk(self):
+        """Delete the least recently written files above disk_max_bytes"""
+        files = []
+        for root, _, names in os.walk(self.store_dir):
+            for name in names:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+
+image_store = RecentImageStore()
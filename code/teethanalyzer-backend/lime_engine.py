@@ -0,0 +1,412 @@
+# lime_engine.py - Vectorized LIME image explainer (drop-in for lime_image.LimeImageExplainer)
+import os
+import time
+import argparse
+import threading
+import logging
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+
+from explanations import image_and_mask
+
+logger = logging.getLogger(__name__)
+
+# "native" = this module; "lime" = the lime package (kept for parity checks / fallback)
+LIME_ENGINE = os.getenv("LIME_ENGINE", "native")
+# Evaluated perturbation sets kept per worker so a larger num_samples resumes instead of restarting
+LIME_SAMPLE_STORE_SIZE = int(os.getenv("LIME_SAMPLE_STORE_SIZE", "16"))
+# Shared by all workers (one small .npz per image/target/segmentation); "" keeps them in memory only
+LIME_SAMPLE_STORE_DIR = os.getenv("LIME_SAMPLE_STORE_DIR", "cache/lime_samples")
+LIME_SAMPLE_STORE_MAX_FILES = int(os.getenv("LIME_SAMPLE_STORE_MAX_FILES", "2000"))
+
+def cosine_kernel_weights(data, kernel_width=0.25):
+    """lime's sample weights: sqrt(exp(-d^2 / width^2)) with d the cosine distance to data[0].
+
+    data[0] is all ones, so cos(row, data[0]) = sqrt(ones(row) / n_features).
+    """
+    similarity = np.sqrt(data.sum(axis=1) / data.shape[1])
+    distances = np.clip(1.0 - similarity, 0.0, 2.0)
+    return np.sqrt(np.exp(-(distances ** 2) / kernel_width ** 2))
+
+def weighted_ridge(data, targets, weights, alpha=1.0):
+    """Closed-form sklearn Ridge(alpha, fit_intercept=True) with sample weights, all targets at once.
+
+    Returns (coef (L, F), intercept (L,), weighted R^2 score (L,)).
+    """
+    X = data.astype(np.float64)
+    Y = targets.astype(np.float64)
+    w = weights / weights.sum()
+    X_offset = w @ X
+    Y_offset = w @ Y
+    Xc = X - X_offset
+    Yc = Y - Y_offset
+    Xw = Xc * weights[:, None]
+    gram = Xc.T @ Xw
+    gram[np.diag_indices_from(gram)] += alpha
+    coef = np.linalg.solve(gram, Xw.T @ Yc).T
+    intercept = Y_offset - coef @ X_offset
+
+    residual = Y - (X @ coef.T + intercept)
+    total = (weights[:, None] * Yc ** 2).sum(axis=0)
+    score = 1.0 - (weights[:, None] * residual ** 2).sum(axis=0) / np.maximum(total, 1e-300)
+    return coef, intercept, score
+
+def fudged_image_for(image, segments, hide_color):
+    """Replacement pixels for hidden superpixels (per-superpixel mean colour when hide_color is None)"""
+    if hide_color is not None:
+        return np.full_like(image, hide_color)
+    flat = segments.ravel()
+    counts = np.bincount(flat)
+    means = np.stack([
+        np.bincount(flat, weights=image[..., c].ravel()) / np.maximum(counts, 1)
+        for c in range(image.shape[2])
+    ], axis=1)
+    return means[segments].astype(image.dtype)
+
+def perturbation_batches(image, fudged_image, segments, data, batch_size):
+    """Yield (N, H, W, C) perturbation batches built by broadcasting the sample matrix over segments.
+
+    Every batch is written into one buffer allocated per call, so consume it before advancing.
+    """
+    buffer = np.empty((batch_size,) + image.shape, dtype=image.dtype)
+    for start in range(0, len(data), batch_size):
+        rows = data[start:start + batch_size]
+        out = buffer[:len(rows)]
+        hidden = (rows == 0)[:, segments]  # (N, H, W)
+        np.copyto(out, image)
+        np.copyto(out, fudged_image, where=hidden[..., None])
+        yield out
+
+class LimeExplanation:
+    """Attributes used by the rest of the backend, as on lime's ImageExplanation"""
+
+    def __init__(self, image, segments):
+        self.image = image
+        self.segments = segments
+        self.top_labels = None
+        self.intercept = {}
+        self.local_exp = {}
+        self.score = {}
+        self.local_pred = {}
+        self.reused_samples = 0
+        self.evaluated_samples = None
+
+    def get_image_and_mask(self, label, **kwargs):
+        return image_and_mask(self.image, self.segments, self.local_exp, label, **kwargs)
+
+class SampleSet:
+    """Evaluated perturbations of one image: sample matrix, model outputs and RNG position.
+
+    Rows are only appended, drawn from the saved RandomState, so the first N
+    rows are the ones a fresh seeded run with num_samples=N draws. Asking for
+    more samples scores only the new rows.
+    """
+
+    def __init__(self, n_features, random_state):
+        self.n_features = n_features
+        self.random_state = random_state
+        self.data = np.empty((0, n_features), dtype=np.uint8)
+        self.predictions = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def extend(self, image, segments, hide_color, classifier_fn, num_samples, batch_size):
+        """Score rows up to num_samples; returns how many new rows were evaluated"""
+        extra = num_samples - len(self.data)
+        if extra <= 0:
+            return 0
+        # The RNG only moves on together with data/predictions: if scoring fails,
+        # the next resume draws these same rows again
+        rng_state = self.random_state.get_state()
+        rows = self.random_state.randint(0, 2, extra * self.n_features).reshape((extra, self.n_features))
+        rows = rows.astype(np.uint8)
+        if len(self.data) == 0:
+            rows[0, :] = 1
+        try:
+            fudged_image = fudged_image_for(image, segments, hide_color)
+            predictions = np.concatenate([
+                np.asarray(classifier_fn(batch))
+                for batch in perturbation_batches(image, fudged_image, segments, rows, batch_size)
+            ])
+        except BaseException:
+            self.random_state.set_state(rng_state)
+            raise
+        self.data = np.concatenate([self.data, rows])
+        self.predictions = predictions if self.predictions is None else np.concatenate([self.predictions, predictions])
+        return extra
+
+    def save(self, path):
+        _, keys, position, has_gauss, cached_gaussian = self.random_state.get_state()
+        tmp_path = f"{path[:-len('.npz')]}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+        np.savez(tmp_path, data=self.data, predictions=self.predictions, keys=keys,
+                 position=np.array([position, has_gauss]), cached_gaussian=np.array([cached_gaussian]))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            random_state = np.random.RandomState()
+            position, has_gauss = (int(v) for v in arrays["position"])
+            random_state.set_state(("MT19937", arrays["keys"], position, has_gauss,
+                                    float(arrays["cached_gaussian"][0])))
+            sample_set = cls(arrays["data"].shape[1], random_state)
+            sample_set.data = arrays["data"]
+            sample_set.predictions = arrays["predictions"]
+        return sample_set
+
+class SampleStore:
+    """Memory LRU of SampleSets in front of one .npz per set on disk.
+
+    Keys must cover everything the rows depend on: image content, model
+    version, explain target, segmentation, seed and hide colour.
+    """
+
+    def __init__(self, capacity=LIME_SAMPLE_STORE_SIZE, directory=LIME_SAMPLE_STORE_DIR,
+                 max_files=LIME_SAMPLE_STORE_MAX_FILES):
+        self.capacity = capacity
+        self.directory = directory
+        self.max_files = max_files
+        self._sets = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0,
+                       "reused_samples": 0, "evaluated_samples": 0}
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def _load(self, key, n_features):
+        if not self.directory:
+            return None
+        try:
+            sample_set = SampleSet.load(self._path(key))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Discarding unreadable LIME sample set {key}: {e}")
+            return None
+        # A different segmentation (e.g. another scikit-image version) invalidates the rows
+        return sample_set if sample_set.n_features == n_features else None
+
+    def get_or_create(self, key, n_features, random_state):
+        """Stored set for key, or an empty one drawing from random_state"""
+        with self._lock:
+            sample_set = self._sets.get(key)
+            if sample_set is not None and sample_set.n_features == n_features:
+                self._sets.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return sample_set
+            sample_set = self._load(key, n_features)
+            if sample_set is not None:
+                self._stats["disk_hits"] += 1
+            else:
+                self._stats["misses"] += 1
+                sample_set = SampleSet(n_features, random_state)
+            self._sets[key] = sample_set
+            while len(self._sets) > self.capacity:
+                self._sets.popitem(last=False)
+            return sample_set
+
+    def save(self, key, sample_set):
+        """Persist a set after it grew (call with sample_set.lock held)"""
+        if not self.directory:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            sample_set.save(self._path(key))
+            self._prune_disk()
+        except OSError as e:
+            logger.warning(f"Could not persist LIME sample set {key}: {e}")
+
+    def _prune_disk(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz") and ".tmp." not in name:
+                path = os.path.join(self.directory, name)
+                try:
+                    entries.append((os.path.getmtime(path), path))
+                except OSError:
+                    continue
+        if len(entries) <= self.max_files:
+            return
+        for _, path in sorted(entries)[:len(entries) - self.max_files]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def record(self, reused, evaluated):
+        with self._lock:
+            self._stats["reused_samples"] += reused
+            self._stats["evaluated_samples"] += evaluated
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, cached=len(self._sets))
+
+class LimeEngine:
+    """LIME for images without lime's per-sample Python loop.
+
+    Same sampling (randint(0, 2) from the seeded RandomState, first row all
+    ones), cosine kernel and Ridge(alpha=1) surrogate as LimeImageExplainer with
+    its default feature selection, so a seeded run reproduces lime's weights.
+    Only the requested labels are fitted, in one linear solve.
+    """
+
+    def __init__(self, kernel_width=0.25, random_state=None, alpha=1.0):
+        self.kernel_width = kernel_width
+        self.alpha = alpha
+        if isinstance(random_state, np.random.RandomState):
+            self.random_state = random_state
+        else:
+            self.random_state = np.random.RandomState(random_state)
+
+    def explain_instance(self, image, classifier_fn, segmentation_fn, labels=(1,), hide_color=None,
+                         top_labels=None, num_samples=1000, batch_size=10,
+                         sample_store=None, sample_key=None):
+        """With ``sample_store``, perturbations already scored under ``sample_key`` are
+        reused and only rows beyond them are evaluated before the surrogate is refitted.
+        """
+        if image.ndim == 2:
+            image = np.stack([image] * 3, axis=-1)
+        segments = segmentation_fn(image)
+        unique = np.unique(segments)
+        if unique[0] != 0 or unique[-1] != len(unique) - 1:
+            segments = np.searchsorted(unique, segments)  # superpixel IDs must be 0..F-1
+        n_features = len(unique)
+
+        if sample_store is None:
+            sample_set = SampleSet(n_features, self.random_state)
+        else:
+            sample_set = sample_store.get_or_create(sample_key, n_features, self.random_state)
+        with sample_set.lock:
+            reused = min(len(sample_set), num_samples)
+            evaluated = sample_set.extend(image, segments, hide_color, classifier_fn, num_samples, batch_size)
+            data = sample_set.data[:num_samples]
+            predictions = sample_set.predictions[:num_samples]
+            if sample_store is not None:
+                if evaluated:
+                    sample_store.save(sample_key, sample_set)
+                sample_store.record(reused, evaluated)
+
+        explanation = LimeExplanation(image, segments)
+        explanation.reused_samples = reused
+        explanation.evaluated_samples = evaluated
+        if top_labels:
+            top = np.argsort(predictions[0])[-top_labels:]
+            explanation.top_labels = list(top)[::-1]
+            labels = top
+        labels = [int(label) for label in labels]
+
+        weights = cosine_kernel_weights(data, self.kernel_width)
+        coef, intercept, score = weighted_ridge(data, predictions[:, labels], weights, self.alpha)
+        for i, label in enumerate(labels):
+            order = np.argsort(-np.abs(coef[i]), kind="stable")
+            explanation.local_exp[label] = [(int(f), float(coef[i, f])) for f in order]
+            explanation.intercept[label] = float(intercept[i])
+            explanation.score[label] = float(score[i])
+            explanation.local_pred[label] = np.array([coef[i].sum() + intercept[i]])  # data[0] is all ones
+        return explanation
+
+# ==================== PARITY CHECK ====================
+
+def _synthetic_classifier(num_classes=6, seed=0):
+    """Deterministic stand-in model: softmax of a fixed projection of coarse colour statistics"""
+    projection = np.random.RandomState(seed).randn(12, num_classes)
+
+    def classifier_fn(images):
+        images = np.asarray(images, dtype=np.float64) / 255.0
+        h, w = images.shape[1:3]
+        quadrants = [images[:, :h // 2, :w // 2], images[:, :h // 2, w // 2:],
+                     images[:, h // 2:, :w // 2], images[:, h // 2:, w // 2:]]
+        features = np.concatenate([q.mean(axis=(1, 2)) for q in quadrants], axis=1)
+        logits = features @ projection * 4
+        logits -= logits.max(axis=1, keepdims=True)
+        probs = np.exp(logits)
+        return probs / probs.sum(axis=1, keepdims=True)
+    return classifier_fn
+
+def check_parity(image, classifier_fn, num_samples=300, seed=42, top_labels=3):
+    """Compare seeded LimeEngine and lime_image.LimeImageExplainer on the same image and model"""
+    from lime import lime_image
+    from skimage.segmentation import slic
+
+    segmentation_fn = lambda x: slic(x, n_segments=50, compactness=10, sigma=1, start_label=0)
+
+    start = time.perf_counter()
+    reference = lime_image.LimeImageExplainer(random_state=seed).explain_instance(
+        image, classifier_fn, top_labels=top_labels, hide_color=0, num_samples=num_samples,
+        segmentation_fn=segmentation_fn, random_seed=seed
+    )
+    lime_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    native = LimeEngine(random_state=seed).explain_instance(
+        image, classifier_fn, segmentation_fn, top_labels=top_labels, hide_color=0,
+        num_samples=num_samples
+    )
+    native_seconds = time.perf_counter() - start
+
+    report = {"lime_seconds": round(lime_seconds, 3), "native_seconds": round(native_seconds, 3), "labels": {}}
+    for label in reference.top_labels:
+        ref = dict(reference.local_exp[label])
+        ours = dict(native.local_exp[label])
+        report["labels"][int(label)] = {
+            "max_abs_weight_diff": max(abs(ref[f] - ours[f]) for f in ref),
+            "top10_match": [f for f, _ in reference.local_exp[label][:10]] == [f for f, _ in native.local_exp[label][:10]],
+            "intercept_diff": abs(float(reference.intercept[label]) - native.intercept[label]),
+        }
+    return report
+
+def compare_targets(image_path, num_samples=300):
+    """Cost of explaining the hybrid (LightGBM) decision vs the CNN-only head on one image"""
+    from lime_inference import EXPLAIN_TARGETS, get_lime_predictor
+
+    predictor = get_lime_predictor()
+    with open(image_path, "rb") as f:
+        image_bytes = f.read()
+    image = np.asarray(Image.open(image_path).convert('RGB'))
+    prediction = predictor.predict(image_bytes)
+    label = int(predictor.label_encoder.transform([prediction['hybrid_prediction']])[0])
+
+    report = {"label": prediction['hybrid_prediction'], "num_samples": num_samples, "targets": {}}
+    top_regions = {}
+    for target in EXPLAIN_TARGETS:
+        explanation, timing = predictor.explain_image_array(image, num_samples, target)
+        report["targets"][target] = timing
+        top_regions[target] = [f for f, _ in explanation.local_exp[label][:5]]
+    report["top5_region_overlap"] = len(set(top_regions["hybrid"]) & set(top_regions["cnn"]))
+    return report
+
+if __name__ == "__main__":
+    import json
+
+    parser = argparse.ArgumentParser(description="Native LIME engine utilities")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    parity_parser = subparsers.add_parser("parity", help="Seeded comparison against the lime package")
+    parity_parser.add_argument("image")
+    parity_parser.add_argument("--samples", type=int, default=300)
+    parity_parser.add_argument("--cnn", action="store_true", help="Use the hybrid CNN instead of a synthetic model")
+    parity_parser.add_argument("--tolerance", type=float, default=1e-6)
+    targets_parser = subparsers.add_parser("targets", help="Time hybrid vs CNN-only explanations")
+    targets_parser.add_argument("image")
+    targets_parser.add_argument("--samples", type=int, default=300)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "targets":
+        print(json.dumps(compare_targets(args.image, args.samples), indent=2))
+        raise SystemExit(0)
+
+    image = np.asarray(Image.open(args.image).convert('RGB'))
+    if args.cnn:
+        from lime_inference import get_lime_predictor
+        classifier_fn = get_lime_predictor().cnn_probabilities
+    else:
+        classifier_fn = _synthetic_classifier()
+    report = check_parity(image, classifier_fn, num_samples=args.samples)
+    print(json.dumps(report, indent=2))
+    worst = max(r["max_abs_weight_diff"] for r in report["labels"].values())
+    raise SystemExit(0 if worst <= args.tolerance else 1)
@@ -8,14 +8,23 @@ import json
 import os
 import io
 import base64
+import hashlib
 import lightgbm as lgb
 from sklearn.preprocessing import LabelEncoder
-from lime import lime_image
-from skimage.segmentation import mark_boundaries, slic
-import matplotlib
-matplotlib.use('Agg')  # Non-interactive backend for server
-import matplotlib.pyplot as plt
+import threading
 import logging
+import time
+
+from feature_store import HYBRID_FEATURES, open_feature_store
+from image_store import content_hash
+from perturbation_pool import get_perturbation_pool
+from lime_engine import LIME_ENGINE, LimeEngine, SampleStore
+from singleflight import MemoFlight
+from serving_config import inference_slot, lightgbm_threads
+from explanations import (
+    ExplanationArtifacts, explanation_registry, explanation_statistics,
+    explanation_id as make_explanation_id, load_matplotlib,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +34,35 @@ IMAGE_SIZE = (260, 260)
 MODEL_PATH = 'dental_lens_model_v4.pth'
 HYBRID_MODELS_DIR = 'hybrid_models'
 
+# Model LIME explains: "hybrid" (LightGBM on CNN features, the reported diagnosis) or "cnn"
+EXPLAIN_TARGETS = ("hybrid", "cnn")
+LIME_EXPLAIN_TARGET = os.getenv("LIME_EXPLAIN_TARGET", "hybrid")
+# Perturbations per classifier call when scoring in-process
+LIME_BATCH_SIZE = int(os.getenv("LIME_BATCH_SIZE", "32"))
+# Recent predictions / SLIC segment maps kept per worker (segment maps are full-resolution)
+PREDICTION_MEMO_SIZE = int(os.getenv("PREDICTION_MEMO_SIZE", "256"))
+SEGMENT_MEMO_SIZE = int(os.getenv("SEGMENT_MEMO_SIZE", "4"))
+
+# lime, scikit-image and matplotlib are only needed to build explanations, so they
+# are imported on first use instead of at module load (keeps cold start short).
+def preload_explainer_modules():
+    """Import the explanation-only dependencies ahead of the first LIME request"""
+    if LIME_ENGINE != "native":
+        from lime import lime_image  # noqa: F401
+    from skimage.segmentation import mark_boundaries, slic  # noqa: F401
+    load_matplotlib()
+
+def model_version():
+    """Short fingerprint (path, size, mtime) of the CNN checkpoint and hybrid model files"""
+    paths = [MODEL_PATH] + sorted(
+        os.path.join(HYBRID_MODELS_DIR, name) for name in os.listdir(HYBRID_MODELS_DIR)
+    )
+    fingerprint = []
+    for path in paths:
+        stat = os.stat(path)
+        fingerprint.append(f"{path}:{stat.st_size}:{stat.st_mtime_ns}")
+    return hashlib.sha256("|".join(fingerprint).encode("utf-8")).hexdigest()[:16]
+
 class EfficientNetV2Classifier(nn.Module):
     """Same architecture as training"""
     def __init__(self, num_classes, pretrained=True, fine_tune=False):
@@ -59,6 +97,11 @@ class EfficientNetV2Classifier(nn.Module):
         features = self.backbone.classifier[1](features)
         features = self.backbone.classifier[2](features)
         return features
+    
+    def classify_features(self, features):
+        """CNN logits from extract_features() output (the rest of the classifier head)"""
+        features = self.backbone.classifier[3](features)
+        return self.backbone.classifier[4](features)
 
 class LIMEPredictor:
     """LIME-enabled predictor for dental disease detection (LightGBM only)"""
@@ -81,7 +124,31 @@ class LIMEPredictor:
         self.label_encoder = LabelEncoder()
         self.label_encoder.classes_ = np.array(self.metadata['label_encoder_classes'])
         
-        logger.info(f"LIME Predictor initialized with LightGBM")
+        # Keys stored explanations and features, so retraining either model invalidates them
+        self.model_version = model_version()
+        
+        # Optional memory-mapped cache of 1024-dim features by image hash (FEATURE_STORE_DIR).
+        # float32 only: a rounded cache hit must not score differently from a miss
+        self.feature_store = open_feature_store(HYBRID_FEATURES, (1024,), version=self.model_version, fp16=False)
+        if self.feature_store is not None and self.feature_store.dtype != np.float32:
+            logger.warning(f"Feature store {self.feature_store.dir} holds {self.feature_store.dtype.name} rows; "
+                           f"not used for serving")
+            self.feature_store = None
+        
+        # Sub-results shared between the fast and LIME paths (and concurrent requests)
+        self._predictions = MemoFlight(PREDICTION_MEMO_SIZE)
+        self._segment_maps = MemoFlight(SEGMENT_MEMO_SIZE)
+        self._sample_store = SampleStore()
+        
+        logger.info("LIME Predictor initialized with LightGBM")
+    
+    def warmup(self):
+        """Run a dummy forward through the CNN and LightGBM so lazy kernels are initialized"""
+        dummy = torch.zeros(1, 3, *IMAGE_SIZE, device=self.device)
+        with torch.no_grad():
+            features = self.cnn_model.extract_features(dummy)
+            self.cnn_model.classify_features(features)
+        self.score_features(features.cpu().numpy())
     
     def _load_cnn_model(self, model_path):
         """Load CNN model"""
@@ -124,308 +191,305 @@ class LIMEPredictor:
         
         return lgb_model, metadata
     
+    def extract_features_batch(self, images):
+        """1024-dim hybrid features for a list of PIL images, in one batched forward"""
+        batch = torch.stack([self.transform(img.convert('RGB')) for img in images]).to(self.device)
+        with torch.no_grad():
+            return self.cnn_model.extract_features(batch).cpu().numpy()
+    
+    def score_features(self, features):
+        """LightGBM class probabilities (N, num_classes) for an (N, 1024) feature matrix"""
+        # Stay within this worker's thread partition rather than LightGBM's all-cores default
+        kwargs = {"num_threads": lightgbm_threads()} if lightgbm_threads() else {}
+        # Handle both Booster and sklearn wrapper
+        if isinstance(self.lightgbm_model, lgb.Booster):
+            return np.asarray(self.lightgbm_model.predict(features, **kwargs))
+        return np.asarray(self.lightgbm_model.predict_proba(features, **kwargs))
+    
+    def _image_features(self, image_bytes):
+        """Features for one upload, served from the feature store when present"""
+        digest = content_hash(image_bytes) if self.feature_store is not None else None
+        if digest is not None:
+            features = self.feature_store.get(digest)
+            if features is not None:
+                return features[None, :]
+        
+        image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
+        features = self.extract_features_batch([image])
+        if digest is not None:
+            self.feature_store.put(digest, features[0])
+        return features
+    
+    def image_features(self, image_bytes):
+        """(1, 1024) embedding for one upload without a prediction; the backbone runs in an inference slot"""
+        with inference_slot():
+            return self._image_features(image_bytes)
+    
+    def memo_stats(self):
+        return {
+            "predictions": self._predictions.stats(),
+            "segment_maps": self._segment_maps.stats(),
+            "lime_samples": self._sample_store.stats(),
+        }
+    
     def predict(self, image_bytes):
         """Quick prediction without LIME"""
+        return self.predict_with_features(image_bytes)[0]
+    
+    def predict_with_features(self, image_bytes):
+        """Quick prediction plus the (1, 1024) embedding it was made from.
+
+        Memoized by content hash, so /predict-fast and the LIME path (or
+        concurrent uploads of the same photo) share one backbone + LightGBM run.
+        """
+        def compute():
+            with inference_slot():
+                return self._predict_with_features(image_bytes)
+        result, features = self._predictions.get_or_compute(content_hash(image_bytes), compute)
+        return dict(result), features
+    
+    def _predict_with_features(self, image_bytes):
         try:
-            image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
-            img_tensor = self.transform(image).unsqueeze(0).to(self.device)
-            
-            # CNN prediction
-            with torch.no_grad():
-                cnn_output = self.cnn_model(img_tensor)
-                cnn_probs = F.softmax(cnn_output, dim=1)
-                cnn_prediction = torch.argmax(cnn_probs, dim=1).item()
-                cnn_confidence = cnn_probs[0, cnn_prediction].item()
-                
-                # Extract features
-                features = self.cnn_model.extract_features(img_tensor).cpu().numpy()
-            
-            # LightGBM prediction - handle both Booster and sklearn wrapper
-            if isinstance(self.lightgbm_model, lgb.Booster):
-                # Booster model
-                prediction_probs = self.lightgbm_model.predict(features)
-                hybrid_prediction = np.argmax(prediction_probs)
-                hybrid_probabilities = prediction_probs[0]
-            else:
-                # sklearn wrapper model
-                hybrid_prediction = self.lightgbm_model.predict(features)[0]
-                hybrid_probabilities = self.lightgbm_model.predict_proba(features)[0]
-            
-            return {
-                'cnn_prediction': self.label_encoder.inverse_transform([cnn_prediction])[0],
-                'cnn_confidence': float(cnn_confidence),
-                'hybrid_prediction': self.label_encoder.inverse_transform([hybrid_prediction])[0],
-                'hybrid_confidence': float(hybrid_probabilities[hybrid_prediction]),
-                'all_probabilities': {
-                    disease: float(prob) 
-                    for disease, prob in zip(self.metadata['disease_classes'], hybrid_probabilities)
-                }
-            }
+            # One backbone pass: the CNN head and LightGBM both read the same features
+            features = self._image_features(image_bytes)
+            return self.result_from_features(features), features
         except Exception as e:
             logger.error(f"Prediction error: {str(e)}")
             raise
     
-    def predict_with_lime(self, image_bytes, num_samples=100):
-        """Prediction with LIME explanation"""
-        try:
-            logger.info(f"Generating LIME explanation with {num_samples} samples...")
-            
-            # Load image
-            image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
-            image_array = np.array(image)
-            
-            # Get basic prediction first
-            prediction_result = self.predict(image_bytes)
-            predicted_class = self.label_encoder.transform([prediction_result['hybrid_prediction']])[0]
-            
-            # Define prediction function for LIME
-            def predict_fn(images):
-                predictions = []
-                for img in images:
-                    pil_img = Image.fromarray(img.astype(np.uint8))
-                    img_tensor = self.transform(pil_img).unsqueeze(0).to(self.device)
-                    with torch.no_grad():
-                        output = self.cnn_model(img_tensor)
-                        probs = F.softmax(output, dim=1).cpu().numpy()[0]
-                    predictions.append(probs)
-                return np.array(predictions)
-            
-            # Generate LIME explanation
+    def predict_frame(self, image):
+        """Prediction for a transient PIL image (camera frame): not memoized or written to the feature store"""
+        with inference_slot():
+            return self.result_from_features(self.extract_features_batch([image]))
+    
+    def result_from_features(self, features):
+        """CNN-head and LightGBM prediction from a (1, 1024) feature matrix"""
+        # CNN prediction
+        with torch.no_grad():
+            cnn_output = self.cnn_model.classify_features(torch.from_numpy(features).to(self.device))
+            cnn_probs = F.softmax(cnn_output, dim=1)
+            cnn_prediction = torch.argmax(cnn_probs, dim=1).item()
+            cnn_confidence = cnn_probs[0, cnn_prediction].item()
+        
+        # LightGBM prediction
+        hybrid_probabilities = self.score_features(features)[0]
+        hybrid_prediction = int(np.argmax(hybrid_probabilities))
+        
+        return {
+            'cnn_prediction': self.label_encoder.inverse_transform([cnn_prediction])[0],
+            'cnn_confidence': float(cnn_confidence),
+            'hybrid_prediction': self.label_encoder.inverse_transform([hybrid_prediction])[0],
+            'hybrid_confidence': float(hybrid_probabilities[hybrid_prediction]),
+            # LightGBM columns follow the label encoder's class order
+            'all_probabilities': {
+                str(disease): float(prob) 
+                for disease, prob in zip(self.label_encoder.classes_, hybrid_probabilities)
+            }
+        }
+    
+    def cnn_probabilities(self, images):
+        """CNN softmax for a batch of uint8 (N, H, W, 3) images, one image at a time"""
+        predictions = []
+        for img in images:
+            pil_img = Image.fromarray(img.astype(np.uint8))
+            img_tensor = self.transform(pil_img).unsqueeze(0).to(self.device)
+            with torch.no_grad():
+                output = self.cnn_model(img_tensor)
+                probs = F.softmax(output, dim=1).cpu().numpy()[0]
+            predictions.append(probs)
+        return np.array(predictions)
+    
+    def hybrid_probabilities(self, images):
+        """LightGBM probabilities for uint8 (N, H, W, 3) images: one backbone pass, one LightGBM call"""
+        features = self.extract_features_batch([Image.fromarray(img.astype(np.uint8)) for img in images])
+        return self.score_features(features)
+    
+    def _lime_classifier(self, target):
+        """(classifier_fn, batch_size) LIME scores perturbations with for an explain target"""
+        pool = get_perturbation_pool()
+        if target == "hybrid":
+            if pool is not None:
+                # Workers run the backbone; LightGBM scores the merged feature matrix here
+                return (lambda images: self.score_features(pool.features_fn(images))), pool.batch_size
+            return self.hybrid_probabilities, LIME_BATCH_SIZE
+        if pool is not None:
+            return pool.predict_fn, pool.batch_size
+        return self.cnn_probabilities, LIME_BATCH_SIZE
+    
+    def lime_batch_size(self, target=LIME_EXPLAIN_TARGET):
+        """Perturbations scored per classifier call for an explain target (pool-aware)"""
+        return self._lime_classifier(target)[1]
+    
+    def explain_image_array(self, image_array, num_samples, target=LIME_EXPLAIN_TARGET, n_segments=50,
+                            image_key=None):
+        """LIME explanation of every class under the hybrid or CNN-only model, plus its timing.
+
+        With ``image_key`` (the content hash) the SLIC segment map is shared with
+        other explanations of the same image and segment count, and (native
+        engine) perturbations scored by earlier explanations of the same image,
+        target and segmentation are reused: only samples beyond them are evaluated.
+        """
+        from skimage.segmentation import slic
+        
+        if target not in EXPLAIN_TARGETS:
+            raise ValueError(f"Unknown explain target '{target}' (expected one of {EXPLAIN_TARGETS})")
+        classifier_fn, batch_size = self._lime_classifier(target)
+        def segmentation_fn(x):
+            compute = lambda: slic(x, n_segments=n_segments, compactness=10, sigma=1, start_label=0).astype(np.uint16)
+            if image_key is None:
+                return compute()
+            return self._segment_maps.get_or_compute((image_key, n_segments), compute)
+        
+        classifier_seconds = 0.0
+        def timed_classifier_fn(images):
+            nonlocal classifier_seconds
+            with inference_slot():
+                start = time.perf_counter()
+                probabilities = classifier_fn(images)
+                classifier_seconds += time.perf_counter() - start
+            return probabilities
+        
+        start = time.perf_counter()
+        if LIME_ENGINE == "native":
+            sample_key = None
+            if image_key is not None:
+                sample_key = make_explanation_id(
+                    image_key, self.model_version, kind="lime-samples", target=target,
+                    n_segments=n_segments, random_seed=42, hide_color=0
+                )
+            # Every class gets a surrogate from the same samples (one linear solve), so
+            # other diagnoses can be compared without further model evaluations
+            explanation = LimeEngine(random_state=42).explain_instance(
+                image_array,
+                timed_classifier_fn,
+                segmentation_fn,
+                labels=range(len(self.label_encoder.classes_)),
+                hide_color=0,
+                num_samples=num_samples,
+                batch_size=batch_size,
+                sample_store=self._sample_store if sample_key else None,
+                sample_key=sample_key
+            )
+        else:
+            from lime import lime_image
             explainer = lime_image.LimeImageExplainer(random_state=42)
             explanation = explainer.explain_instance(
                 image_array,
-                predict_fn,
+                timed_classifier_fn,
                 top_labels=len(self.label_encoder.classes_),
                 hide_color=0,
                 num_samples=num_samples,
-                segmentation_fn=lambda x: slic(x, n_segments=50, compactness=10, sigma=1, start_label=0),
-                random_seed=42
+                segmentation_fn=segmentation_fn,
+                random_seed=42,
+                batch_size=batch_size
             )
-            
-            # Generate comprehensive visualization
-            logger.info("Creating comprehensive LIME visualization...")
-            
-            # Get explanation masks
-            temp, mask = explanation.get_image_and_mask(
-                predicted_class,
-                positive_only=False,
-                num_features=10,
-                hide_rest=False
-            )
-            
-            temp_positive, mask_positive = explanation.get_image_and_mask(
-                predicted_class,
-                positive_only=True,
-                num_features=5,
-                hide_rest=False
-            )
-            
-            temp_negative, mask_negative = explanation.get_image_and_mask(
-                predicted_class,
-                positive_only=False,
-                num_features=5,
-                hide_rest=False,
-                negative_only=True
+        total_seconds = time.perf_counter() - start
+        
+        evaluated = getattr(explanation, 'evaluated_samples', None)
+        evaluated = num_samples if evaluated is None else evaluated
+        timing = {
+            'target': target,
+            'total_seconds': round(total_seconds, 3),
+            'classifier_seconds': round(classifier_seconds, 3),
+            'classifier_ms_per_sample': round(1000 * classifier_seconds / max(1, evaluated), 3),
+            'evaluated_samples': evaluated,
+            'reused_samples': num_samples - evaluated,
+        }
+        logger.info(f"LIME timing: {timing}")
+        return explanation, timing
+    
+    def predict_with_lime(self, image_bytes, num_samples=100, inline_image=True, target=LIME_EXPLAIN_TARGET,
+                          n_segments=50, explain_class=None):
+        """Prediction with LIME explanation.
+
+        ``target`` picks the model whose decision is explained: "hybrid" (the
+        LightGBM head that produces hybrid_prediction) or "cnn" (CNN softmax).
+        ``explain_class`` (a class name) makes the figure and lime_statistics
+        describe that class instead of hybrid_prediction, e.g. the label a
+        triage-student answer reported to the client.
+        The explanation is registered under ``explanation_id`` so its figure can be
+        rendered on demand (format, DPI, panels); ``explanation_image`` (base64 PNG
+        of the full figure) is only included when ``inline_image`` is set.
+        """
+        try:
+            if target not in EXPLAIN_TARGETS:
+                raise ValueError(f"Unknown explain target '{target}' (expected one of {EXPLAIN_TARGETS})")
+            if explain_class is not None and explain_class not in self.label_encoder.classes_:
+                raise ValueError(f"Unknown class '{explain_class}'")
+            image_hash = content_hash(image_bytes)
+            id_params = {} if explain_class is None else {'explain_class': explain_class}
+            explanation_id = make_explanation_id(
+                image_hash, self.model_version, explainer=LIME_ENGINE, target=target,
+                num_samples=num_samples, n_segments=n_segments, random_seed=42, labels="all", **id_params
             )
             
-            # Create comprehensive 8-panel visualization
-            fig, axes = plt.subplots(2, 4, figsize=(20, 12))
-            disease_name = prediction_result["hybrid_prediction"]
-            fig.suptitle(f'LIME Explanation for {disease_name}', fontsize=16, fontweight='bold')
-            
-            # 1. Original Image
-            axes[0, 0].imshow(image)
-            axes[0, 0].set_title('Original Image', fontsize=12, fontweight='bold')
-            axes[0, 0].axis('off')
-            
-            # 2. Superpixel Segmentation
-            segments = explanation.segments
-            segmented_img = mark_boundaries(image_array/255.0, segments)
-            axes[0, 1].imshow(segmented_img)
-            axes[0, 1].set_title(f'Superpixel Segmentation\n({len(np.unique(segments))} segments)', 
-                               fontsize=12, fontweight='bold')
-            axes[0, 1].axis('off')
-            
-            # 3. Overall Explanation (Positive + Negative)
-            axes[0, 2].imshow(mark_boundaries(temp/255.0, mask))
-            axes[0, 2].set_title('Complete Explanation\n(Green=Support, Red=Against)', 
-                               fontsize=12, fontweight='bold')
-            axes[0, 2].axis('off')
-            
-            # 4. Positive Contributions Only
-            axes[0, 3].imshow(mark_boundaries(temp_positive/255.0, mask_positive))
-            axes[0, 3].set_title('Positive Evidence\n(Supports Diagnosis)', 
-                               fontsize=12, fontweight='bold')
-            axes[0, 3].axis('off')
+            # Explained before (by any worker, before any restart): skip sampling
+            stored = explanation_registry.get(explanation_id)
+            if stored is not None and stored.result is not None:
+                logger.info(f"Reusing stored LIME explanation {explanation_id}")
+                result = self._explanation_response(explanation_id, stored.result, inline_image)
+                result['from_store'] = True
+                return result
             
-            # 5. Negative Contributions Only
-            axes[1, 0].imshow(mark_boundaries(temp_negative/255.0, mask_negative))
-            axes[1, 0].set_title('Negative Evidence\n(Against Diagnosis)', 
-                               fontsize=12, fontweight='bold')
-            axes[1, 0].axis('off')
+            logger.info(f"Generating LIME explanation of the {target} model with {num_samples} samples...")
             
-            # 6. Heatmap of superpixel importance
-            importance_map = self._create_importance_heatmap(explanation, predicted_class)
-            im = axes[1, 1].imshow(importance_map, cmap='RdYlBu_r', alpha=0.8)
-            axes[1, 1].imshow(image_array, alpha=0.5)
-            axes[1, 1].set_title('Importance Heatmap\n(Warmer = More Important)', 
-                               fontsize=12, fontweight='bold')
-            axes[1, 1].axis('off')
-            plt.colorbar(im, ax=axes[1, 1], fraction=0.046)
-            
-            # 7. Top Contributing Regions
-            self._plot_top_regions(axes[1, 2], explanation, image_array, predicted_class)
-            
-            # 8. Quantitative Analysis
-            self._plot_quantitative_analysis(axes[1, 3], explanation, predicted_class, disease_name)
-            
-            plt.tight_layout()
-            
-            # Save to base64
-            buf = io.BytesIO()
-            plt.savefig(buf, format='png', bbox_inches='tight', dpi=150)
-            buf.seek(0)
-            img_base64 = base64.b64encode(buf.read()).decode('utf-8')
-            plt.close()
-            
-            # Calculate LIME statistics
-            local_exp = explanation.local_exp[predicted_class]
-            positive_sum = sum(imp for _, imp in local_exp if imp > 0)
-            negative_sum = sum(imp for _, imp in local_exp if imp < 0)
-            net_evidence = positive_sum + negative_sum
+            # Load image
+            image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
+            image_array = np.array(image)
             
-            # Generate clinical interpretation
-            clinical_interpretation = []
-            if positive_sum > abs(negative_sum):
-                clinical_interpretation.append("The model found more supporting evidence than contradicting evidence")
-                clinical_interpretation.append("Key pathological regions were identified and weighted appropriately")
-            else:
-                clinical_interpretation.append("The model found mixed or contradictory evidence")
-                clinical_interpretation.append("Consider reviewing the diagnosis or obtaining additional images")
+            # Get basic prediction first
+            prediction_result = self.predict(image_bytes)
+            explained_class = prediction_result['hybrid_prediction'] if explain_class is None else explain_class
+            predicted_class = self.label_encoder.transform([explained_class])[0]
             
-            logger.info("LIME explanation generated successfully")
+            # Generate LIME explanation
+            explanation, timing = self.explain_image_array(
+                image_array, num_samples, target, n_segments, image_key=image_hash
+            )
             
-            return {
-                'explanation_image': img_base64,
+            # Keep what the figure needs (downscaled) instead of the rendered PNG
+            artifacts = ExplanationArtifacts.from_full_resolution(
+                image_array, explanation.segments, explanation.local_exp,
+                predicted_class, self.label_encoder.classes_
+            )
+            artifacts.result = {
                 'prediction': prediction_result,
                 'num_samples': num_samples,
-                'lime_statistics': {
-                    'total_positive_evidence': float(positive_sum),
-                    'total_negative_evidence': float(negative_sum),
-                    'net_evidence': float(net_evidence),
-                    'clinical_interpretation': clinical_interpretation
-                }
+                'explained_model': target,
+                'explained_class': str(explained_class),
+                'n_segments': n_segments,
+                'explanation_timing': timing,
+                'lime_statistics': explanation_statistics(artifacts.local_exp[artifacts.predicted_class]),
+                'class_explanations': artifacts.class_summaries()
             }
+            explanation_registry.put(explanation_id, artifacts)
+            
+            logger.info("LIME explanation generated successfully")
+            
+            return self._explanation_response(explanation_id, artifacts.result, inline_image)
             
         except Exception as e:
             logger.error(f"LIME explanation error: {str(e)}")
             raise
-    
-    def _create_importance_heatmap(self, explanation, predicted_class):
-        """Create importance heatmap from LIME explanation"""
-        segments = explanation.segments
-        importance_map = np.zeros_like(segments, dtype=float)
-        
-        # Get local explanation
-        local_exp = explanation.local_exp[predicted_class]
-        
-        for segment_id, importance in local_exp:
-            importance_map[segments == segment_id] = importance
-        
-        return importance_map
-    
-    def _plot_top_regions(self, ax, explanation, image_array, predicted_class):
-        """Plot top contributing regions with their importance scores"""
-        local_exp = explanation.local_exp[predicted_class]
-        top_regions = sorted(local_exp, key=lambda x: abs(x[1]), reverse=True)[:5]
-        
-        # Create image showing only top regions
-        segments = explanation.segments
-        top_regions_mask = np.zeros_like(segments)
-        
-        for i, (segment_id, importance) in enumerate(top_regions):
-            top_regions_mask[segments == segment_id] = i + 1
-        
-        # Show regions with different colors
-        masked_image = image_array.copy()
-        colored_mask = plt.cm.Set1(top_regions_mask / 5.0)
-        
-        # Blend original image with colored mask
-        for i in range(3):
-            masked_image[:, :, i] = np.where(
-                top_regions_mask > 0,
-                0.6 * masked_image[:, :, i] + 0.4 * 255 * colored_mask[:, :, i],
-                masked_image[:, :, i]
-            )
-        
-        ax.imshow(masked_image.astype(np.uint8))
-        ax.set_title('Top 5 Contributing Regions', fontsize=12, fontweight='bold')
-        ax.axis('off')
-        
-        # Add legend
-        legend_text = []
-        for i, (segment_id, importance) in enumerate(top_regions):
-            sign = "+" if importance > 0 else ""
-            legend_text.append(f"Region {i+1}: {sign}{importance:.3f}")
-        
-        ax.text(1.02, 1, '\n'.join(legend_text), transform=ax.transAxes, 
-               verticalalignment='top', fontsize=9,
-               bbox=dict(boxstyle="round,pad=0.3", facecolor="white", alpha=0.8))
-    
-    def _plot_quantitative_analysis(self, ax, explanation, predicted_class, disease_name):
-        """Plot quantitative analysis of LIME explanation"""
-        local_exp = explanation.local_exp[predicted_class]
-        
-        # Separate positive and negative contributions
-        positive_contrib = [imp for _, imp in local_exp if imp > 0]
-        negative_contrib = [imp for _, imp in local_exp if imp < 0]
-        
-        # Create summary statistics
-        stats_text = f"Quantitative Analysis\n" + "="*25 + "\n"
-        stats_text += f"Disease: {disease_name}\n\n"
-        stats_text += f"Total Regions: {len(local_exp)}\n"
-        stats_text += f"Supporting: {len(positive_contrib)}\n"
-        stats_text += f"Against: {len(negative_contrib)}\n\n"
-        
-        if positive_contrib:
-            stats_text += f"Positive Evidence:\n"
-            stats_text += f"• Mean: {np.mean(positive_contrib):.4f}\n"
-            stats_text += f"• Max: {np.max(positive_contrib):.4f}\n"
-            stats_text += f"• Sum: {np.sum(positive_contrib):.4f}\n\n"
-        
-        if negative_contrib:
-            stats_text += f"Negative Evidence:\n"
-            stats_text += f"• Mean: {np.abs(np.mean(negative_contrib)):.4f}\n"
-            stats_text += f"• Min: {np.abs(np.min(negative_contrib)):.4f}\n"
-            stats_text += f"• Sum: {np.abs(np.sum(negative_contrib)):.4f}\n\n"
-        
-        # Overall assessment
-        net_support = np.sum(positive_contrib) - np.abs(np.sum(negative_contrib))
-        stats_text += f"Net Support: {net_support:.4f}\n"
-        
-        if net_support > 0.1:
-            assessment = "Strong Support"
-        elif net_support > 0.05:
-            assessment = "Moderate Support"
-        elif net_support > -0.05:
-            assessment = "Weak/Mixed Evidence"
-        else:
-            assessment = "Contradictory Evidence"
-        
-        stats_text += f"Assessment: {assessment}"
-        
-        ax.text(0.05, 0.95, stats_text, transform=ax.transAxes, 
-               verticalalignment='top', fontsize=10, fontfamily='monospace',
-               bbox=dict(boxstyle="round,pad=0.5", facecolor="lightgray", alpha=0.8))
-        ax.set_title('Statistical Summary', fontsize=12, fontweight='bold')
-        ax.axis('off')
+
+    def _explanation_response(self, explanation_id, stored_result, inline_image):
+        result = {'explanation_id': explanation_id, **stored_result}
+        if inline_image:
+            png = explanation_registry.render(explanation_id, fmt='png', dpi=150)
+            result['explanation_image'] = base64.b64encode(png).decode('utf-8')
+        return result
 
 # Global instance (lazy initialization)
 _lime_predictor = None
+_lime_predictor_lock = threading.Lock()
 
 def get_lime_predictor():
     """Get or create LIME predictor instance"""
     global _lime_predictor
     if _lime_predictor is None:
-        _lime_predictor = LIMEPredictor()
-    return _lime_predictor
\ No newline at end of file
+        # Startup builds the predictor in a background thread; requests arriving
+        # meanwhile wait for that instance instead of building a second one.
+        with _lime_predictor_lock:
+            if _lime_predictor is None:
+                _lime_predictor = LIMEPredictor()
+    return _lime_predictor
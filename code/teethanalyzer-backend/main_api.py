@@ -1,28 +1,137 @@
 # main_api.py - Updated for PyTorch Autoencoder
-from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks
-from fastapi.responses import JSONResponse, StreamingResponse
+import time
+_IMPORT_START = time.perf_counter()
+# Claim this worker's core partition and size torch/OpenMP threads before any model is built
+from serving_config import apply_serving_config, inference_slot, serving_state
+apply_serving_config()
+
+from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks, Request, WebSocket
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from prediction import predict_disease
 from pydantic import BaseModel
 from chatbot import stream_response
+from chat_cache import chat_cache
+from image_store import image_store
+from case_index import get_case_index
+from near_duplicate import dhash, near_duplicates
+from memory_budget import AdmissionRejected, memory_admission, memory_guard, memory_metrics
+from quality import quality_controller
+from singleflight import inflight
+from triage import get_triage_classifier
+from explanations import IMAGE_FORMATS, MAX_DPI, MIN_DPI, PANELS, explanation_registry
 from typing import List
+from contextlib import asynccontextmanager, contextmanager, suppress
+import asyncio
+import base64
+import hashlib
+import os
 import traceback
 import logging
-import numpy as np
-from PIL import Image
-import io
-import torch
-import torch.nn as nn
-from torchvision import transforms
+
+from autoencoder import (
+    RECONSTRUCTION_ERROR_THRESHOLD,
+    anomaly_heatmap,
+    anomaly_maps,
+    autoencoder_verdict,
+    load_autoencoder,
+    preprocess_image_for_autoencoder,
+    preprocess_images_for_autoencoder,
+    reconstruction_errors,
+    warmup_autoencoder,
+)
 
 # Import LIME functionality
-from lime_inference import get_lime_predictor
+from lime_inference import EXPLAIN_TARGETS, LIME_EXPLAIN_TARGET, get_lime_predictor, preload_explainer_modules
+from perturbation_pool import get_perturbation_pool, shutdown_perturbation_pool
+from tiling import TILE_BATCH_SIZE, TILE_BUDGET, TILE_MAX_BUDGET, analyze_tiles
+from screening import ScreeningSession, screen_frame, screening_stats
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+# ==================== STARTUP (LOAD + WARM MODELS) ====================
+# Models are built and warmed in a background phase at startup, so liveness
+# (/health) answers immediately while readiness (/ready) waits for the models.
+
+# Import explanation-only dependencies (lime, skimage, matplotlib) at startup too
+PRELOAD_EXPLAINER = os.getenv("PRELOAD_EXPLAINER", "0") == "1"
+
+autoencoder = None
+device = None
+AUTOENCODER_LOADED = False
+
+STARTUP_PHASES = {}  # phase name -> seconds
+startup_state = {"complete": False, "hybrid_loaded": False, "error": None}
+
+@contextmanager
+def startup_phase(name):
+    """Time one startup phase and record it in STARTUP_PHASES"""
+    phase_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP_PHASES[name] = round(time.perf_counter() - phase_start, 4)
+        logger.info(f"Startup phase '{name}' took {STARTUP_PHASES[name]:.3f}s")
+
+def load_models():
+    """Build and warm every model; runs once in a worker thread during startup"""
+    global autoencoder, device, AUTOENCODER_LOADED
+
+    # ==================== LOAD PYTORCH AUTOENCODER ====================
+    try:
+        with startup_phase("autoencoder_load"):
+            autoencoder, device = load_autoencoder()
+        with startup_phase("autoencoder_warmup"):
+            warmup_autoencoder(autoencoder, device)
+        AUTOENCODER_LOADED = True
+    except Exception as e:
+        logger.error(f"Failed to load autoencoder: {str(e)}")
+        autoencoder = None
+        device = None
+        AUTOENCODER_LOADED = False
+
+    # ==================== LOAD HYBRID CNN + LIGHTGBM ====================
+    try:
+        with startup_phase("hybrid_load"):
+            predictor = get_lime_predictor()
+        with startup_phase("hybrid_warmup"):
+            predictor.warmup()
+        startup_state["hybrid_loaded"] = True
+
+        if PRELOAD_EXPLAINER:
+            with startup_phase("explainer_imports"):
+                preload_explainer_modules()
+        
+        triage = get_triage_classifier(predictor.label_encoder.classes_)
+        if triage is not None:
+            with startup_phase("triage_warmup"):
+                triage.warmup()
+        
+        pool = get_perturbation_pool()
+        if pool is not None:
+            with startup_phase("lime_pool_start"):
+                pool.warmup()
+    except Exception as e:
+        logger.error(f"Failed to load hybrid model: {str(e)}")
+        startup_state["error"] = str(e)
+
+    startup_state["complete"] = True
+    logger.info(f"Startup phases (seconds): {STARTUP_PHASES}")
+
+@asynccontextmanager
+async def lifespan(app):
+    STARTUP_PHASES["imports"] = round(_app_created - _IMPORT_START, 4)
+    loop = asyncio.get_running_loop()
+    startup_task = loop.run_in_executor(None, load_models)
+    yield
+    if not startup_task.done():
+        logger.info("Shutting down before model startup finished")
+    shutdown_perturbation_pool()
+
+app = FastAPI(lifespan=lifespan)
+_app_created = time.perf_counter()
 
 # CORS setup
 app.add_middleware(
@@ -33,78 +142,40 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# ==================== DEFINE AUTOENCODER ARCHITECTURE ====================
-# You need to define the same architecture as your training code
-class SimpleAutoencoder(nn.Module):
-    def __init__(self):
-        super(SimpleAutoencoder, self).__init__()
-        # Encoder
-        self.encoder = nn.Sequential(
-            nn.Conv2d(3, 16, 3, stride=2, padding=1),  # [B, 16, 112, 112]
-            nn.ReLU(),
-            nn.Conv2d(16, 32, 3, stride=2, padding=1), # [B, 32, 56, 56]
-            nn.ReLU(),
-            nn.Conv2d(32, 64, 3, stride=2, padding=1), # [B, 64, 28, 28]
-            nn.ReLU(),
-        )
-        # Decoder
-        self.decoder = nn.Sequential(
-            nn.ConvTranspose2d(64, 32, 3, stride=2, padding=1, output_padding=1), # [B, 32, 56, 56]
-            nn.ReLU(),
-            nn.ConvTranspose2d(32, 16, 3, stride=2, padding=1, output_padding=1), # [B, 16, 112, 112]
-            nn.ReLU(),
-            nn.ConvTranspose2d(16, 3, 3, stride=2, padding=1, output_padding=1),  # [B, 3, 224, 224]
-            nn.Sigmoid(),  # Output in [0,1]
-        )
-    def forward(self, x):
-        x = self.encoder(x)
-        x = self.decoder(x)
-        return x
-
-# ==================== LOAD PYTORCH AUTOENCODER ====================
-try:
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    logger.info(f"Using device: {device}")
-    
-    # Initialize model
-    autoencoder = SimpleAutoencoder().to(device)
-    
-    # Load weights
-    autoencoder.load_state_dict(torch.load('hybrid_models/autoencoder_healthy.pth', map_location=device))
-    autoencoder.eval()  # Set to evaluation mode
-    
-    logger.info("PyTorch Autoencoder model loaded successfully")
-    AUTOENCODER_LOADED = True
-except Exception as e:
-    logger.error(f"Failed to load autoencoder: {str(e)}")
-    autoencoder = None
-    device = None
-    AUTOENCODER_LOADED = False
-
-# Autoencoder threshold (tune this based on your validation results)
-RECONSTRUCTION_ERROR_THRESHOLD = 0.05  # Adjust based on your model's performance
-
-# Image preprocessing for PyTorch
-transform = transforms.Compose([
-    transforms.Resize((224, 224)),
-    transforms.ToTensor(),  # Converts to [0, 1] and changes to CHW format
-])
-
 # Store for LIME results
 lime_cache = {}
 
+# Model work is blocking, so endpoints hand it to the threadpool with
+# run_in_threadpool; chat streaming stays on the event loop and holds no thread.
+
 # ==================== AUTOENCODER VALIDATION ENDPOINT ====================
 
-def preprocess_image_for_autoencoder(image_bytes):
-    """Preprocess image for PyTorch autoencoder"""
-    img = Image.open(io.BytesIO(image_bytes))
-    img = img.convert('RGB')
-    img_tensor = transform(img)  # Shape: (3, 224, 224)
-    img_tensor = img_tensor.unsqueeze(0)  # Add batch dimension: (1, 3, 224, 224)
-    return img_tensor
+# Upper bound on images scored in one /validate-autoencoder-batch forward
+AUTOENCODER_MAX_BATCH = int(os.getenv("AUTOENCODER_MAX_BATCH", "32"))
+
+def compute_reconstruction_error(image_bytes, include_heatmap=False):
+    """Reconstruction MSE of one image, plus its anomaly heatmap if requested"""
+    # Preprocess image
+    img_tensor = preprocess_image_for_autoencoder(image_bytes)
+    img_tensor = img_tensor.to(device)
+    
+    with inference_slot():
+        errors, reconstructed = reconstruction_errors(autoencoder, img_tensor)
+    heatmap = None
+    if include_heatmap:
+        # Reuses the reconstruction above; no extra forward
+        heatmap = anomaly_heatmap(anomaly_maps(img_tensor, reconstructed)[0])
+    return float(errors[0]), heatmap
+
+def compute_reconstruction_errors(images_bytes):
+    """Reconstruction MSE of each image, scored in a single batched forward"""
+    batch = preprocess_images_for_autoencoder(images_bytes).to(device)
+    with inference_slot():
+        errors, _ = reconstruction_errors(autoencoder, batch)
+    return [float(error) for error in errors]
 
 @app.post("/validate-autoencoder")
-async def validate_autoencoder(file: UploadFile = File(...)):
+async def validate_autoencoder(file: UploadFile = File(...), include_heatmap: bool = False):
     """
     STEP 0: Validate if image shows diseased teeth using autoencoder
     
@@ -117,6 +188,8 @@ async def validate_autoencoder(file: UploadFile = File(...)):
         - reconstruction_error: MSE value
         - confidence: Confidence level
         - status: 'diseased' or 'healthy'
+        - anomaly_heatmap (include_heatmap=true): per-patch reconstruction error
+          grid, a small PNG overlay and the top anomalous regions
     """
     try:
         if not AUTOENCODER_LOADED:
@@ -129,60 +202,328 @@ async def validate_autoencoder(file: UploadFile = File(...)):
         
         # Read image bytes
         image_bytes = await file.read()
+        image_hash = await run_in_threadpool(image_store.put, image_bytes)
         
-        # Preprocess image
-        img_tensor = preprocess_image_for_autoencoder(image_bytes)
-        img_tensor = img_tensor.to(device)
+        reconstruction_error, heatmap = await run_in_threadpool(
+            compute_reconstruction_error, image_bytes, include_heatmap
+        )
         
-        # Get reconstruction from autoencoder
-        with torch.no_grad():
-            reconstructed = autoencoder(img_tensor)
+        result = autoencoder_verdict(reconstruction_error)
+        if heatmap is not None:
+            result['anomaly_heatmap'] = heatmap
         
-        # Calculate reconstruction error (MSE)
-        mse = torch.nn.functional.mse_loss(img_tensor, reconstructed)
-        reconstruction_error = float(mse.item())
+        logger.info(f"Autoencoder result: {result['status']} (error: {reconstruction_error:.6f}, threshold: {RECONSTRUCTION_ERROR_THRESHOLD}, confidence: {result['confidence']:.2f})")
         
-        # Determine if image is valid (diseased) or invalid (healthy)
-        # High error = diseased (autoencoder can't reconstruct anomalies well)
-        # Low error = healthy (autoencoder reconstructs healthy teeth well)
-        is_valid = reconstruction_error > RECONSTRUCTION_ERROR_THRESHOLD
+        return JSONResponse(content={
+            **result,
+            'image_hash': image_hash
+        })
         
-        # Calculate confidence based on distance from threshold
-        error_diff = abs(reconstruction_error - RECONSTRUCTION_ERROR_THRESHOLD)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in validate_autoencoder: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        raise HTTPException(
+            status_code=500, 
+            detail=f"Autoencoder validation failed: {str(e)}"
+        )
+
+@app.post("/validate-autoencoder-batch")
+async def validate_autoencoder_batch(files: List[UploadFile] = File(...)):
+    """
+    Batched STEP 0: score several images in one autoencoder forward
+    
+    Returns one validation result per file (same fields as /validate-autoencoder),
+    in upload order.
+    """
+    try:
+        if not AUTOENCODER_LOADED:
+            raise HTTPException(
+                status_code=503, 
+                detail="Autoencoder model not loaded"
+            )
+        if len(files) > AUTOENCODER_MAX_BATCH:
+            raise HTTPException(
+                status_code=400,
+                detail=f"At most {AUTOENCODER_MAX_BATCH} files per batch"
+            )
+        
+        logger.info(f"Autoencoder batch validation - {len(files)} files")
         
-        if is_valid:
-            # Diseased - confidence based on how much higher than threshold
-            confidence = min(0.99, 0.5 + error_diff * 10)
-        else:
-            # Healthy - confidence based on how much lower than threshold
-            confidence = min(0.99, 0.5 + error_diff * 10)
+        images_bytes = [await file.read() for file in files]
+        image_hashes = [await run_in_threadpool(image_store.put, image_bytes) for image_bytes in images_bytes]
         
-        status = 'diseased' if is_valid else 'healthy'
+        errors = await run_in_threadpool(compute_reconstruction_errors, images_bytes)
         
-        logger.info(f"Autoencoder result: {status} (error: {reconstruction_error:.6f}, threshold: {RECONSTRUCTION_ERROR_THRESHOLD}, confidence: {confidence:.2f})")
+        results = [
+            {
+                'filename': file.filename,
+                **autoencoder_verdict(error),
+                'image_hash': image_hash
+            }
+            for file, error, image_hash in zip(files, errors, image_hashes)
+        ]
         
         return JSONResponse(content={
-            'is_valid': is_valid,
-            'reconstruction_error': reconstruction_error,
+            'status': 'success',
             'threshold': RECONSTRUCTION_ERROR_THRESHOLD,
-            'confidence': confidence,
-            'status': status
+            'results': results
         })
         
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error in validate_autoencoder: {str(e)}")
+        logger.error(f"Error in validate_autoencoder_batch: {str(e)}")
         logger.error(f"Traceback: {traceback.format_exc()}")
         raise HTTPException(
             status_code=500, 
-            detail=f"Autoencoder validation failed: {str(e)}"
+            detail=f"Autoencoder batch validation failed: {str(e)}"
+        )
+
+# ==================== MEMORY ADMISSION ====================
+# Prediction and LIME work reserve their estimated peak memory against the
+# worker's budget first (queued or rejected when it would not fit) and record
+# what they actually used for /metrics/memory.
+
+def memory_busy(error):
+    """503 for a request that could not be admitted under the memory budget"""
+    logger.warning(f"Memory admission rejected a request: {str(error)}")
+    return HTTPException(status_code=503, detail=str(error), headers={"Retry-After": "5"})
+
+# ==================== NEAR-DUPLICATE REUSE ====================
+# Re-uploads of the same photo (recompressed, resized, slightly cropped) reuse the
+# stored explanation instead of running LIME again. Off unless
+# NEAR_DUPLICATE_MAX_DISTANCE is set; hash candidates are confirmed by embedding.
+# Plain predictions never reuse: confirming a candidate costs the same forward
+# that answers the request.
+
+def image_embedding(image_bytes):
+    """(1024,) hybrid CNN embedding; memoized with the prediction, so the LIME run that follows a miss reuses it"""
+    return get_lime_predictor().predict_with_features(image_bytes)[1][0]
+
+async def near_duplicate_lookup(image_bytes, operation):
+    """Returns (phash, hit); hit is (result, distance, matched_image_hash, similarity) or None.
+
+    The hash only nominates candidates; the upload's embedding is computed to
+    confirm one, so different photos with similar framing are never merged.
+    """
+    if not near_duplicates.enabled:
+        return None, None
+    phash = await run_in_threadpool(dhash, image_bytes)
+    if not near_duplicates.has_candidates(phash, operation):
+        return phash, None
+    embedding = await run_in_threadpool(image_embedding, image_bytes)
+    return phash, near_duplicates.lookup(phash, operation, embedding)
+
+def near_duplicate_flag(hit):
+    """Response field describing a near-duplicate hit (None on a fresh computation)"""
+    if hit is None:
+        return None
+    _, distance, matched_image_hash, similarity = hit
+    return {
+        'matched_image_hash': matched_image_hash,
+        'hamming_distance': distance,
+        'embedding_similarity': similarity
+    }
+
+async def explain_image(image_bytes, image_hash, num_samples, target=LIME_EXPLAIN_TARGET, n_segments=50,
+                        explain_class=None):
+    """predict_with_lime with near-duplicate reuse; returns (result, hit)"""
+    operation = f"lime:{target}:{num_samples}:{n_segments}:{explain_class}"
+    phash, hit = await near_duplicate_lookup(image_bytes, operation)
+    # A hit is only usable while its explanation can still be rendered
+    if hit is not None and explanation_registry.get(hit[0]['explanation_id']) is not None:
+        logger.info(f"Near-duplicate LIME hit (distance {hit[1]}) for {image_hash}")
+        return hit[0], hit
+    
+    predictor = await run_in_threadpool(get_lime_predictor)
+    async with memory_guard("lime", image_bytes, num_samples, predictor.lime_batch_size(target)):
+        result = await run_in_threadpool(
+            predictor.predict_with_lime, image_bytes, num_samples=num_samples, inline_image=False,
+            target=target, n_segments=n_segments, explain_class=explain_class
         )
+    if phash is not None:
+        embedding = await run_in_threadpool(image_embedding, image_bytes)
+        near_duplicates.add(phash, operation, result, image_hash, embedding)
+    return result, None
+
+# ==================== EXPLANATION IMAGES ====================
+# LIME endpoints return an explanation_id/explanation_url; the figure itself is
+# served as raw bytes (WebP/JPEG/PNG, chosen DPI or pixel budget, chosen panels)
+# so it is not base64-inflated inside the JSON and is cacheable by clients.
+
+IMAGE_DELIVERY_MODES = ("inline", "url")
+
+def explanation_url(explanation_id):
+    return f"/explanations/{explanation_id}/image"
+
+async def explanation_fields(result, image_delivery, dpi=150):
+    """explanation_id/url, plus the base64 PNG figure for inline delivery"""
+    fields = {
+        "explanation_id": result['explanation_id'],
+        "explanation_url": explanation_url(result['explanation_id']),
+    }
+    if image_delivery == "inline":
+        start = time.perf_counter()
+        png = await run_in_threadpool(explanation_registry.render, result['explanation_id'], fmt='png', dpi=dpi)
+        quality_controller.observe_render(time.perf_counter() - start, dpi)
+        fields["explanation_image"] = base64.b64encode(png).decode('utf-8')
+    return fields
+
+async def explain_with_quality(image_bytes, image_hash, num_samples, explain_target, image_delivery,
+                               explain_class=None):
+    """explain_image at the quality the adaptive controller allows under current load.
+
+    Returns (result, hit, fields): fields holds the explanation_id/url/image
+    plus "quality", the level actually delivered.
+    """
+    async with quality_controller.session(num_samples, explain_target) as plan:
+        # Identical concurrent explanations (same image and parameters) run once
+        operation = f"lime:{plan['explain_target']}:{plan['num_samples']}:{plan['n_segments']}:{explain_class}"
+        async def run_explanation():
+            # Only the shared execution counts as load, not every coalesced request
+            async with quality_controller.running():
+                return await explain_image(
+                    image_bytes, image_hash, plan['num_samples'], plan['explain_target'], plan['n_segments'],
+                    explain_class
+                )
+        (result, hit), shared = await inflight.do((image_hash, operation), run_explanation)
+        # Only the leader's fresh computation says anything about current latency
+        if hit is None and not shared and not result.get('from_store'):
+            quality_controller.observe(result['explanation_timing'], result['num_samples'])
+        fields = await explanation_fields(result, image_delivery, dpi=plan['inline_dpi'])
+    fields["quality"] = plan
+    return result, hit, fields
+
+def validate_image_delivery(image_delivery):
+    if image_delivery not in IMAGE_DELIVERY_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"image_delivery must be one of {', '.join(IMAGE_DELIVERY_MODES)}"
+        )
+
+@app.get("/explanations/{explanation_id}/image")
+async def explanation_image_endpoint(
+    explanation_id: str,
+    request: Request,
+    format: str = "webp",
+    dpi: int = 100,
+    max_pixels: int | None = None,
+    panels: str | None = None,
+    class_name: str | None = None
+):
+    """
+    Rendered LIME explanation figure
+    - format: webp (default), jpeg or png
+    - dpi: 20-300; max_pixels lowers it further to fit a pixel budget
+    - panels: comma-separated subset of the 8 panels (default: all)
+    - class_name: explain this disease class instead of the prediction (same LIME run)
+    """
+    try:
+        if format not in IMAGE_FORMATS:
+            raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(IMAGE_FORMATS)}")
+        dpi = max(MIN_DPI, min(MAX_DPI, dpi))
+        if max_pixels is not None and max_pixels <= 0:
+            raise HTTPException(status_code=400, detail="max_pixels must be positive")
+        panel_list = tuple(p.strip() for p in panels.split(",") if p.strip()) if panels else PANELS
+        unknown = [p for p in panel_list if p not in PANELS]
+        if unknown or not panel_list:
+            raise HTTPException(status_code=400, detail=f"panels must be a subset of {', '.join(PANELS)}")
+        
+        artifacts = explanation_registry.get(explanation_id)
+        if artifacts is None:
+            raise HTTPException(status_code=404, detail="Unknown or expired explanation_id")
+        class_index = None
+        if class_name is not None:
+            class_index = artifacts.class_index(class_name)
+            if class_index is None:
+                raise HTTPException(status_code=404, detail=f"No weights for class '{class_name}' in this explanation")
+        
+        # Explanations are immutable, so the ETag only depends on the request
+        variant = f"{explanation_id}|{format}|{dpi}|{max_pixels}|{','.join(panel_list)}|{class_index}"
+        etag = '"' + hashlib.sha256(variant.encode("utf-8")).hexdigest()[:32] + '"'
+        headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        
+        data = await run_in_threadpool(
+            explanation_registry.render, explanation_id, panel_list, format, dpi, max_pixels, class_index
+        )
+        if data is None:
+            raise HTTPException(status_code=404, detail="Unknown or expired explanation_id")
+        return Response(content=data, media_type=IMAGE_FORMATS[format], headers=headers)
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in explanation_image_endpoint: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        raise HTTPException(status_code=500, detail=f"Explanation rendering failed: {str(e)}")
+
+@app.get("/explanations/{explanation_id}/classes")
+async def explanation_classes_endpoint(explanation_id: str, class_name: str | None = None):
+    """
+    Superpixel weights and evidence statistics for every disease class of one LIME run
+    - class_name: only this class
+    """
+    try:
+        artifacts = explanation_registry.get(explanation_id)
+        if artifacts is None:
+            raise HTTPException(status_code=404, detail="Unknown or expired explanation_id")
+        summaries = artifacts.class_summaries(top_regions=None)
+        if class_name is not None:
+            if class_name not in summaries:
+                raise HTTPException(status_code=404, detail=f"No weights for class '{class_name}' in this explanation")
+            summaries = {class_name: summaries[class_name]}
+        return {
+            "explanation_id": explanation_id,
+            "predicted_class": str(artifacts.class_names[artifacts.predicted_class]),
+            "num_segments": artifacts.num_segments,
+            "classes": summaries
+        }
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in explanation_classes_endpoint: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        raise HTTPException(status_code=500, detail=f"Explanation lookup failed: {str(e)}")
 
 # ==================== FAST PREDICTION ENDPOINT (NO LIME) ====================
 
+def index_case(image_hash, features, result):
+    """Add a finished prediction to the similar-case index (runs after the response)"""
+    try:
+        case_index = get_case_index()
+        if case_index is not None:
+            case_index.add(image_hash, features[0], result['hybrid_prediction'], result['hybrid_confidence'])
+    except Exception as e:
+        logger.error(f"Failed to index case {image_hash}: {str(e)}")
+
+def cascade_predict(predictor, image_bytes):
+    """Triage student first (PREDICT_CASCADE=1); full hybrid path when it is not confident.
+
+    Returns (result, features); features is None when the student answered.
+    result['tier'] records which model answered: a student answer carries
+    triage_prediction/triage_confidence, never the cnn_/hybrid_ fields.
+    The saving is time to first answer only: a client that then asks
+    /generate-lime (explain_class=triage_prediction) still runs the full model
+    on every LIME perturbation, so total compute per scan barely changes.
+    """
+    triage = get_triage_classifier(predictor.label_encoder.classes_)
+    if triage is not None:
+        result, decision = triage.triage(image_bytes)
+        if result is not None:
+            return {**result, 'tier': 'triage', 'triage': decision}, None
+    result, features = predictor.predict_with_features(image_bytes)
+    result['tier'] = 'hybrid'
+    if triage is not None:
+        result['triage'] = decision
+    return result, features
+
 @app.post("/predict-fast")
-async def predict_fast_endpoint(file: UploadFile = File(...)):
+async def predict_fast_endpoint(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
     """
     STEP 1: Fast prediction without LIME explanation
     Returns result immediately
@@ -193,35 +534,181 @@ async def predict_fast_endpoint(file: UploadFile = File(...)):
         
         # Read image bytes
         image_bytes = await file.read()
+        image_hash = await run_in_threadpool(image_store.put, image_bytes)
         
         # Get predictor
-        predictor = get_lime_predictor()
+        predictor = await run_in_threadpool(get_lime_predictor)
         
-        # Quick prediction (no LIME)
-        result = predictor.predict(image_bytes)
+        # Quick prediction (no LIME); concurrent uploads of this image share one run
+        async def run_prediction():
+            async with memory_guard("predict", image_bytes):
+                return await run_in_threadpool(cascade_predict, predictor, image_bytes)
+        (result, features), _ = await inflight.do((image_hash, "predict"), run_prediction)
+        if features is not None:
+            background_tasks.add_task(index_case, image_hash, features, result)
         
-        logger.info(f"Fast prediction successful: {result['hybrid_prediction']}")
+        logger.info(f"Fast prediction successful ({result.get('tier', 'hybrid')}): "
+                    f"{result.get('hybrid_prediction', result.get('triage_prediction'))}")
         
         return JSONResponse(content={
             "status": "success",
-            "prediction": result
+            "prediction": result,
+            "tier": result.get('tier', 'hybrid'),
+            "image_hash": image_hash
         })
     
+    except AdmissionRejected as e:
+        raise memory_busy(e)
     except Exception as e:
         logger.error(f"Error in predict_fast_endpoint: {str(e)}")
         logger.error(f"Traceback: {traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Fast prediction failed: {str(e)}")
 
+# ==================== SIMILAR CASES ENDPOINT ====================
+
+@app.post("/similar-cases")
+async def similar_cases_endpoint(file: UploadFile = File(...), k: int = 5):
+    """
+    k most similar prior cases (cosine similarity of hybrid CNN embeddings)
+    Cases are indexed incrementally as /predict-fast predictions happen
+    """
+    try:
+        if not 1 <= k <= 50:
+            raise HTTPException(status_code=400, detail="k must be between 1 and 50")
+        
+        case_index = await run_in_threadpool(get_case_index)
+        if case_index is None:
+            raise HTTPException(status_code=503, detail="Case index disabled (CASE_INDEX_DIR is empty)")
+        
+        image_bytes = await file.read()
+        image_hash = await run_in_threadpool(image_store.put, image_bytes)
+        
+        predictor = await run_in_threadpool(get_lime_predictor)
+        features = await run_in_threadpool(predictor.image_features, image_bytes)
+        similar = await run_in_threadpool(case_index.search, features[0], k, image_hash)
+        
+        return JSONResponse(content={
+            "status": "success",
+            "similar_cases": similar,
+            "index": case_index.stats(),
+            "image_hash": image_hash
+        })
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in similar_cases_endpoint: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        raise HTTPException(status_code=500, detail=f"Similar case search failed: {str(e)}")
+
+# ==================== TILED HIGH-RESOLUTION ENDPOINT ====================
+
+@app.post("/predict-tiled")
+async def predict_tiled_endpoint(
+    file: UploadFile = File(...),
+    tile_budget: int = TILE_BUDGET,
+    skip_healthy: bool = True
+):
+    """
+    Full-resolution analysis: overlapping model-size tiles scored in batched forwards
+    - tile_budget: maximum tiles for this image (larger photos are downscaled to fit)
+    - skip_healthy: skip tiles the autoencoder reconstructs as healthy
+    Returns the image-level diagnosis plus a coarse localization grid
+    """
+    try:
+        if not 1 <= tile_budget <= TILE_MAX_BUDGET:
+            raise HTTPException(status_code=400, detail=f"tile_budget must be between 1 and {TILE_MAX_BUDGET}")
+        
+        image_bytes = await file.read()
+        image_hash = await run_in_threadpool(image_store.put, image_bytes)
+        predictor = await run_in_threadpool(get_lime_predictor)
+        gate = autoencoder if skip_healthy and AUTOENCODER_LOADED else None
+        
+        async def run_tiled():
+            async with memory_guard("tiled", image_bytes, batch_size=TILE_BATCH_SIZE):
+                return await run_in_threadpool(analyze_tiles, predictor, image_bytes, tile_budget, gate, device)
+        result, _ = await inflight.do((image_hash, f"tiled:{tile_budget}:{gate is not None}"), run_tiled)
+        
+        return JSONResponse(content={
+            "status": "success",
+            "prediction": result,
+            "image_hash": image_hash
+        })
+    
+    except HTTPException:
+        raise
+    except AdmissionRejected as e:
+        raise memory_busy(e)
+    except Exception as e:
+        logger.error(f"Error in predict_tiled_endpoint: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        raise HTTPException(status_code=500, detail=f"Tiled prediction failed: {str(e)}")
+
+# ==================== LIVE CAMERA SCREENING (WEBSOCKET) ====================
+
+@app.websocket("/ws/screen")
+async def screen_websocket(websocket: WebSocket):
+    """
+    Live screening while positioning the camera: send compressed frames (JPEG/WebP) as binary messages
+    - frames near-identical to the last processed one are skipped
+    - while a frame is processed only the newest arrival is kept (latest-frame-wins)
+    - each processed frame gets a JSON result (autoencoder gate, prediction, latency);
+      fewer frames are processed, and only the gate runs, when the server is busy
+    """
+    await websocket.accept()
+    if not (startup_state["hybrid_loaded"] and AUTOENCODER_LOADED):
+        await websocket.send_json({"type": "error", "detail": "Models are still loading"})
+        await websocket.close(code=1013)
+        return
+    predictor = await run_in_threadpool(get_lime_predictor)
+    
+    async def process(frame_bytes, gate_only):
+        async with memory_guard("predict", frame_bytes):
+            return await run_in_threadpool(screen_frame, autoencoder, device, predictor, frame_bytes, gate_only)
+    
+    async with ScreeningSession(process, websocket.send_json) as session:
+        worker = asyncio.create_task(session.run())
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                if message.get("bytes") is None:
+                    await websocket.send_json({"type": "error", "detail": "Send frames as binary messages"})
+                    continue
+                error = await session.on_frame(message["bytes"])
+                if error is not None:
+                    await websocket.send_json(error)
+        except Exception as e:
+            logger.error(f"Screening session error: {str(e)}")
+        finally:
+            worker.cancel()
+            with suppress(asyncio.CancelledError, Exception):
+                await worker
+            logger.info(f"Screening session closed: {session.stats}")
+
+@app.get("/screening/stats")
+async def screening_stats_endpoint():
+    """Live screening sessions and frames received, skipped as duplicates, dropped and processed"""
+    return screening_stats.snapshot()
+
 # ==================== LIME GENERATION ENDPOINT (SEPARATE) ====================
 
 @app.post("/generate-lime")
 async def generate_lime_endpoint(
     file: UploadFile = File(...),
-    num_samples: int = 300
+    num_samples: int = 300,
+    image_delivery: str = "inline",
+    explain_target: str = LIME_EXPLAIN_TARGET,
+    explain_class: str | None = None
 ):
     """
     STEP 2: Generate LIME explanation separately (can be called after fast prediction)
     This takes longer but provides interpretability
+    Under load, samples/segments/DPI may be lowered to meet LIME_SLO_SECONDS; "quality" says what was delivered
+    image_delivery="url" omits the base64 figure; fetch explanation_url instead
+    explain_target="hybrid" explains the LightGBM diagnosis, "cnn" the CNN-only head
+    explain_class explains the label /predict-fast returned (pass it for tier="triage" answers)
     """
     try:
         if not 100 <= num_samples <= 1000:
@@ -229,29 +716,47 @@ async def generate_lime_endpoint(
                 status_code=400, 
                 detail="num_samples must be between 100 and 1000"
             )
+        validate_image_delivery(image_delivery)
+        if explain_target not in EXPLAIN_TARGETS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"explain_target must be one of {', '.join(EXPLAIN_TARGETS)}"
+            )
+        
+        if explain_class is not None:
+            predictor = await run_in_threadpool(get_lime_predictor)
+            if explain_class not in predictor.label_encoder.classes_:
+                raise HTTPException(status_code=400, detail=f"Unknown explain_class '{explain_class}'")
         
         logger.info(f"LIME generation - File: {file.filename}, Samples: {num_samples}")
         
         # Read image bytes
         image_bytes = await file.read()
-        
-        # Get predictor
-        predictor = get_lime_predictor()
+        image_hash = await run_in_threadpool(image_store.put, image_bytes)
         
         # Generate LIME explanation
-        result = predictor.predict_with_lime(image_bytes, num_samples=num_samples)
+        result, hit, fields = await explain_with_quality(
+            image_bytes, image_hash, num_samples, explain_target, image_delivery, explain_class
+        )
         
-        logger.info(f"LIME explanation generated successfully")
+        logger.info("LIME explanation generated successfully")
         
         return JSONResponse(content={
             "status": "success",
-            "explanation_image": result['explanation_image'],
+            **fields,
             "lime_statistics": result['lime_statistics'],
-            "num_samples": result['num_samples']
+            "num_samples": result['num_samples'],
+            "explained_model": result['explained_model'],
+            "explained_class": result.get('explained_class'),
+            "explanation_timing": result['explanation_timing'],
+            "image_hash": image_hash,
+            "near_duplicate": near_duplicate_flag(hit)
         })
     
     except HTTPException:
         raise
+    except AdmissionRejected as e:
+        raise memory_busy(e)
     except Exception as e:
         logger.error(f"Error in generate_lime_endpoint: {str(e)}")
         logger.error(f"Traceback: {traceback.format_exc()}")
@@ -262,10 +767,14 @@ async def generate_lime_endpoint(
 @app.post("/predict-with-lime")
 async def predict_with_lime_endpoint(
     file: UploadFile = File(...),
-    num_samples: int = 300
+    num_samples: int = 300,
+    image_delivery: str = "inline",
+    explain_target: str = LIME_EXPLAIN_TARGET
 ):
     """
     Original endpoint: Prediction with LIME explanation (slow but complete)
+    image_delivery="url" omits the base64 figure; fetch explanation_url instead
+    explain_target="hybrid" explains the LightGBM diagnosis, "cnn" the CNN-only head
     """
     try:
         if not 100 <= num_samples <= 1000:
@@ -273,21 +782,34 @@ async def predict_with_lime_endpoint(
                 status_code=400, 
                 detail="num_samples must be between 100 and 1000"
             )
+        validate_image_delivery(image_delivery)
+        if explain_target not in EXPLAIN_TARGETS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"explain_target must be one of {', '.join(EXPLAIN_TARGETS)}"
+            )
         
         logger.info(f"LIME with Explanation - File: {file.filename}, Samples: {num_samples}")
         
         image_bytes = await file.read()
-        predictor = get_lime_predictor()
-        result = predictor.predict_with_lime(image_bytes, num_samples=num_samples)
+        image_hash = await run_in_threadpool(image_store.put, image_bytes)
+        result, hit, fields = await explain_with_quality(
+            image_bytes, image_hash, num_samples, explain_target, image_delivery
+        )
         
         logger.info(f"LIME explanation generated for: {result['prediction']['hybrid_prediction']}")
         return JSONResponse(content={
             "status": "success",
-            **result
+            **result,
+            **fields,
+            "image_hash": image_hash,
+            "near_duplicate": near_duplicate_flag(hit)
         })
     
     except HTTPException:
         raise
+    except AdmissionRejected as e:
+        raise memory_busy(e)
     except Exception as e:
         logger.error(f"Error in predict_with_lime_endpoint: {str(e)}")
         logger.error(f"Traceback: {traceback.format_exc()}")
@@ -298,25 +820,47 @@ async def predict_with_lime_endpoint(
 class ChatRequest(BaseModel):
     prompt: str
     image: str | None = None
+    # Content hash (image_hash) returned by an analysis endpoint, instead of re-sending the image
+    image_ref: str | None = None
 
 @app.post("/chat-stream")
-async def chat_stream(request: ChatRequest):
-    def event_generator():
+async def chat_stream(request: ChatRequest, http_request: Request):
+    image_bytes = None
+    if request.image_ref:
+        image_bytes = await run_in_threadpool(image_store.get, request.image_ref)
+        if image_bytes is None:
+            raise HTTPException(
+                status_code=404,
+                detail="Unknown or expired image_ref; send the image instead"
+            )
+
+    async def event_generator():
+        stream = stream_response(request.prompt, request.image, image_bytes=image_bytes)
         try:
-            for chunk in stream_response(request.prompt, request.image):
+            async for chunk in stream:
+                if await http_request.is_disconnected():
+                    logger.info("Chat client disconnected, cancelling upstream stream")
+                    break
                 yield chunk
         except Exception as e:
             yield f"Error: {str(e)}"
+        finally:
+            await stream.aclose()
 
     return StreamingResponse(event_generator(), media_type="text/plain")
 
+@app.get("/chat/cache/stats")
+async def chat_cache_stats():
+    """Hit rate and upstream latency saved by the chat response cache"""
+    return chat_cache.stats()
+
 # ==================== HEALTH CHECK ENDPOINTS ====================
 
 @app.get("/lime/health")
 async def lime_health_check():
     """Check if LIME model is loaded and ready"""
     try:
-        predictor = get_lime_predictor()
+        predictor = await run_in_threadpool(get_lime_predictor)
         return {
             "status": "healthy",
             "model_loaded": True,
@@ -345,6 +889,58 @@ async def autoencoder_health_check():
             detail="Autoencoder model not loaded"
         )
 
+@app.get("/near-duplicates/stats")
+async def near_duplicate_stats():
+    """Perceptual-hash reuse hit rate per operation"""
+    return near_duplicates.stats()
+
+@app.get("/metrics/memory")
+async def memory_metrics_endpoint():
+    """Per-operation memory peaks (RSS delta, Python, torch CUDA; null on CPU) and admission state"""
+    return {"operations": memory_metrics.snapshot(), "admission": memory_admission.stats()}
+
+@app.get("/inflight/stats")
+async def inflight_stats():
+    """Single-flight coalescing: endpoint calls shared, plus predictor memo hit counts"""
+    predictor = get_lime_predictor() if startup_state["hybrid_loaded"] else None
+    return {
+        "endpoints": inflight.stats(),
+        "predictor": predictor.memo_stats() if predictor else None,
+    }
+
+@app.get("/explanations/quality")
+async def explanation_quality_stats():
+    """Adaptive quality controller: latency model and quality levels delivered"""
+    return quality_controller.stats()
+
+@app.get("/serving/topology")
+async def serving_topology():
+    """This worker's core partition, pinning and per-slot thread counts"""
+    return serving_state
+
+@app.get("/explanations/stats")
+async def explanation_store_stats():
+    """Stored LIME explanations: memory/disk hits and misses"""
+    return explanation_registry.stats()
+
+@app.get("/ready")
+async def readiness_check():
+    """Readiness probe: 200 only once every model is built and warmed"""
+    ready = startup_state["complete"] and startup_state["hybrid_loaded"] and AUTOENCODER_LOADED
+    body = {
+        "status": "ready" if ready else "not_ready",
+        "startup_complete": startup_state["complete"],
+        "models_loaded": {
+            "autoencoder": AUTOENCODER_LOADED,
+            "hybrid_model": startup_state["hybrid_loaded"]
+        },
+        "startup_phases": STARTUP_PHASES,
+        "startup_seconds": round(sum(STARTUP_PHASES.values()), 4)
+    }
+    if startup_state["error"]:
+        body["error"] = startup_state["error"]
+    return JSONResponse(content=body, status_code=200 if ready else 503)
+
 @app.get("/")
 async def root():
     return {
@@ -356,24 +952,31 @@ async def root():
         },
         "endpoints": {
             "validation": {
-                "/validate-autoencoder": "Check if teeth are healthy or diseased ✓"
+                "/validate-autoencoder": "Check if teeth are healthy or diseased ✓",
+                "/validate-autoencoder-batch": "Score several images in one autoencoder pass"
             },
             "prediction": {
                 "/predict-fast": "Fast prediction (CNN + LightGBM, no LIME) ⚡",
+                "/predict-tiled": "Full-resolution tiled analysis with a localization grid",
+                "/ws/screen": "Live camera screening over WebSocket",
                 "/generate-lime": "Generate LIME explanation separately 🔍",
-                "/predict-with-lime": "Complete prediction with LIME (slower) 📊"
+                "/predict-with-lime": "Complete prediction with LIME (slower) 📊",
+                "/similar-cases": "Most similar prior cases for an image"
             },
             "chatbot": {
-                "/chat-stream": "Streaming chatbot responses 💬"
+                "/chat-stream": "Streaming chatbot responses 💬",
+                "/chat/cache/stats": "Chat response cache hit rate and latency saved"
             },
             "health": {
                 "/lime/health": "Check hybrid model status",
-                "/autoencoder/health": "Check autoencoder model status"
+                "/autoencoder/health": "Check autoencoder model status",
+                "/health": "Liveness probe",
+                "/ready": "Readiness probe with startup timings by phase"
             }
         },
         "models_loaded": {
             "autoencoder": AUTOENCODER_LOADED,
-            "hybrid_model": True
+            "hybrid_model": startup_state["hybrid_loaded"]
         }
     }
 
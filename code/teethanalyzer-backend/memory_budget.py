@@ -0,0 +1,294 @@
+# memory_budget.py - Per-request memory accounting and memory-budget admission control
+import os
+import io
+import time
+import asyncio
+import threading
+import tracemalloc
+import logging
+from contextlib import asynccontextmanager, contextmanager
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Bytes this worker may reserve for in-flight requests (on top of the loaded models).
+# Unset: 80% of the container limit left after startup; 0 disables admission control.
+MEMORY_BUDGET_MB = os.getenv("MEMORY_BUDGET_MB")
+# "queue" waits for memory to free up (up to MEMORY_QUEUE_TIMEOUT seconds); "reject" answers 503 at once
+MEMORY_ADMISSION_MODE = os.getenv("MEMORY_ADMISSION_MODE", "queue")
+MEMORY_QUEUE_TIMEOUT = float(os.getenv("MEMORY_QUEUE_TIMEOUT", "30"))
+# Also trace Python allocations (tracemalloc adds ~10-30% CPU overhead to allocation-heavy code)
+MEMORY_TRACE_PYTHON = os.getenv("MEMORY_TRACE_PYTHON", "0") == "1"
+RSS_SAMPLE_INTERVAL = float(os.getenv("MEMORY_RSS_SAMPLE_INTERVAL", "0.01"))
+
+MB = 1024 * 1024
+
+# ==================== COST ESTIMATES ====================
+# Coefficients are deliberately conservative; /metrics/memory reports the
+# measured peak next to each estimate so they can be tuned.
+
+CNN_ACTIVATION_BYTES = 40 * MB   # EfficientNetV2-S inference activations per 260x260 image
+FIGURE_BYTES = 3000 * 1800 * 4 * 3  # 20x12 in @ 150 dpi RGBA canvas plus encode copies
+REQUEST_OVERHEAD_BYTES = 32 * MB
+
+def image_dimensions(image_bytes):
+    """(width, height) from the image header, without decoding pixels"""
+    try:
+        return Image.open(io.BytesIO(image_bytes)).size
+    except Exception:
+        return None
+
+def estimate_request_bytes(operation, image_size, num_samples=0, batch_size=32):
+    """Rough peak memory of one request from the image dimensions and LIME settings"""
+    width, height = image_size or (4000, 3000)
+    pixels = width * height
+    decoded = pixels * 3 * 3  # PIL image + NumPy copies
+    if operation == "predict":
+        return REQUEST_OVERHEAD_BYTES + decoded + CNN_ACTIVATION_BYTES
+    if operation == "tiled":
+        tiles = pixels * 3 * 2  # downscaled analysis copy + cropped tiles
+        return REQUEST_OVERHEAD_BYTES + decoded + tiles + batch_size * CNN_ACTIVATION_BYTES
+    if operation == "lime":
+        segmentation = pixels * 3 * 8 * 3      # slic works on float64 RGB/Lab copies
+        perturbations = batch_size * pixels * 4  # uint8 batch buffer + hidden mask
+        # hybrid_probabilities copies every perturbation (astype(uint8)) and wraps it in a PIL image
+        perturbation_copies = batch_size * pixels * 3 * 2
+        sample_matrix = num_samples * 64 * 8
+        return (REQUEST_OVERHEAD_BYTES + decoded + segmentation + perturbations + perturbation_copies
+                + sample_matrix + batch_size * CNN_ACTIVATION_BYTES + FIGURE_BYTES)
+    return REQUEST_OVERHEAD_BYTES + decoded
+
+# ==================== MEASUREMENT ====================
+
+def current_rss():
+    """Resident set size of this process in bytes, or None where /proc is unavailable"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+def container_memory_limit():
+    """cgroup (v2, then v1) memory limit in bytes, or None when unlimited/unknown"""
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path, "r") as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value.isdigit() and int(value) < (1 << 60):
+            return int(value)
+    return None
+
+class _RssSampler:
+    """One background thread sampling RSS while any request is being tracked"""
+
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            rss = current_rss()
+            with self._lock:
+                if not self._active:
+                    self._thread = None
+                    return
+                for usage in self._active.values():
+                    usage["rss_peak"] = max(usage["rss_peak"], rss)
+            time.sleep(self.interval)
+
+    def register(self, usage):
+        with self._lock:
+            self._active[id(usage)] = usage
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+                self._thread.start()
+
+    def unregister(self, usage):
+        with self._lock:
+            self._active.pop(id(usage), None)
+
+_rss_sampler = _RssSampler()
+
+if MEMORY_TRACE_PYTHON:
+    tracemalloc.start()
+
+def _torch_cuda_peak():
+    """Peak CUDA bytes allocated by torch, or None on CPU (the torch CPU allocator keeps no
+    statistics; CPU tensors show up in the request's RSS delta instead)"""
+    try:
+        import torch
+        if torch.cuda.is_available():
+            return torch.cuda.max_memory_allocated()
+    except Exception:
+        pass
+    return None
+
+@contextmanager
+def track_memory(operation, estimate=None):
+    """Measure a request's RSS increase, Python allocation peak and torch CUDA peak.
+
+    Concurrent requests share one process (and one tracemalloc peak), so under
+    concurrency these figures are approximate and attribute overlapping work.
+    """
+    rss_start = current_rss()
+    usage = {"rss_peak": rss_start or 0}
+    if rss_start is not None:
+        _rss_sampler.register(usage)
+    traced_start = None
+    if tracemalloc.is_tracing():
+        traced_start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    torch_start = _torch_cuda_peak()
+    start = time.perf_counter()
+    try:
+        yield usage
+    finally:
+        _rss_sampler.unregister(usage)
+        sample = {"seconds": time.perf_counter() - start, "estimate_bytes": estimate}
+        if rss_start is not None:
+            sample["rss_delta_bytes"] = max(0, max(usage["rss_peak"], current_rss() or 0) - rss_start)
+        if traced_start is not None:
+            sample["python_peak_bytes"] = max(0, tracemalloc.get_traced_memory()[1] - traced_start)
+        torch_end = _torch_cuda_peak()
+        # Null on CPU deployments rather than implying torch memory was measured
+        sample["torch_cuda_peak_bytes"] = (
+            max(0, torch_end - torch_start) if torch_start is not None and torch_end is not None else None
+        )
+        memory_metrics.record(operation, sample)
+
+class MemoryMetrics:
+    """Per-operation aggregates of tracked requests"""
+
+    FIELDS = ("rss_delta_bytes", "python_peak_bytes", "torch_cuda_peak_bytes")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._operations = {}
+
+    def record(self, operation, sample):
+        with self._lock:
+            stats = self._operations.setdefault(operation, {"requests": 0, "last": None})
+            stats["requests"] += 1
+            stats["last"] = sample
+            for field in self.FIELDS:
+                value = sample.get(field)
+                if value is None:
+                    continue
+                stats[f"max_{field}"] = max(stats.get(f"max_{field}", 0), value)
+                stats[f"sum_{field}"] = stats.get(f"sum_{field}", 0) + value
+            estimate = sample.get("estimate_bytes")
+            if estimate and sample.get("rss_delta_bytes") is not None:
+                ratio = sample["rss_delta_bytes"] / estimate
+                stats["max_measured_to_estimate"] = max(stats.get("max_measured_to_estimate", 0.0), ratio)
+
+    def snapshot(self):
+        with self._lock:
+            result = {}
+            for operation, stats in self._operations.items():
+                summary = {k: v for k, v in stats.items() if not k.startswith("sum_")}
+                for field in self.FIELDS:
+                    if f"sum_{field}" in stats:
+                        summary[f"mean_{field}"] = stats[f"sum_{field}"] / stats["requests"]
+                result[operation] = summary
+        result["rss_bytes"] = current_rss()
+        return result
+
+memory_metrics = MemoryMetrics()
+
+# ==================== ADMISSION CONTROL ====================
+
+class AdmissionRejected(Exception):
+    """A request could not get its memory reservation (budget full or queue timeout)"""
+
+class MemoryAdmission:
+    """Reserve a request's estimated bytes before running it; wait or reject when over budget.
+
+    A request estimated above the whole budget is admitted only when nothing
+    else holds a reservation, so it can still run, alone.
+    """
+
+    def __init__(self, budget_bytes=None, mode=MEMORY_ADMISSION_MODE, queue_timeout=MEMORY_QUEUE_TIMEOUT):
+        self._budget_bytes = budget_bytes
+        self.mode = mode
+        self.queue_timeout = queue_timeout
+        self.reserved = 0
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._condition = None
+
+    @property
+    def budget_bytes(self):
+        if self._budget_bytes is None:
+            if MEMORY_BUDGET_MB is not None:
+                self._budget_bytes = int(float(MEMORY_BUDGET_MB) * MB)
+            else:
+                limit = container_memory_limit()
+                rss = current_rss()
+                self._budget_bytes = int(0.8 * (limit - rss)) if limit and rss and limit > rss else 0
+            logger.info(f"Memory budget for requests: {self._budget_bytes / MB:.0f} MB "
+                        f"({'disabled' if not self._budget_bytes else self.mode})")
+        return self._budget_bytes
+
+    def _fits(self, estimate):
+        return self.in_flight == 0 or self.reserved + estimate <= self.budget_bytes
+
+    @asynccontextmanager
+    async def admit(self, estimate):
+        if not self.budget_bytes:
+            yield
+            return
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            if not self._fits(estimate):
+                if self.mode == "reject":
+                    self.rejected += 1
+                    raise AdmissionRejected(f"Memory budget exhausted ({self.reserved / MB:.0f} MB reserved)")
+                self.waiting += 1
+                try:
+                    await asyncio.wait_for(
+                        self._condition.wait_for(lambda: self._fits(estimate)), self.queue_timeout
+                    )
+                except asyncio.TimeoutError:
+                    self.rejected += 1
+                    raise AdmissionRejected(f"Timed out waiting {self.queue_timeout:.0f}s for memory budget")
+                finally:
+                    self.waiting -= 1
+            self.reserved += estimate
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self.reserved -= estimate
+                self.in_flight -= 1
+                self._condition.notify_all()
+
+    def stats(self):
+        return {
+            "budget_bytes": self.budget_bytes,
+            "mode": self.mode,
+            "reserved_bytes": self.reserved,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+        }
+
+memory_admission = MemoryAdmission()
+
+@asynccontextmanager
+async def memory_guard(operation, image_bytes, num_samples=0, batch_size=32):
+    """Admit a request against the memory budget, then track what it actually used.
+
+    batch_size is the number of images the operation scores per forward (LIME:
+    perturbations handed to the classifier at once; tiled: tiles per batch).
+    """
+    estimate = estimate_request_bytes(operation, image_dimensions(image_bytes), num_samples, batch_size)
+    async with memory_admission.admit(estimate):
+        with track_memory(operation, estimate) as usage:
+            yield usage
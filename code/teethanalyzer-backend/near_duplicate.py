@@ -0,0 +1,113 @@
+# near_duplicate.py - Perceptual-hash reuse of LIME explanations for near-identical uploads
+import os
+import io
+import threading
+import logging
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Max Hamming distance (out of 64 bits) for two uploads to be a near-duplicate candidate;
+# negative (the default) disables near-duplicate reuse. A 64-bit hash of a 9x8
+# thumbnail can collide for different patients' photos with similar framing, so
+# candidates are only reused once their embeddings confirm the match.
+NEAR_DUPLICATE_MAX_DISTANCE = int(os.getenv("NEAR_DUPLICATE_MAX_DISTANCE", "-1"))
+# Minimum cosine similarity of the hybrid CNN embeddings to confirm a candidate
+NEAR_DUPLICATE_MIN_SIMILARITY = float(os.getenv("NEAR_DUPLICATE_MIN_SIMILARITY", "0.98"))
+# Results remembered per operation (oldest dropped first)
+NEAR_DUPLICATE_CAPACITY = int(os.getenv("NEAR_DUPLICATE_CAPACITY", "2048"))
+
+def dhash(image_bytes, hash_size=8):
+    """64-bit difference hash of the decoded image.
+
+    Robust to recompression, resizing and small crops, unlike a byte hash.
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    image.draft('L', (hash_size * 8, hash_size * 8))  # cheap JPEG downscale on decode
+    image = image.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = np.asarray(image, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int(np.packbits(bits).view('>u8')[0])
+
+def _unit(embedding):
+    vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+    return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+class NearDuplicateIndex:
+    """Per-operation table of (perceptual hash -> stored result), searched by Hamming distance.
+
+    The hash only nominates candidates; a result is reused when the upload's
+    embedding is also within NEAR_DUPLICATE_MIN_SIMILARITY of the stored one.
+    """
+
+    def __init__(self, max_distance=NEAR_DUPLICATE_MAX_DISTANCE, capacity=NEAR_DUPLICATE_CAPACITY,
+                 min_similarity=NEAR_DUPLICATE_MIN_SIMILARITY):
+        self.max_distance = max_distance
+        self.capacity = capacity
+        self.min_similarity = min_similarity
+        self._tables = {}  # operation -> {"hashes": np.uint64 array, "entries": list}
+        self._lock = threading.Lock()
+        self._stats = {"lookups": 0, "candidates": 0, "hits": 0, "rejected": 0}
+
+    @property
+    def enabled(self):
+        return self.max_distance >= 0
+
+    def has_candidates(self, phash, operation):
+        """Whether any stored hash is within max_distance (cheap pre-check before embedding)"""
+        if not self.enabled:
+            return False
+        with self._lock:
+            table = self._tables.get(operation)
+            if table is None or not len(table["hashes"]):
+                return False
+            return bool(np.bitwise_count(table["hashes"] ^ np.uint64(phash)).min() <= self.max_distance)
+
+    def lookup(self, phash, operation, embedding):
+        """Closest confirmed result as (result, distance, image_hash, similarity), or None"""
+        if not self.enabled:
+            return None
+        query = _unit(embedding)
+        with self._lock:
+            self._stats["lookups"] += 1
+            table = self._tables.get(operation)
+            if table is None or not len(table["hashes"]):
+                return None
+            distances = np.bitwise_count(table["hashes"] ^ np.uint64(phash))
+            candidates = np.flatnonzero(distances <= self.max_distance)
+            if not len(candidates):
+                return None
+            self._stats["candidates"] += 1
+            for i in candidates[np.argsort(distances[candidates], kind="stable")]:
+                result, image_hash, stored = table["entries"][i]
+                similarity = float(stored @ query)
+                if similarity >= self.min_similarity:
+                    self._stats["hits"] += 1
+                    return result, int(distances[i]), image_hash, similarity
+            self._stats["rejected"] += 1
+            return None
+
+    def add(self, phash, operation, result, image_hash, embedding):
+        if not self.enabled:
+            return
+        with self._lock:
+            table = self._tables.setdefault(
+                operation, {"hashes": np.empty(0, dtype=np.uint64), "entries": []}
+            )
+            table["hashes"] = np.append(table["hashes"], np.uint64(phash))
+            table["entries"].append((result, image_hash, _unit(embedding)))
+            if len(table["entries"]) > self.capacity:
+                table["hashes"] = table["hashes"][-self.capacity:]
+                table["entries"] = table["entries"][-self.capacity:]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = {op: len(t["entries"]) for op, t in self._tables.items()}
+        stats["hit_rate"] = stats["hits"] / stats["lookups"] if stats["lookups"] else 0.0
+        stats["max_distance"] = self.max_distance
+        stats["min_similarity"] = self.min_similarity
+        return stats
+
+near_duplicates = NearDuplicateIndex()
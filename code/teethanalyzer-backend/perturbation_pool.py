@@ -0,0 +1,208 @@
+# perturbation_pool.py - Parallel evaluation of LIME perturbations across CPU cores
+import os
+import time
+import argparse
+import threading
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, shared_memory
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Worker processes for LIME perturbations; 0 evaluates them serially in-process
+LIME_WORKERS = int(os.getenv("LIME_WORKERS", "0"))
+# Torch threads per worker; 0 = one per core pinned to that worker
+LIME_WORKER_THREADS = int(os.getenv("LIME_WORKER_THREADS", "0"))
+# Perturbations each worker scores per predict_fn call (one batched forward)
+LIME_SHARD_SIZE = int(os.getenv("LIME_SHARD_SIZE", "25"))
+
+MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+# ==================== WORKER PROCESS ====================
+
+_worker_model = None
+
+def _init_worker(model_path, cores, threads):
+    """Pin the worker to its cores and load a read-only CNN.
+
+    The checkpoint is memory-mapped and assigned (not copied) into the model, so
+    all workers share the weights through the page cache.
+    """
+    global _worker_model
+    import torch
+    from lime_inference import EfficientNetV2Classifier
+
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+
+    checkpoint = torch.load(model_path, map_location="cpu", mmap=True)
+    model = EfficientNetV2Classifier(num_classes=checkpoint['num_classes'], pretrained=False, fine_tune=True)
+    model.load_state_dict(checkpoint['model_state_dict'], assign=True)
+    model.eval()
+    _worker_model = model
+
+def _score_shard(shm_name, shape, start, end, output):
+    """CNN softmax probabilities ("probabilities") or 1024-dim hybrid features ("features")
+    for perturbations [start, end) of the shared uint8 batch"""
+    import torch
+    import torch.nn.functional as F
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    batch = None
+    try:
+        batch = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)[start:end]
+        x = (batch.astype(np.float32) / 255.0 - MEAN) / STD
+    finally:
+        batch = None  # release the view before closing the mapping
+        shm.close()
+    x = torch.from_numpy(np.ascontiguousarray(x.transpose(0, 3, 1, 2)))
+    with torch.inference_mode():
+        if output == "features":
+            return _worker_model.extract_features(x).numpy()
+        return F.softmax(_worker_model(x), dim=1).numpy()
+
+# ==================== PARENT SIDE ====================
+
+def _core_sets(workers):
+    """Split the cores this process may use into `workers` disjoint contiguous sets"""
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    per_worker = max(1, len(cores) // workers)
+    return [cores[(i * per_worker) % len(cores):][:per_worker] for i in range(workers)]
+
+class PerturbationPool:
+    """Scores LIME perturbation batches on single-process executors pinned to disjoint cores.
+
+    The parent resizes each perturbation to the CNN input size into one shared
+    memory block; shard i always goes to worker i and shard results are
+    concatenated in order, so the output matches serial evaluation order.
+    """
+
+    def __init__(self, model_path, image_size, workers, threads=LIME_WORKER_THREADS, shard_size=LIME_SHARD_SIZE):
+        self.image_size = image_size
+        self.workers = workers
+        self.shard_size = shard_size
+        context = get_context("spawn")  # never fork a process holding torch threads
+        self._executors = []
+        for cores in _core_sets(workers):
+            self._executors.append(ProcessPoolExecutor(
+                max_workers=1, mp_context=context, initializer=_init_worker,
+                initargs=(model_path, cores, threads or len(cores)),
+            ))
+        logger.info(f"LIME perturbation pool started with {workers} workers")
+
+    @property
+    def batch_size(self):
+        """Perturbations LIME should hand to predict_fn at once"""
+        return self.workers * self.shard_size
+
+    def warmup(self):
+        """Start every worker and load its model (spawn + import is slow)"""
+        height, width = self.image_size
+        dummy = np.zeros((self.workers, height, width, 3), dtype=np.uint8)
+        self.predict_fn(dummy)
+
+    def predict_fn(self, images):
+        """LIME classifier_fn: (N, H, W, 3) perturbations -> (N, num_classes) CNN probabilities"""
+        return self._run_shards(images, "probabilities")
+
+    def features_fn(self, images):
+        """(N, H, W, 3) perturbations -> (N, 1024) hybrid features (for LightGBM in the parent)"""
+        return self._run_shards(images, "features")
+
+    def _run_shards(self, images, output):
+        height, width = self.image_size
+        shape = (len(images), height, width, 3)
+        shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+        batch = None
+        try:
+            batch = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+            # Same resize as the serial path's transforms.Resize on a PIL image
+            for i, img in enumerate(images):
+                pil_img = Image.fromarray(img.astype(np.uint8))
+                batch[i] = np.asarray(pil_img.resize((width, height), Image.BILINEAR))
+
+            bounds = np.linspace(0, len(images), num=min(self.workers, len(images)) + 1).astype(int)
+            futures = [
+                executor.submit(_score_shard, shm.name, shape, int(start), int(end), output)
+                for executor, start, end in zip(self._executors, bounds[:-1], bounds[1:])
+            ]
+            return np.concatenate([future.result() for future in futures])
+        finally:
+            batch = None  # release the view before closing the mapping
+            shm.close()
+            shm.unlink()
+
+    def shutdown(self):
+        for executor in self._executors:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+# Global instance (lazy initialization)
+_perturbation_pool = None
+_perturbation_pool_lock = threading.Lock()
+
+def get_perturbation_pool():
+    """Get or create the pool, or None when LIME_WORKERS is 0"""
+    global _perturbation_pool
+    if _perturbation_pool is None and LIME_WORKERS > 0:
+        with _perturbation_pool_lock:
+            if _perturbation_pool is None:
+                from lime_inference import IMAGE_SIZE, MODEL_PATH
+                _perturbation_pool = PerturbationPool(MODEL_PATH, IMAGE_SIZE, LIME_WORKERS)
+    return _perturbation_pool
+
+def shutdown_perturbation_pool():
+    global _perturbation_pool
+    if _perturbation_pool is not None:
+        _perturbation_pool.shutdown()
+        _perturbation_pool = None
+
+# ==================== SCALING BENCHMARK ====================
+
+def benchmark(image_path, num_samples, worker_counts):
+    """Wall-clock time of one explanation's perturbation scoring per worker count"""
+    from lime_inference import IMAGE_SIZE, MODEL_PATH
+
+    rng = np.random.RandomState(42)
+    image = np.asarray(Image.open(image_path).convert('RGB'))
+    images = np.repeat(image[None], num_samples, axis=0)
+    images[rng.rand(num_samples, *image.shape[:2]) < 0.5] = 0  # stand-in for hidden superpixels
+
+    results = {}
+    reference = None
+    for workers in worker_counts:
+        pool = PerturbationPool(MODEL_PATH, IMAGE_SIZE, workers)
+        try:
+            pool.warmup()
+            start = time.perf_counter()
+            probs = np.concatenate([
+                pool.predict_fn(images[i:i + pool.batch_size])
+                for i in range(0, num_samples, pool.batch_size)
+            ])
+            elapsed = time.perf_counter() - start
+        finally:
+            pool.shutdown()
+        if reference is None:
+            reference = probs
+        results[workers] = {
+            "seconds": round(elapsed, 3),
+            "max_abs_diff_vs_first": float(np.abs(probs - reference).max()),
+        }
+        print(f"{workers} workers: {elapsed:.2f}s")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="LIME perturbation pool scaling benchmark")
+    parser.add_argument("image")
+    parser.add_argument("--samples", type=int, default=1000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print(benchmark(args.image, args.samples, args.workers))
@@ -0,0 +1,153 @@
+# quality.py - Latency-SLO-aware adaptive LIME explanation quality
+import os
+import threading
+import logging
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+# End-to-end latency target for one explanation request
+LIME_SLO_SECONDS = float(os.getenv("LIME_SLO_SECONDS", "20"))
+# "0" always delivers the requested quality
+LIME_ADAPTIVE_QUALITY = os.getenv("LIME_ADAPTIVE_QUALITY", "1") == "1"
+# Explain target used at the lowest quality level when set (e.g. "cnn" or "hybrid")
+LIME_FALLBACK_TARGET = os.getenv("LIME_FALLBACK_TARGET", "")
+# Weight of the newest observation in the latency moving averages
+EWMA_ALPHA = 0.3
+
+DEFAULT_N_SEGMENTS = 50
+DEFAULT_INLINE_DPI = 150
+MIN_SAMPLES = 50
+
+# Quality ladder: fraction of the requested samples, SLIC segments, inline figure DPI
+QUALITY_LEVELS = [
+    {"name": "full", "sample_fraction": 1.0, "n_segments": DEFAULT_N_SEGMENTS, "inline_dpi": DEFAULT_INLINE_DPI},
+    {"name": "reduced", "sample_fraction": 0.5, "n_segments": DEFAULT_N_SEGMENTS, "inline_dpi": 120},
+    {"name": "low", "sample_fraction": 0.25, "n_segments": 35, "inline_dpi": 100},
+    {"name": "minimal", "sample_fraction": 0.1, "n_segments": 25, "inline_dpi": 72},
+]
+
+class AdaptiveQualityController:
+    """Picks the best explanation quality whose predicted latency meets the SLO.
+
+    Latency model, from moving averages of completed explanations:
+    (in-flight explanations + 1) * (fixed cost + samples * per-sample cost)
+    + inline render cost (scaled with DPI^2). Concurrent explanations share the
+    CPU, so each one ahead of a request roughly adds its own duration.
+    """
+
+    def __init__(self, slo_seconds=LIME_SLO_SECONDS, enabled=LIME_ADAPTIVE_QUALITY,
+                 fallback_target=LIME_FALLBACK_TARGET):
+        self.slo_seconds = slo_seconds
+        self.enabled = enabled
+        self.fallback_target = fallback_target or None
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._fixed_seconds = {}      # target -> EWMA of non-classifier seconds
+        self._per_sample_seconds = {} # target -> EWMA of classifier seconds per sample
+        self._render_seconds_150dpi = None
+        self._delivered = {level["name"]: 0 for level in QUALITY_LEVELS}
+
+    @staticmethod
+    def _ewma(previous, value):
+        return value if previous is None else (1 - EWMA_ALPHA) * previous + EWMA_ALPHA * value
+
+    def _predict_seconds(self, samples, target, dpi, queue_depth):
+        fixed = self._fixed_seconds.get(target)
+        per_sample = self._per_sample_seconds.get(target)
+        if fixed is None or per_sample is None:
+            return None
+        explain = fixed + samples * per_sample
+        render = 0.0
+        if self._render_seconds_150dpi is not None:
+            render = self._render_seconds_150dpi * (dpi / DEFAULT_INLINE_DPI) ** 2
+        return (queue_depth + 1) * explain + render
+
+    def plan(self, requested_samples, target, queue_depth=None):
+        """Quality to deliver for a request: effective samples, segments, DPI and target"""
+        queue_depth = self.in_flight if queue_depth is None else queue_depth
+        chosen, predicted = None, None
+        with self._lock:
+            for index, level in enumerate(QUALITY_LEVELS):
+                samples = max(MIN_SAMPLES, min(requested_samples, round(requested_samples * level["sample_fraction"])))
+                level_target = target
+                if index == len(QUALITY_LEVELS) - 1 and self.fallback_target:
+                    level_target = self.fallback_target
+                predicted = self._predict_seconds(samples, level_target, level["inline_dpi"], queue_depth)
+                chosen = (index, level, samples, level_target)
+                # No history yet (or adaptation off): deliver full quality
+                if not self.enabled or predicted is None or predicted <= self.slo_seconds:
+                    break
+            index, level, samples, level_target = chosen
+            self._delivered[level["name"]] += 1
+        return {
+            "level": index,
+            "name": level["name"],
+            "degraded": index > 0,
+            "requested_samples": requested_samples,
+            "num_samples": samples,
+            "n_segments": level["n_segments"],
+            "inline_dpi": level["inline_dpi"],
+            "explain_target": level_target,
+            "queue_depth": queue_depth,
+            "predicted_seconds": None if predicted is None else round(predicted, 2),
+            "slo_seconds": self.slo_seconds,
+        }
+
+    def observe(self, timing, num_samples):
+        """Fold a completed explanation's timing (from explain_image_array) into the averages.
+
+        Refinements reuse earlier samples, so the per-sample cost is taken over
+        the samples actually evaluated (none: only the fixed cost is updated).
+        """
+        target = timing["target"]
+        evaluated = timing.get("evaluated_samples", num_samples)
+        fixed = max(0.0, timing["total_seconds"] - timing["classifier_seconds"])
+        with self._lock:
+            self._fixed_seconds[target] = self._ewma(self._fixed_seconds.get(target), fixed)
+            if evaluated:
+                per_sample = timing["classifier_seconds"] / evaluated
+                self._per_sample_seconds[target] = self._ewma(self._per_sample_seconds.get(target), per_sample)
+
+    def observe_render(self, seconds, dpi):
+        with self._lock:
+            normalized = seconds * (DEFAULT_INLINE_DPI / dpi) ** 2
+            self._render_seconds_150dpi = self._ewma(self._render_seconds_150dpi, normalized)
+
+    @asynccontextmanager
+    async def session(self, requested_samples, target):
+        """Plan a request's quality (wrap the work it actually runs in ``running``)"""
+        plan = self.plan(requested_samples, target)
+        if plan["degraded"]:
+            logger.info(f"Explanation quality lowered to '{plan['name']}' "
+                        f"(queue {plan['queue_depth']}, predicted {plan['predicted_seconds']}s)")
+        yield plan
+
+    @asynccontextmanager
+    async def running(self):
+        """Count one explanation as in flight while it runs.
+
+        Entered by the execution itself, not by each request: coalesced
+        requests sharing one run add no load.
+        """
+        with self._lock:
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "slo_seconds": self.slo_seconds,
+                "in_flight": self.in_flight,
+                "fixed_seconds": dict(self._fixed_seconds),
+                "per_sample_seconds": dict(self._per_sample_seconds),
+                "render_seconds_150dpi": self._render_seconds_150dpi,
+                "delivered": dict(self._delivered),
+            }
+
+quality_controller = AdaptiveQualityController()
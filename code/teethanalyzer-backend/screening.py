@@ -0,0 +1,199 @@
+# screening.py - Live camera screening: near-duplicate frame skipping, latest-frame-wins scheduling
+import os
+import io
+import time
+import asyncio
+import threading
+import logging
+from fastapi.concurrency import run_in_threadpool
+from PIL import Image
+
+from autoencoder import autoencoder_verdict, preprocess_image_for_autoencoder, reconstruction_errors
+from memory_budget import AdmissionRejected, memory_admission
+from near_duplicate import dhash
+from quality import quality_controller
+from serving_config import inference_slot
+from triage import get_triage_classifier
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on frames processed per second per session (when the server is idle)
+SCREEN_MAX_FPS = float(os.getenv("SCREEN_MAX_FPS", "5"))
+# Frames within this dHash distance of the last processed frame are skipped
+SCREEN_DUPLICATE_DISTANCE = int(os.getenv("SCREEN_DUPLICATE_DISTANCE", "4"))
+SCREEN_MAX_FRAME_BYTES = int(os.getenv("SCREEN_MAX_FRAME_BYTES", str(2 * 1024 * 1024)))
+# Server load (other busy sessions + explanations in flight + requests waiting for memory)
+# at which sessions run only the autoencoder gate
+SCREEN_GATE_ONLY_LOAD = int(os.getenv("SCREEN_GATE_ONLY_LOAD", "4"))
+# Weight of the newest frame in the processing-time moving average
+EWMA_ALPHA = 0.3
+
+def screen_frame(autoencoder_model, device, predictor, frame_bytes, gate_only=False):
+    """Autoencoder gate, then (for diseased frames, unless gate_only) the triage student or hybrid model"""
+    batch = preprocess_image_for_autoencoder(frame_bytes).to(device)
+    with inference_slot():
+        errors, _ = reconstruction_errors(autoencoder_model, batch)
+    result = {'validation': autoencoder_verdict(float(errors[0])), 'prediction': None, 'tier': None}
+    if gate_only or not result['validation']['is_valid']:
+        return result
+
+    triage = get_triage_classifier(predictor.label_encoder.classes_)
+    if triage is not None:
+        prediction, _ = triage.triage(frame_bytes)
+        if prediction is not None:
+            result.update(prediction=prediction, tier='triage')
+            return result
+    image = Image.open(io.BytesIO(frame_bytes)).convert('RGB')
+    result.update(prediction=predictor.predict_frame(image), tier='hybrid')
+    return result
+
+class ScreeningStats:
+    """Process-wide session counts and frame totals"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sessions = 0
+        self.processing = 0
+        self.totals = {"received": 0, "duplicates": 0, "dropped": 0, "processed": 0, "gate_only": 0}
+
+    def add(self, counter, amount=1):
+        with self._lock:
+            self.totals[counter] += amount
+
+    def adjust(self, gauge, delta):
+        with self._lock:
+            setattr(self, gauge, getattr(self, gauge) + delta)
+
+    def snapshot(self):
+        with self._lock:
+            return {"sessions": self.sessions, "processing": self.processing, **self.totals}
+
+screening_stats = ScreeningStats()
+
+class _Frame:
+    __slots__ = ("seq", "data", "phash", "received_at")
+
+    def __init__(self, seq, data, phash, received_at):
+        self.seq = seq
+        self.data = data
+        self.phash = phash
+        self.received_at = received_at
+
+class ScreeningSession:
+    """One camera stream: keeps only the newest pending frame and paces processing to load.
+
+    ``process(frame_bytes, gate_only)`` is awaited for each processed frame and
+    ``send(message)`` delivers results. Frames arriving while one is processed
+    replace each other, so the client always gets feedback on its latest view.
+    """
+
+    def __init__(self, process, send):
+        self._process = process
+        self._send = send
+        self._pending = None
+        self._ready = asyncio.Event()
+        self._last_hash = None
+        self._next_allowed = 0.0
+        self._processing_seconds = None
+        self._seq = 0
+        self._since_result = {"duplicates": 0, "dropped": 0}
+        self.stats = {"received": 0, "duplicates": 0, "dropped": 0, "processed": 0}
+
+    def _count(self, counter):
+        self.stats[counter] += 1
+        screening_stats.add(counter)
+        if counter in self._since_result:
+            self._since_result[counter] += 1
+
+    async def on_frame(self, frame_bytes):
+        """Accept one received frame; returns an error message for the client or None"""
+        received_at = time.perf_counter()
+        self._seq += 1
+        self._count("received")
+        if len(frame_bytes) > SCREEN_MAX_FRAME_BYTES:
+            return {"type": "error", "frame": self._seq, "detail": f"Frame exceeds {SCREEN_MAX_FRAME_BYTES} bytes"}
+        try:
+            phash = await run_in_threadpool(dhash, frame_bytes)
+        except Exception:
+            return {"type": "error", "frame": self._seq, "detail": "Frame could not be decoded"}
+        if (self._last_hash is not None
+                and bin(phash ^ self._last_hash).count("1") <= SCREEN_DUPLICATE_DISTANCE):
+            self._count("duplicates")
+            return None
+        if self._pending is not None:
+            self._count("dropped")
+        self._pending = _Frame(self._seq, frame_bytes, phash, received_at)
+        self._ready.set()
+        return None
+
+    def _load(self):
+        """Other work competing for this worker's CPU (this session is not processing yet)"""
+        return screening_stats.processing + quality_controller.in_flight + memory_admission.waiting
+
+    async def run(self):
+        """Process pending frames until cancelled"""
+        while True:
+            await self._ready.wait()
+            delay = self._next_allowed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)  # newer frames may still replace the pending one
+            self._ready.clear()
+            frame, self._pending = self._pending, None
+            if frame is None:
+                continue
+            self._last_hash = frame.phash
+            await self._handle(frame)
+
+    async def _handle(self, frame):
+        load = self._load()
+        gate_only = load >= SCREEN_GATE_ONLY_LOAD
+        start = time.perf_counter()
+        screening_stats.adjust("processing", 1)
+        try:
+            result = await self._process(frame.data, gate_only)
+        except AdmissionRejected as e:
+            result = None
+            message = {"type": "busy", "frame": frame.seq, "detail": str(e)}
+        except Exception as e:
+            logger.error(f"Screening frame {frame.seq} failed: {str(e)}")
+            result = None
+            message = {"type": "error", "frame": frame.seq, "detail": str(e)}
+        finally:
+            screening_stats.adjust("processing", -1)
+        done = time.perf_counter()
+
+        seconds = done - start
+        self._processing_seconds = (seconds if self._processing_seconds is None
+                                    else (1 - EWMA_ALPHA) * self._processing_seconds + EWMA_ALPHA * seconds)
+        # Idle: up to SCREEN_MAX_FPS; busy: leave room for the competing work
+        interval = max(1.0 / SCREEN_MAX_FPS, self._processing_seconds * load)
+        self._next_allowed = start + interval
+
+        if result is not None:
+            self._count("processed")
+            if gate_only:
+                screening_stats.add("gate_only")
+            message = {
+                "type": "result",
+                "frame": frame.seq,
+                **result,
+                "gate_only": gate_only,
+                "latency_ms": {
+                    "queue": round(1000 * (start - frame.received_at), 1),
+                    "processing": round(1000 * seconds, 1),
+                    "total": round(1000 * (done - frame.received_at), 1),
+                },
+                "skipped": dict(self._since_result),
+                "load": load,
+                "next_frame_in_ms": round(1000 * max(0.0, self._next_allowed - done), 1),
+            }
+            self._since_result = {"duplicates": 0, "dropped": 0}
+        await self._send(message)
+
+    async def __aenter__(self):
+        screening_stats.adjust("sessions", 1)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        screening_stats.adjust("sessions", -1)
+        return False
@@ -0,0 +1,206 @@
+# serving_config.py - Core partitioning across uvicorn workers and inference slots
+import os
+import json
+import time
+import fcntl
+import argparse
+import threading
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Must match uvicorn --workers; each worker gets an equal share of the cores
+SERVING_WORKERS = int(os.getenv("SERVING_WORKERS", "1"))
+# Concurrent model computations per worker; each gets worker cores / slots threads.
+# Enforced only with SERVING_CONFIG=1; otherwise forwards run as concurrently as the threadpool allows
+INFERENCE_SLOTS = int(os.getenv("INFERENCE_SLOTS", "1"))
+# "1" pins each worker process to its core partition
+SERVING_PIN_CORES = os.getenv("SERVING_PIN_CORES", "0") == "1"
+# Where workers claim their partition index (one lock file per index)
+SERVING_SLOT_DIR = os.getenv("SERVING_SLOT_DIR", "cache/serving")
+# "1" sizes torch/OpenMP/LightGBM threads per worker and slot; "0" leaves library defaults
+SERVING_CONFIG_ENABLED = os.getenv("SERVING_CONFIG", "0") == "1"
+
+serving_state = {"applied": False, "worker_index": None, "cores": None, "threads_per_slot": None}
+_slot_lock_file = None  # held open for the life of the process
+_inference_slots = threading.BoundedSemaphore(max(1, INFERENCE_SLOTS))
+
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def partition_cores(cores, parts):
+    """Split cores into `parts` contiguous, disjoint (as far as possible) sets"""
+    per_part = max(1, len(cores) // parts)
+    return [cores[(i * per_part) % len(cores):][:per_part] for i in range(parts)]
+
+def claim_worker_index(workers, slot_dir=SERVING_SLOT_DIR):
+    """Index of this process among the uvicorn workers, via an flock on one file per index"""
+    global _slot_lock_file
+    os.makedirs(slot_dir, exist_ok=True)
+    for index in range(workers):
+        lock_file = open(os.path.join(slot_dir, f"worker-{index}.lock"), "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            continue
+        _slot_lock_file = lock_file
+        return index
+    return os.getpid() % workers  # more processes than partitions: share one
+
+def set_thread_counts(threads, interop_threads=1):
+    """Torch intra/inter-op threads plus the OpenMP/MKL env read by native libraries"""
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[var] = str(threads)
+    import torch
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(interop_threads)
+    except RuntimeError:
+        pass  # inter-op pool already started; it can only be set once per process
+
+def apply_serving_config(workers=SERVING_WORKERS, slots=INFERENCE_SLOTS, pin=SERVING_PIN_CORES):
+    """Claim this worker's core partition, optionally pin to it, and size the thread pools.
+
+    Call before the first model is built (torch fixes its inter-op pool on first use).
+    """
+    if not SERVING_CONFIG_ENABLED or serving_state["applied"]:
+        return serving_state
+    cores = available_cores()
+    index = claim_worker_index(workers) if workers > 1 else 0
+    worker_cores = partition_cores(cores, workers)[index]
+    if pin and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, worker_cores)
+    threads_per_slot = max(1, len(worker_cores) // max(1, slots))
+    set_thread_counts(threads_per_slot)
+    serving_state.update({
+        "applied": True,
+        "workers": workers,
+        "worker_index": index,
+        "cores": worker_cores,
+        "pinned": pin,
+        "inference_slots": slots,
+        "threads_per_slot": threads_per_slot,
+    })
+    logger.info(f"Serving config: worker {index}/{workers} on cores {worker_cores}, "
+                f"{slots} inference slot(s) x {threads_per_slot} threads")
+    return serving_state
+
+def lightgbm_threads():
+    """num_threads for LightGBM predict calls (0 = LightGBM's default)"""
+    return serving_state["threads_per_slot"] or 0
+
+@contextmanager
+def inference_slot():
+    """Hold one of this worker's INFERENCE_SLOTS while running a model.
+
+    Slots x threads-per-slot equals the worker's cores, so concurrent fast and
+    LIME requests queue here instead of oversubscribing the CPU. A no-op until
+    apply_serving_config has sized the threads (SERVING_CONFIG=1).
+    """
+    if not serving_state["applied"]:
+        yield
+        return
+    with _inference_slots:
+        yield
+
+# ==================== LAYOUT SWEEP ====================
+
+def _sweep_worker(image_bytes, cores, slots, threads, duration, results):
+    """One simulated uvicorn worker: pinned, sized, predicting in a loop from ``slots`` threads"""
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    set_thread_counts(threads)
+    from lime_inference import get_lime_predictor
+    predictor = get_lime_predictor()
+    predictor.warmup()
+    latencies = []
+    deadline = time.perf_counter() + duration
+
+    def run_slot():
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            predictor._predict_with_features(image_bytes)  # unmemoized
+            latencies.append(time.perf_counter() - start)
+
+    slot_threads = [threading.Thread(target=run_slot) for _ in range(slots)]
+    for thread in slot_threads:
+        thread.start()
+    for thread in slot_threads:
+        thread.join()
+    results.put(latencies)
+
+def default_layouts(core_count):
+    """(workers, slots, threads) layouts where workers x slots x threads fills every core"""
+    return [(workers, slots, core_count // workers // slots)
+            for workers in range(1, core_count + 1) if core_count % workers == 0
+            for slots in range(1, core_count // workers + 1) if (core_count // workers) % slots == 0]
+
+def sweep(image_path, duration=15.0, layouts=None):
+    """Throughput and latency of workers x slots x threads layouts"""
+    import statistics
+    from multiprocessing import get_context
+
+    with open(image_path, "rb") as f:
+        image_bytes = f.read()
+    cores = available_cores()
+    if layouts is None:
+        layouts = default_layouts(len(cores))
+
+    context = get_context("spawn")
+    report = []
+    for workers, slots, threads in layouts:
+        results = context.Queue()
+        processes = [
+            context.Process(target=_sweep_worker,
+                            args=(image_bytes, part[:slots * threads], slots, threads, duration, results))
+            for part in partition_cores(cores, workers)
+        ]
+        for process in processes:
+            process.start()
+        latencies = []
+        for _ in processes:
+            latencies.extend(results.get())
+        for process in processes:
+            process.join()
+        entry = {
+            "workers": workers,
+            "slots_per_worker": slots,
+            "threads_per_slot": threads,
+            "throughput_per_s": len(latencies) / duration,
+            "p50_ms": 1000 * statistics.median(latencies) if latencies else None,
+            "p95_ms": 1000 * statistics.quantiles(latencies, n=20)[18] if len(latencies) >= 20 else None,
+        }
+        report.append(entry)
+        print(json.dumps(entry))
+    best = max(report, key=lambda e: e["throughput_per_s"])
+    return {
+        "cores": len(cores),
+        "layouts": report,
+        "best": best,
+        "suggested_env": {
+            "SERVING_CONFIG": 1,
+            "SERVING_WORKERS": best["workers"],
+            "INFERENCE_SLOTS": best["slots_per_worker"],
+            "uvicorn_workers": best["workers"],
+        },
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serving topology utilities")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    sweep_parser = subparsers.add_parser("sweep", help="Find the best workers x slots x threads layout")
+    sweep_parser.add_argument("image")
+    sweep_parser.add_argument("--duration", type=float, default=15.0, help="Seconds per layout")
+    sweep_parser.add_argument("--layout", action="append", metavar="WORKERSxSLOTSxTHREADS",
+                              help="Layout to test, e.g. 2x2x2 (repeatable; default: all divisors)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    layouts = None
+    if args.layout:
+        layouts = [tuple(int(v) for v in layout.lower().split("x")) for layout in args.layout]
+    print(json.dumps(sweep(args.image, args.duration, layouts), indent=2))
@@ -0,0 +1,112 @@
+# singleflight.py - Coalescing of concurrent identical work (async endpoints and worker threads)
+import asyncio
+import threading
+import logging
+from collections import OrderedDict
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+class _Flight:
+    """One shared execution and the number of callers still waiting for it"""
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+class SingleFlight:
+    """Event-loop level: concurrent calls with the same key share one execution.
+
+    The first caller starts the coroutine as a task; every caller (the first
+    included) awaits it shielded, so a disconnecting client only withdraws
+    itself. The task is cancelled once no caller is waiting for it any more.
+    Nothing is kept once it completes.
+    """
+
+    def __init__(self):
+        self._in_flight = {}
+        self._stats = {"calls": 0, "shared": 0, "abandoned": 0}
+
+    def _forget(self, key, flight):
+        if self._in_flight.get(key) is flight:
+            del self._in_flight[key]
+
+    async def do(self, key, coroutine_fn):
+        """Returns (result, shared); shared is True when another caller did the work"""
+        self._stats["calls"] += 1
+        flight = self._in_flight.get(key)
+        shared = flight is not None
+        if shared:
+            self._stats["shared"] += 1
+        else:
+            flight = _Flight(asyncio.ensure_future(coroutine_fn()))
+            self._in_flight[key] = flight
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task), shared
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                # Every caller went away: stop the work, and let new callers start afresh
+                self._stats["abandoned"] += 1
+                self._forget(key, flight)
+                flight.task.cancel()
+
+    def stats(self):
+        return dict(self._stats, in_flight=len(self._in_flight))
+
+class MemoFlight:
+    """Thread level: bounded LRU of results plus in-flight deduplication.
+
+    Used inside the predictor so the fast and LIME paths (running in different
+    threadpool threads) share sub-results such as the prediction or segment map.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._results = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "shared": 0, "computed": 0}
+
+    def get_or_compute(self, key, fn):
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                self._stats["hits"] += 1
+                return self._results[key]
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._in_flight[key] = future
+            else:
+                self._stats["shared"] += 1
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+        except BaseException as e:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._in_flight.pop(key, None)
+            self._stats["computed"] += 1
+            if self.capacity > 0:
+                self._results[key] = result
+                while len(self._results) > self.capacity:
+                    self._results.popitem(last=False)
+        future.set_result(result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, cached=len(self._results), in_flight=len(self._in_flight))
+
+# Endpoint-level coalescing keyed by (image content hash, operation)
+inflight = SingleFlight()
@@ -0,0 +1,10 @@
+import pytest
+
+pytest.importorskip("torch")
+# chat_api also pulls in the chatbot's web dependencies (fastapi, google-genai)
+chat_api = pytest.importorskip("chat_api")
+
+@pytest.mark.parametrize("feature_dim,size", [(768, 32), (64, 16)])
+def test_fused_agff_matches_reference(feature_dim, size):
+    matches, max_diff = chat_api.check_agff_parity(batch_size=2, feature_dim=feature_dim, size=size, atol=1e-4)
+    assert matches, f"fused AGFF differs from the reference block by {max_diff}"
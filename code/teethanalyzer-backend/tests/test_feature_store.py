@@ -0,0 +1,20 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from feature_store import FeatureStore, open_feature_store  # noqa: E402
+
+def test_versions_are_kept_apart(tmp_path):
+    old = FeatureStore(str(tmp_path), "hybrid", (4,), version="old")
+    old.put("digest", np.ones(4, dtype=np.float32))
+    new = FeatureStore(str(tmp_path), "hybrid", (4,), version="new")
+    assert new.get("digest") is None
+    assert old.get("digest") is not None
+
+def test_serving_store_round_trips_float32_exactly(tmp_path):
+    store = open_feature_store("hybrid", (4,), root=str(tmp_path), version="v1", fp16=False)
+    row = np.array([0.1, 1 / 3, 12345.678, -2e-5], dtype=np.float32)
+    store.put("digest", row)
+    reopened = FeatureStore(str(tmp_path), "hybrid", (4,), version="v1")
+    assert reopened.dtype == np.float32
+    np.testing.assert_array_equal(reopened.get("digest"), row)
@@ -0,0 +1,69 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("PIL")
+
+from lime_engine import LimeEngine, SampleStore, _synthetic_classifier  # noqa: E402
+
+def _image_and_segments():
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, size=(48, 64, 3), dtype=np.uint8)
+    segments = (np.arange(48)[:, None] // 12) * 4 + (np.arange(64)[None, :] // 16)  # 16 superpixels
+    return image, segments
+
+def _explain(store, classifier_fn, num_samples):
+    image, segments = _image_and_segments()
+    return LimeEngine(random_state=42).explain_instance(
+        image, classifier_fn, lambda x: segments, labels=range(6), hide_color=0,
+        num_samples=num_samples, batch_size=16, sample_store=store, sample_key="key"
+    )
+
+def test_resume_matches_fresh_run():
+    classifier_fn = _synthetic_classifier()
+    store = SampleStore(directory="")
+    _explain(store, classifier_fn, 100)
+    resumed = _explain(store, classifier_fn, 300)
+    fresh = _explain(None, classifier_fn, 300)
+
+    assert resumed.reused_samples == 100 and resumed.evaluated_samples == 200
+    assert resumed.local_exp == fresh.local_exp
+
+def test_failed_scoring_does_not_advance_the_stored_rng():
+    classifier_fn = _synthetic_classifier()
+    calls = {"n": 0}
+
+    def flaky(images):
+        calls["n"] += 1
+        if calls["n"] == 1:
+            raise RuntimeError("worker crashed")
+        return classifier_fn(images)
+
+    store = SampleStore(directory="")
+    with pytest.raises(RuntimeError):
+        _explain(store, flaky, 200)
+    resumed = _explain(store, flaky, 200)
+    fresh = _explain(None, classifier_fn, 200)
+
+    assert resumed.evaluated_samples == 200
+    assert resumed.local_exp == fresh.local_exp
+
+def test_parity_with_lime():
+    lime_image = pytest.importorskip("lime.lime_image")
+    image, segments = _image_and_segments()
+    classifier_fn = _synthetic_classifier()
+
+    reference = lime_image.LimeImageExplainer(random_state=42).explain_instance(
+        image, classifier_fn, top_labels=3, hide_color=0, num_samples=300,
+        segmentation_fn=lambda x: segments, random_seed=42
+    )
+    native = LimeEngine(random_state=42).explain_instance(
+        image, classifier_fn, lambda x: segments, top_labels=3, hide_color=0, num_samples=300
+    )
+
+    assert list(native.top_labels) == list(reference.top_labels)
+    for label in reference.top_labels:
+        ref = dict(reference.local_exp[label])
+        ours = dict(native.local_exp[label])
+        assert ours.keys() == ref.keys()
+        assert max(abs(ref[f] - ours[f]) for f in ref) <= 1e-6
+        assert native.intercept[label] == pytest.approx(reference.intercept[label], abs=1e-6)
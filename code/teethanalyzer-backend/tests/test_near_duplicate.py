@@ -0,0 +1,54 @@
+import io
+
+import pytest
+
+np = pytest.importorskip("numpy")
+Image = pytest.importorskip("PIL.Image")
+
+from near_duplicate import NearDuplicateIndex, dhash  # noqa: E402
+
+def _jpeg(array):
+    buf = io.BytesIO()
+    Image.fromarray(array).save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+def _similar_photos():
+    """Two different images with the same framing: shared left-to-right gradient, different texture"""
+    gradient = np.tile(np.linspace(40, 220, 256), (192, 1))
+    rng = np.random.default_rng(0)
+    first = gradient + rng.normal(0, 6, gradient.shape)
+    second = gradient + rng.normal(0, 6, gradient.shape)
+    second[60:120, 100:160] += 12  # a small lesion-sized difference
+    to_rgb = lambda a: np.repeat(np.clip(a, 0, 255).astype(np.uint8)[..., None], 3, axis=2)
+    return _jpeg(to_rgb(first)), _jpeg(to_rgb(second))
+
+def test_disabled_by_default():
+    assert not NearDuplicateIndex().enabled
+
+def test_hash_collision_without_matching_embedding_is_not_merged():
+    first, second = _similar_photos()
+    h1, h2 = dhash(first), dhash(second)
+    assert bin(h1 ^ h2).count("1") <= 6  # the hash alone would merge these photos
+
+    rng = np.random.default_rng(1)
+    embedding_first = rng.normal(size=1024)
+    embedding_second = rng.normal(size=1024)
+
+    index = NearDuplicateIndex(max_distance=6)
+    index.add(h1, "predict", {"hybrid_prediction": "caries"}, "hash-first", embedding_first)
+
+    assert index.lookup(h2, "predict", embedding_second) is None
+    assert index.stats()["rejected"] == 1
+
+def test_confirmed_match_is_reused():
+    first, _ = _similar_photos()
+    h1 = dhash(first)
+    embedding = np.random.default_rng(2).normal(size=1024)
+
+    index = NearDuplicateIndex(max_distance=6)
+    index.add(h1, "predict", {"hybrid_prediction": "caries"}, "hash-first", embedding)
+
+    hit = index.lookup(h1, "predict", embedding * 1.01)
+    assert hit is not None
+    result, distance, image_hash, similarity = hit
+    assert image_hash == "hash-first" and distance == 0 and similarity > 0.99
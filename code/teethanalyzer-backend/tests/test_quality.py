@@ -0,0 +1,29 @@
+import asyncio
+
+from quality import AdaptiveQualityController
+from singleflight import SingleFlight
+
+def test_coalesced_requests_count_as_one_unit_of_load():
+    async def scenario():
+        controller = AdaptiveQualityController()
+        flight = SingleFlight()
+        release = asyncio.Event()
+        seen = []
+
+        async def request():
+            async with controller.session(300, "hybrid"):
+                async def run():
+                    async with controller.running():
+                        await release.wait()
+                        return "explanation"
+                return await flight.do("key", run)
+
+        callers = [asyncio.ensure_future(request()) for _ in range(4)]
+        await asyncio.sleep(0.01)
+        seen.append(controller.in_flight)
+        release.set()
+        await asyncio.gather(*callers)
+        seen.append(controller.in_flight)
+        return seen
+
+    assert asyncio.run(scenario()) == [1, 0]
@@ -0,0 +1,161 @@
+# tiling.py - Tiled full-resolution analysis: batched tile inference, healthy-tile skipping, localization grid
+import os
+import io
+import math
+import time
+import logging
+import numpy as np
+import torch
+from PIL import Image
+
+from autoencoder import RECONSTRUCTION_ERROR_THRESHOLD, reconstruction_errors, transform as autoencoder_transform
+from lime_inference import IMAGE_SIZE
+from serving_config import inference_slot
+
+logger = logging.getLogger(__name__)
+
+# Tiles are cut at the classifier's input size, so no detail is lost to resizing
+TILE_SIZE = IMAGE_SIZE[0]
+# Fraction of a tile shared with its neighbour (lesions on a tile border appear whole in one tile)
+TILE_OVERLAP = float(os.getenv("TILE_OVERLAP", "0.25"))
+# Tiles per request; larger photos are downscaled until their grid fits the budget
+TILE_BUDGET = int(os.getenv("TILE_BUDGET", "48"))
+TILE_MAX_BUDGET = int(os.getenv("TILE_MAX_BUDGET", "192"))
+# Tiles per batched forward (autoencoder and backbone)
+TILE_BATCH_SIZE = int(os.getenv("TILE_BATCH_SIZE", "16"))
+# Tiles the autoencoder reconstructs at or below this error are skipped as healthy
+TILE_HEALTHY_THRESHOLD = float(os.getenv("TILE_HEALTHY_THRESHOLD", str(RECONSTRUCTION_ERROR_THRESHOLD)))
+# How evaluated tiles combine into image probabilities: "mean" averages every evaluated tile,
+# "topk" averages the TILE_TOP_K most abnormal ones (so a small lesion is not diluted)
+TILE_AGGREGATION = os.getenv("TILE_AGGREGATION", "mean")
+TILE_TOP_K = int(os.getenv("TILE_TOP_K", "4"))
+
+def _axis_positions(length, tile_size, stride):
+    """Tile offsets along one axis, evenly spread with the last tile flush with the edge"""
+    if length <= tile_size:
+        return [0]
+    count = math.ceil((length - tile_size) / stride) + 1
+    last = length - tile_size
+    return [round(i * last / (count - 1)) for i in range(count)]
+
+def plan_tiles(width, height, tile_size=TILE_SIZE, overlap=TILE_OVERLAP, budget=TILE_BUDGET):
+    """Analysis size and tile offsets for an image so the grid stays within budget tiles"""
+    stride = max(1, round(tile_size * (1 - overlap)))
+    scale = 1.0
+    while True:
+        size = (max(tile_size, round(width * scale)), max(tile_size, round(height * scale)))
+        xs = _axis_positions(size[0], tile_size, stride)
+        ys = _axis_positions(size[1], tile_size, stride)
+        count = len(xs) * len(ys)
+        if count <= budget or count == 1:
+            break
+        scale *= min(0.95, math.sqrt(budget / count))
+    return {"size": size, "scale": size[0] / width, "xs": xs, "ys": ys, "stride": stride}
+
+def _batches(indices, batch_size=TILE_BATCH_SIZE):
+    for start in range(0, len(indices), batch_size):
+        yield indices[start:start + batch_size]
+
+def tile_reconstruction_errors(autoencoder_model, device, tiles):
+    """Autoencoder reconstruction MSE per tile, in batched forwards"""
+    errors = []
+    for batch_indices in _batches(list(range(len(tiles)))):
+        batch = torch.stack([autoencoder_transform(tiles[i]) for i in batch_indices]).to(device)
+        with inference_slot():
+            batch_errors, _ = reconstruction_errors(autoencoder_model, batch)
+        errors.extend(float(e) for e in batch_errors)
+    return errors
+
+def aggregate_tiles(tile_probabilities, errors=None, method=TILE_AGGREGATION, top_k=TILE_TOP_K):
+    """Image-level class probabilities from per-tile probabilities.
+
+    Both methods average whole probability rows, so the result is still a
+    distribution. "topk" keeps the tiles with the highest reconstruction error
+    (or, without errors, the most confident tiles).
+    """
+    if method == "topk" and len(tile_probabilities) > top_k:
+        abnormality = tile_probabilities.max(axis=1) if errors is None else np.asarray(errors)
+        tile_probabilities = tile_probabilities[np.argsort(abnormality)[-top_k:]]
+    return tile_probabilities.mean(axis=0)
+
+def analyze_tiles(predictor, image_bytes, budget=TILE_BUDGET, autoencoder_model=None, device=None):
+    """Hybrid diagnosis from overlapping full-resolution tiles plus a coarse localization grid.
+
+    With ``autoencoder_model`` tiles it reconstructs well (healthy) are not sent
+    to the classifier. When every tile is skipped the whole-image prediction is
+    returned instead. ``tile_peak_scores`` holds each class's highest single-tile
+    probability; it is a localization signal, not a probability distribution.
+    """
+    start = time.perf_counter()
+    image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
+    width, height = image.size
+    plan = plan_tiles(width, height, budget=budget)
+    analysis = image if plan["size"] == (width, height) else image.resize(plan["size"], Image.BILINEAR)
+    boxes = [(x, y, x + TILE_SIZE, y + TILE_SIZE) for y in plan["ys"] for x in plan["xs"]]
+    tiles = [analysis.crop(box) for box in boxes]
+
+    errors = None
+    evaluated = list(range(len(tiles)))
+    if autoencoder_model is not None:
+        errors = tile_reconstruction_errors(autoencoder_model, device, tiles)
+        evaluated = [i for i, error in enumerate(errors) if error > TILE_HEALTHY_THRESHOLD]
+
+    class_names = [str(name) for name in predictor.label_encoder.classes_]
+    probabilities = np.full((len(tiles), len(class_names)), np.nan)
+    for batch_indices in _batches(evaluated):
+        with inference_slot():
+            features = predictor.extract_features_batch([tiles[i] for i in batch_indices])
+            probabilities[batch_indices] = predictor.score_features(features)
+
+    if evaluated:
+        tile_probabilities = probabilities[evaluated]
+        tile_errors = None if errors is None else [errors[i] for i in evaluated]
+        image_probabilities = aggregate_tiles(tile_probabilities, tile_errors)
+        prediction = int(np.argmax(image_probabilities))
+        result = {
+            'hybrid_prediction': class_names[prediction],
+            'hybrid_confidence': float(image_probabilities[prediction]),
+            'all_probabilities': {name: float(p) for name, p in zip(class_names, image_probabilities)},
+            # Highest single-tile probability per class (uncalibrated; does not sum to 1)
+            'tile_peak_scores': {name: float(p) for name, p in zip(class_names, tile_probabilities.max(axis=0))},
+            'aggregation': TILE_AGGREGATION,
+        }
+    else:
+        result = dict(predictor.predict(image_bytes))
+        result['aggregation'] = 'whole_image'
+        prediction = class_names.index(str(result['hybrid_prediction']))
+
+    # Grid cells in original-image pixel coordinates (tiles overlap, so boxes do too)
+    sx, sy = width / plan["size"][0], height / plan["size"][1]
+    cells = []
+    for i, (x0, y0, x1, y1) in enumerate(boxes):
+        tile_prediction = None if np.isnan(probabilities[i, 0]) else int(np.argmax(probabilities[i]))
+        cells.append({
+            'row': i // len(plan["xs"]),
+            'col': i % len(plan["xs"]),
+            'box': [round(x0 * sx), round(y0 * sy), round(min(x1 * sx, width)), round(min(y1 * sy, height))],
+            'skipped': tile_prediction is None,
+            'reconstruction_error': None if errors is None else errors[i],
+            'prediction': None if tile_prediction is None else class_names[tile_prediction],
+            'confidence': None if tile_prediction is None else float(probabilities[i, tile_prediction]),
+        })
+    class_grid = probabilities[:, prediction].reshape(len(plan["ys"]), len(plan["xs"]))
+
+    result['tiling'] = {
+        'tiles_total': len(tiles),
+        'tiles_evaluated': len(evaluated),
+        'tiles_skipped': len(tiles) - len(evaluated),
+        'tile_size': TILE_SIZE,
+        'stride': plan["stride"],
+        'scale': round(plan["scale"], 4),
+        'seconds': round(time.perf_counter() - start, 3),
+    }
+    result['grid'] = {
+        'rows': len(plan["ys"]),
+        'cols': len(plan["xs"]),
+        'cells': cells,
+        # Probability of the image-level diagnosis per tile (None: skipped as healthy)
+        'prediction_probability': [[None if np.isnan(p) else float(p) for p in row] for row in class_grid],
+    }
+    logger.info(f"Tiled analysis: {result['tiling']}")
+    return result
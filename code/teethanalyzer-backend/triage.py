@@ -0,0 +1,316 @@
+# triage.py - Lightweight triage student for a confidence-based /predict-fast cascade
+import os
+import io
+import json
+import time
+import argparse
+import threading
+import logging
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torchvision import models, transforms
+from PIL import Image
+
+from serving_config import inference_slot
+
+logger = logging.getLogger(__name__)
+
+TRIAGE_MODEL_PATH = os.getenv("TRIAGE_MODEL_PATH", "hybrid_models/triage_student.pth")
+TRIAGE_IMAGE_SIZE = (224, 224)
+# "1" answers /predict-fast from the student when it is confident enough
+PREDICT_CASCADE = os.getenv("PREDICT_CASCADE", "0") == "1"
+# The student answers only when both hold; otherwise the full hybrid path runs
+TRIAGE_MIN_CONFIDENCE = float(os.getenv("TRIAGE_MIN_CONFIDENCE", "0.9"))
+TRIAGE_MIN_MARGIN = float(os.getenv("TRIAGE_MIN_MARGIN", "0.5"))
+
+triage_transform = transforms.Compose([
+    transforms.Resize(TRIAGE_IMAGE_SIZE),
+    transforms.ToTensor(),
+    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+])
+
+class TriageStudent(nn.Module):
+    """MobileNetV3-Small distilled from the hybrid EfficientNetV2 + LightGBM teacher"""
+    def __init__(self, num_classes, pretrained=False):
+        super(TriageStudent, self).__init__()
+        weights = models.MobileNet_V3_Small_Weights.DEFAULT if pretrained else None
+        self.backbone = models.mobilenet_v3_small(weights=weights)
+        in_features = self.backbone.classifier[3].in_features
+        self.backbone.classifier[3] = nn.Linear(in_features, num_classes)
+
+    def forward(self, x):
+        return self.backbone(x)
+
+def open_for_triage(image_bytes):
+    """Decode an upload for the student (JPEGs are downscaled during decode)"""
+    image = Image.open(io.BytesIO(image_bytes))
+    image.draft('RGB', TRIAGE_IMAGE_SIZE)
+    return image
+
+def confidence_and_margin(probabilities):
+    """Top-1 probability and its gap to the runner-up"""
+    top2 = np.sort(probabilities)[-2:]
+    return float(top2[1]), float(top2[1] - top2[0])
+
+class TriageClassifier:
+    """Loaded student plus the cascade decision rule"""
+
+    def __init__(self, model_path=TRIAGE_MODEL_PATH, class_names=None, min_confidence=TRIAGE_MIN_CONFIDENCE,
+                 min_margin=TRIAGE_MIN_MARGIN):
+        """``class_names`` (the hybrid label encoder's classes) must equal the
+        student's saved class list, in order, or the student is refused."""
+        checkpoint = torch.load(model_path, map_location='cpu')
+        self.classes = [str(c) for c in checkpoint['classes']]
+        if class_names is not None and self.classes != [str(c) for c in class_names]:
+            raise ValueError(f"Triage student classes {self.classes} do not match the hybrid model's "
+                             f"{[str(c) for c in class_names]}")
+        self.model = TriageStudent(num_classes=len(self.classes))
+        self.model.load_state_dict(checkpoint['model_state_dict'])
+        self.model.eval()
+        self.min_confidence = min_confidence
+        self.min_margin = min_margin
+        logger.info(f"Triage student loaded from {model_path}")
+
+    def warmup(self):
+        with torch.no_grad():
+            self.model(torch.zeros(1, 3, *TRIAGE_IMAGE_SIZE))
+
+    def probabilities(self, images):
+        """(N, num_classes) softmax for a list of PIL images; the forward runs in an inference slot"""
+        batch = torch.stack([triage_transform(img.convert('RGB')) for img in images])
+        with inference_slot(), torch.no_grad():
+            return F.softmax(self.model(batch), dim=1).numpy()
+
+    def accepts(self, probabilities, min_confidence=None, min_margin=None):
+        confidence, margin = confidence_and_margin(probabilities)
+        min_confidence = self.min_confidence if min_confidence is None else min_confidence
+        min_margin = self.min_margin if min_margin is None else min_margin
+        return confidence >= min_confidence and margin >= min_margin
+
+    def triage(self, image_bytes):
+        """(student result, or None to escalate; decision details).
+
+        The student's answer is reported under its own triage_* keys, never as a
+        cnn_/hybrid_ result; its classes were checked against the hybrid model's
+        at load, so all_probabilities is keyed the same way as the hybrid path.
+        """
+        probabilities = self.probabilities([open_for_triage(image_bytes)])[0]
+        confidence, margin = confidence_and_margin(probabilities)
+        decision = {
+            'confidence': confidence,
+            'margin': margin,
+            'min_confidence': self.min_confidence,
+            'min_margin': self.min_margin,
+        }
+        if not self.accepts(probabilities):
+            return None, decision
+        label = self.classes[int(np.argmax(probabilities))]
+        return {
+            'triage_prediction': label,
+            'triage_confidence': confidence,
+            'all_probabilities': {c: float(p) for c, p in zip(self.classes, probabilities)},
+        }, decision
+
+# Global instance (lazy initialization)
+_triage_classifier = None
+_triage_lock = threading.Lock()
+_triage_refused = False  # the trained student's classes do not match the hybrid model's
+
+def get_triage_classifier(class_names):
+    """Get or create the triage student, or None when the cascade is off, no model is trained
+    or the student's classes differ from ``class_names`` (the hybrid label encoder's)"""
+    global _triage_classifier, _triage_refused
+    if _triage_classifier is None and not _triage_refused and PREDICT_CASCADE and os.path.exists(TRIAGE_MODEL_PATH):
+        with _triage_lock:
+            if _triage_classifier is None and not _triage_refused:
+                try:
+                    _triage_classifier = TriageClassifier(class_names=class_names)
+                except ValueError as e:
+                    logger.error(f"Triage student refused, cascade disabled: {str(e)}")
+                    _triage_refused = True
+    return _triage_classifier
+
+# ==================== DISTILLATION ====================
+
+def _labeled_paths(image_dir):
+    from autoencoder import IMAGE_EXTENSIONS
+    paths = []
+    for root, _, names in os.walk(image_dir):
+        for name in sorted(names):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                rel_path = os.path.relpath(os.path.join(root, name), image_dir)
+                label = rel_path.split(os.sep)[0] if os.sep in rel_path else None
+                paths.append((os.path.join(image_dir, rel_path), label))
+    return sorted(paths)
+
+def teacher_targets(paths, predictor, batch_size=32):
+    """Hybrid (LightGBM) probabilities per image; cached hybrid features skip the backbone"""
+    from image_store import content_hash
+
+    targets = np.zeros((len(paths), len(predictor.label_encoder.classes_)), dtype=np.float32)
+    store = predictor.feature_store
+    for start in range(0, len(paths), batch_size):
+        batch = paths[start:start + batch_size]
+        features, missing = [], []
+        for i, (path, _) in enumerate(batch):
+            with open(path, "rb") as f:
+                digest = content_hash(f.read())
+            cached = store.get(digest) if store is not None else None
+            if cached is None:
+                missing.append(i)
+            features.append(cached)
+        if missing:
+            extracted = predictor.extract_features_batch([Image.open(batch[i][0]) for i in missing])
+            for i, row in zip(missing, extracted):
+                features[i] = row
+        targets[start:start + len(batch)] = predictor.score_features(np.stack(features))
+        logger.info(f"Teacher targets {min(start + batch_size, len(paths))}/{len(paths)}")
+    return targets
+
+def distill(image_dir, output_path=TRIAGE_MODEL_PATH, epochs=10, batch_size=32, lr=1e-3,
+            temperature=2.0, alpha=0.7):
+    """Train the student on teacher soft targets (plus folder labels when present)"""
+    from lime_inference import get_lime_predictor
+
+    predictor = get_lime_predictor()
+    classes = list(predictor.label_encoder.classes_)
+    paths = _labeled_paths(image_dir)
+    if not paths:
+        raise ValueError(f"No images found under {image_dir}")
+    targets = torch.from_numpy(teacher_targets(paths, predictor))
+    hard = torch.tensor([classes.index(label) if label in classes else -1 for _, label in paths])
+
+    augment = transforms.Compose([
+        transforms.RandomResizedCrop(TRIAGE_IMAGE_SIZE, scale=(0.7, 1.0)),
+        transforms.RandomHorizontalFlip(),
+        transforms.ColorJitter(0.2, 0.2, 0.2),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+    ])
+    student = TriageStudent(num_classes=len(classes), pretrained=True)
+    optimizer = torch.optim.AdamW(student.parameters(), lr=lr, weight_decay=1e-4)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=epochs)
+
+    for epoch in range(epochs):
+        student.train()
+        order = torch.randperm(len(paths))
+        total_loss = 0.0
+        for start in range(0, len(paths), batch_size):
+            idx = order[start:start + batch_size]
+            batch = torch.stack([augment(Image.open(paths[i][0]).convert('RGB')) for i in idx])
+            logits = student(batch)
+            soft_targets = F.softmax(torch.log(targets[idx].clamp_min(1e-8)) / temperature, dim=1)
+            loss = alpha * F.kl_div(F.log_softmax(logits / temperature, dim=1), soft_targets,
+                                    reduction='batchmean') * temperature ** 2
+            labeled = hard[idx] >= 0
+            if labeled.any():
+                loss = loss + (1 - alpha) * F.cross_entropy(logits[labeled], hard[idx][labeled])
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total_loss += loss.item() * len(idx)
+        scheduler.step()
+        logger.info(f"Epoch {epoch + 1}/{epochs}: loss {total_loss / len(paths):.4f}")
+
+    torch.save({
+        'model_state_dict': student.state_dict(),
+        'num_classes': len(classes),
+        'classes': classes,
+        'teacher_version': predictor.model_version,
+    }, output_path)
+    return output_path
+
+# ==================== CASCADE REPORT ====================
+
+def cascade_report(image_dir, model_path=TRIAGE_MODEL_PATH,
+                   thresholds=(0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 0.98), min_margin=TRIAGE_MIN_MARGIN):
+    """Accuracy and mean latency of the cascade at each confidence threshold.
+
+    Acceptance uses the served rule (confidence and ``min_margin``); the
+    entry for the configured TRIAGE_MIN_CONFIDENCE is marked "served".
+    """
+    from lime_inference import get_lime_predictor
+
+    predictor = get_lime_predictor()
+    triage = TriageClassifier(model_path, class_names=predictor.label_encoder.classes_, min_margin=min_margin)
+    triage.warmup()
+    predictor.warmup()
+
+    rows = []
+    for path, label in _labeled_paths(image_dir):
+        with open(path, "rb") as f:
+            image_bytes = f.read()
+        start = time.perf_counter()
+        student_probs = triage.probabilities([open_for_triage(image_bytes)])[0]
+        student_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        full = predictor._predict_with_features(image_bytes)[0]  # unmemoized: measure real cost
+        full_seconds = time.perf_counter() - start
+        rows.append({
+            "label": label,
+            "student": triage.classes[int(np.argmax(student_probs))],
+            "probabilities": student_probs,
+            "full": full['hybrid_prediction'],
+            "student_seconds": student_seconds,
+            "full_seconds": full_seconds,
+        })
+    if not rows:
+        raise ValueError(f"No images found under {image_dir}")
+
+    labeled = [r for r in rows if r["label"] is not None]
+    mean_student = float(np.mean([r["student_seconds"] for r in rows]))
+    mean_full = float(np.mean([r["full_seconds"] for r in rows]))
+    report = {
+        "images": len(rows),
+        "min_margin": triage.min_margin,
+        "full_only": {
+            "mean_latency_ms": 1000 * mean_full,
+            "accuracy": float(np.mean([r["full"] == r["label"] for r in labeled])) if labeled else None,
+        },
+        "thresholds": [],
+    }
+    for threshold in sorted(set(thresholds) | {triage.min_confidence}):
+        answered = [triage.accepts(r["probabilities"], min_confidence=threshold) for r in rows]
+        cascade = [r["student"] if a else r["full"] for r, a in zip(rows, answered)]
+        escalated = 1.0 - float(np.mean(answered))
+        entry = {
+            "min_confidence": threshold,
+            "served": threshold == triage.min_confidence,
+            "student_answered": float(np.mean(answered)),
+            "agreement_with_full": float(np.mean([c == r["full"] for c, r in zip(cascade, rows)])),
+            "mean_latency_ms": 1000 * (mean_student + escalated * mean_full),
+        }
+        if labeled:
+            entry["accuracy"] = float(np.mean([c == r["label"] for c, r in zip(cascade, rows) if r["label"] is not None]))
+        report["thresholds"].append(entry)
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Triage student for the /predict-fast cascade")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    distill_parser = subparsers.add_parser("distill", help="Distill the student from the hybrid model")
+    distill_parser.add_argument("image_dir", help="Folder of images (optionally image_dir/<label>/*)")
+    distill_parser.add_argument("--output", default=TRIAGE_MODEL_PATH)
+    distill_parser.add_argument("--epochs", type=int, default=10)
+    distill_parser.add_argument("--batch-size", type=int, default=32)
+    distill_parser.add_argument("--lr", type=float, default=1e-3)
+    distill_parser.add_argument("--temperature", type=float, default=2.0)
+
+    report_parser = subparsers.add_parser("report", help="Accuracy/latency per confidence threshold")
+    report_parser.add_argument("image_dir", help="Folder of images (image_dir/<label>/* for accuracy)")
+    report_parser.add_argument("--model", default=TRIAGE_MODEL_PATH)
+    report_parser.add_argument("--min-margin", type=float, default=TRIAGE_MIN_MARGIN,
+                               help="Margin rule applied with every threshold (default: the served one)")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "distill":
+        path = distill(args.image_dir, args.output, epochs=args.epochs, batch_size=args.batch_size,
+                       lr=args.lr, temperature=args.temperature)
+        print(f"Student saved to {path}")
+    elif args.command == "report":
+        print(json.dumps(cascade_report(args.image_dir, args.model, min_margin=args.min_margin), indent=2))